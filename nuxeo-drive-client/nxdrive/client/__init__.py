@@ -1,4 +1,5 @@
 from nxdrive.client.common import NotFound
+from nxdrive.client.common import CorruptedFile
 from nxdrive.client.base_automation_client import Unauthorized
 
 from nxdrive.client.remote_document_client import NuxeoDocumentInfo
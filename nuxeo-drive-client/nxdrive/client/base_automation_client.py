@@ -2,6 +2,8 @@
 
 import sys
 import base64
+from fnmatch import fnmatch
+import io
 import json
 import urllib2
 import mimetypes
@@ -9,14 +11,34 @@ import random
 import time
 import os
 import tempfile
+import zlib
 from urllib import urlencode
+from cStringIO import StringIO
+from email.generator import Generator
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from poster.streaminghttp import get_handlers
 from nxdrive.logging_config import get_logger
+from nxdrive.client.common import BUFFER_SIZE
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.client.common import safe_filename
+from nxdrive.client.operation_chain import CHAIN_OPERATION
+from nxdrive.client.operation_chain import ChainError
+from nxdrive.client.operation_registry import DEFAULT_REGISTRY_CACHE
+from nxdrive.client.operation_registry import OperationRegistry
+from nxdrive.client.response_cache import DEFAULT_RESPONSE_CACHE
+from nxdrive.client.single_flight import DEFAULT_SINGLE_FLIGHT
+from nxdrive.client.streaming import DURABILITY_NONE
+from nxdrive.client.streaming import get_buffer_size
+from nxdrive.client.streaming import iter_file
+from nxdrive.client.timeouts import DEFAULT_LINK_STATS
+from nxdrive.client.timeouts import MIN_BLOB_TIMEOUT
+from nxdrive.client.timeouts import ReadWatchdog
+from nxdrive.client.transport import DEFAULT_TRANSPORT
+from nxdrive.client.transport import Request
+from nxdrive.client.transport import chain
+from nxdrive.client.transport import completed_future
 from nxdrive.utils import force_decode
 from urllib2 import ProxyHandler
 from urlparse import urlparse
@@ -32,7 +54,114 @@ DEVICE_DESCRIPTIONS = {
     'win32': 'Windows Desktop',
 }
 
-DEFAULT_STREAMING_BUFFER_SIZE = 4096
+
+# Content encodings of the JSON responses supported by the client
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# JSON requests bigger than this are compressed if request compression is
+# enabled
+REQUEST_COMPRESSION_MIN_SIZE = 16 * 1024
+
+
+# Files smaller than this are always uploaded as is
+UPLOAD_COMPRESSION_MIN_SIZE = 64 * 1024
+
+# Size of the beginning of a file compressed to estimate its compression
+# ratio, the file is uploaded as is if the compressed sample is bigger than
+# MAX_UPLOAD_COMPRESSION_RATIO times the sample
+UPLOAD_COMPRESSION_SAMPLE_SIZE = 1024 ** 2
+MAX_UPLOAD_COMPRESSION_RATIO = 0.8
+
+# Fastest zlib level: about 7 times faster than the default level for a
+# slightly worse ratio, the compression should not slow down the uploads
+UPLOAD_COMPRESSION_LEVEL = 1
+
+# Compressible MIME types, e.g. for the upload_compression_types option
+COMPRESSIBLE_MIME_TYPES = (
+    'text/*',
+    'application/json',
+    'application/xml',
+    'application/javascript',
+    'application/x-sql',
+)
+
+
+# Value of the X-NXDocumentProperties header to get all the document schemas
+ALL_DOCUMENT_SCHEMAS = '*'
+
+
+def gzip_compress(data):
+    """Compress data in the gzip format"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _DeflateDecompressor(object):
+    """Decompressor of the HTTP deflate content encoding
+
+    The content is supposed to be in the zlib format but some servers send
+    raw deflate data.
+    """
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, data):
+        if not self._started:
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+def get_decompressor(content_encoding):
+    """Return a decompressor for a response content encoding, or None"""
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        return _DeflateDecompressor()
+    return None
+
+
+def read_body(response, buffer_size=BUFFER_SIZE):
+    """Read the body of a response, decoding its content encoding
+
+    A compressed body is decompressed by chunks as it is received.
+    """
+    decompressor = get_decompressor(response.info().get('Content-Encoding'))
+    if decompressor is None:
+        return response.read()
+    chunks = []
+    while True:
+        data = response.read(buffer_size)
+        if not data:
+            break
+        chunks.append(decompressor.decompress(data))
+    chunks.append(decompressor.flush())
+    return ''.join(chunks)
+
+
+def decode_body(info, data):
+    """Decode the content encoding of a body received at once"""
+    decompressor = get_decompressor(info.get('Content-Encoding'))
+    if decompressor is None:
+        return data
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def _part_to_string(part):
+    """Serialize a MIME part without altering its binary payload"""
+    out = StringIO()
+    # Do not escape the lines starting with 'From '
+    Generator(out, mangle_from_=False).flatten(part)
+    return out.getvalue()
 
 
 def get_proxies_for_handler(proxy_settings):
@@ -99,11 +228,17 @@ class Unauthorized(Exception):
 class BaseAutomationClient(object):
     """Client for the Nuxeo Content Automation HTTP API
 
-    timeout is a short timeout to avoid having calls to fast JSON operations
-    to block and freeze the application in case of network issues.
+    timeout is the minimum timeout of the calls to the JSON operations, to
+    avoid having them block and freeze the application in case of network
+    issues. It is raised according to the latency of the server and to the
+    expected size of the responses, estimated by link_stats, a
+    nxdrive.client.timeouts.LinkStats instance shared by all the clients of
+    the process by default.
 
-    blob_timeout is long (or infinite) timeout dedicated to long HTTP
-    requests involving a blob transfer.
+    blob_timeout is a fixed timeout dedicated to long HTTP requests
+    involving a blob transfer. If None, it is derived from the latency of
+    the server, and the streamed transfers are aborted when they stall or
+    last much longer than expected at the estimated throughput.
 
     Supports HTTP proxies.
     If proxies is given, it must be a dictionary mapping protocol names to
@@ -115,6 +250,43 @@ class BaseAutomationClient(object):
     and in a Mac OS X environment proxy information is retrieved from the
     OS X System Configuration Framework.
     To disable autodetected proxy pass an empty dictionary.
+
+    If throttle is given, it must be a nxdrive.client.throttling.Throttle
+    instance used to limit the upload and download bandwidth and the rate of
+    Automation requests. It can be shared by several clients.
+
+    durability is the policy used to make the downloaded files durable, see
+    the DURABILITY_* constants of nxdrive.client.streaming.
+
+    The JSON responses can be compressed by the server. If compress_requests
+    is True, the JSON requests bigger than REQUEST_COMPRESSION_MIN_SIZE are
+    gzip compressed too: the server has to support it.
+
+    The operation registry of the server is cached by registry_cache, a
+    nxdrive.client.operation_registry.RegistryCache instance, and revalidated
+    when creating the client, or reused for a while if the server sends no
+    validator. The cache is shared by all the clients of
+    the process by default.
+
+    Identical concurrent read requests of the clients sharing the
+    single_flight nxdrive.client.single_flight.SingleFlight instance (all
+    the clients of the process by default) are sent only once, see
+    execute_read. The results of the conditional_operations are kept in
+    response_cache, a nxdrive.client.response_cache.ResponseCache instance,
+    and only sent again by the server when they have changed.
+
+    upload_compression_types is a list of MIME type patterns, such as
+    COMPRESSIBLE_MIME_TYPES, of the files to upload gzip compressed. The
+    server has to support gzip encoded batch uploads. Files that do not
+    compress well are uploaded as is. The number of bytes saved by the
+    compression is counted in upload_bytes_saved.
+
+    The *_async methods return a nxdrive.client.transport.Future instead of
+    blocking: their requests are sent by the event loop of transport, a
+    nxdrive.client.transport.EventLoopTransport instance shared by all the
+    clients of the process by default, along with many others. They fall
+    back on the synchronous calls when the transport cannot be used, see
+    can_use_transport.
     """
     # TODO: handle system proxy detection under Linux,
     # see https://jira.nuxeo.com/browse/NXP-12068
@@ -127,14 +299,32 @@ class BaseAutomationClient(object):
 
     permission = 'ReadWrite'
 
+    # Schemas of the documents returned by operation id, all of them for the
+    # other operations
+    document_schemas = {}
+
+    # Operations read by execute_read with conditional requests
+    conditional_operations = frozenset()
+
+    # Minimum socket timeout of the blob transfers without blob_timeout
+    min_blob_timeout = MIN_BLOB_TIMEOUT
+
     def __init__(self, server_url, user_id, device_id, client_version,
                  proxies=None, proxy_exceptions=None,
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
                  timeout=20, blob_timeout=None, cookie_jar=None,
-                 upload_tmp_dir=None):
+                 upload_tmp_dir=None, throttle=None,
+                 durability=DURABILITY_NONE, compress_requests=False,
+                 upload_compression_types=(), registry_cache=None,
+                 single_flight=None, response_cache=None, link_stats=None,
+                 transport=None):
         self.timeout = timeout
         self.blob_timeout = blob_timeout
+        self.link_stats = (link_stats if link_stats is not None
+                           else DEFAULT_LINK_STATS)
+        self.transport = (transport if transport is not None
+                          else DEFAULT_TRANSPORT)
         if ignored_prefixes is not None:
             self.ignored_prefixes = ignored_prefixes
         else:
@@ -161,6 +351,17 @@ class BaseAutomationClient(object):
         self._update_auth(password=password, token=token)
 
         self.cookie_jar = cookie_jar
+        self.throttle = throttle
+        self.durability = durability
+        self.compress_requests = compress_requests
+        self.upload_compression_types = upload_compression_types
+        self.upload_bytes_saved = 0
+        self.registry_cache = (registry_cache if registry_cache is not None
+                               else DEFAULT_REGISTRY_CACHE)
+        self.single_flight = (single_flight if single_flight is not None
+                              else DEFAULT_SINGLE_FLIGHT)
+        self.response_cache = (response_cache if response_cache is not None
+                               else DEFAULT_RESPONSE_CACHE)
         cookie_processor = urllib2.HTTPCookieProcessor(
             cookiejar=cookie_jar)
 
@@ -192,21 +393,76 @@ class BaseAutomationClient(object):
         """Make next calls to server raise the provided exception"""
         self._error = error
 
+    def set_throttle(self, throttle):
+        """Use the provided throttle to limit the next requests"""
+        self.throttle = throttle
+
+    def get_timeout(self, size=0, upload=False):
+        """Return the timeout of a JSON request transferring size bytes"""
+        return self.link_stats.get_timeout(self.server_url, size=size,
+                                           upload=upload,
+                                           min_timeout=self.timeout)
+
+    def get_blob_timeout(self):
+        """Return the socket timeout of a blob transfer"""
+        if self.blob_timeout is not None:
+            return self.blob_timeout
+        return self.link_stats.get_timeout(
+            self.server_url,
+            min_timeout=max(self.timeout, self.min_blob_timeout))
+
+    def get_watchdog(self, size=None, upload=False):
+        """Return the watchdog of a blob transfer of size bytes"""
+        if self.blob_timeout is not None:
+            # Fixed timeout of the socket operations
+            return ReadWatchdog(None)
+        idle_timeout = self.get_blob_timeout()
+        deadline = None
+        if size is not None:
+            deadline = time.time() + self.link_stats.get_timeout(
+                self.server_url, size=size, upload=upload,
+                min_timeout=idle_timeout)
+        return ReadWatchdog(idle_timeout, deadline=deadline)
+
     def fetch_api(self):
         base_error_message = (
             "Failed to connect to Nuxeo server %s"
         ) % (self.server_url)
         url = self.automation_url
         headers = self._get_common_headers()
+        headers['Accept-Encoding'] = ACCEPT_ENCODING
+        cached = self.registry_cache.get_fresh(url)
+        if cached is not None:
+            # Recently downloaded registry that cannot be revalidated
+            log.trace("Reusing the operation registry of %s", url)
+            self._registry = cached
+            self.operations = cached.operations
+            return
+        cached = self.registry_cache.get(url)
+        if cached is not None:
+            # Conditional request: the registry is not sent again if it has
+            # not changed
+            if cached.etag is not None:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified is not None:
+                headers['If-Modified-Since'] = cached.last_modified
         cookies = self._get_cookies()
         log.trace("Calling %s with headers %r and cookies %r",
             url, headers, cookies)
         req = urllib2.Request(url, headers=headers)
         try:
-            response = json.loads(self.opener.open(
-                req, timeout=self.timeout).read())
+            response = self.opener.open(req, timeout=self.get_timeout())
+            info = response.info()
+            registry = OperationRegistry(
+                json.loads(read_body(response))["operations"],
+                etag=info.get('ETag'),
+                last_modified=info.get('Last-Modified'))
+            self.registry_cache.put(url, registry)
         except urllib2.HTTPError as e:
-            if e.code == 401 or e.code == 403:
+            if e.code == 304 and cached is not None:
+                log.trace("Operation registry of %s has not changed", url)
+                registry = cached
+            elif e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
             else:
                 msg = base_error_message + "\nHTTP error %d" % e.code
@@ -238,31 +494,97 @@ class BaseAutomationClient(object):
                 msg = msg + ": " + e.msg
             e.msg = msg
             raise e
-        self.operations = {}
-        for operation in response["operations"]:
-            self.operations[operation['id']] = operation
+        self._registry = registry
+        self.operations = registry.operations
 
     def execute(self, command, op_input=None, timeout=-1,
-                check_params=True, void_op=False, **params):
-        """Execute an Automation operation"""
+                check_params=True, void_op=False, raw_response=False,
+                schemas=None, extra_headers=None, record_latency=True,
+                **params):
+        """Execute an Automation operation
+
+        If raw_response is True, return the urllib2 response to be read (and
+        closed) by the caller, e.g. to stream a blob result.
+
+        record_latency is False for the operations that do not reply right
+        away, e.g. long polls, so as not to skew the latency estimate.
+
+        schemas is the comma separated list of the schemas of the documents
+        returned by the operation, defaults to the ones of the operation in
+        document_schemas.
+
+        extra_headers are added to the HTTP request headers.
+        """
         if self._error is not None:
             # Simulate a configurable (e.g. network or server) error for the
             # tests
             raise self._error
         if check_params:
             self._check_params(command, params)
+        url, headers, data = self._get_operation_request(
+            command, op_input, params, schemas=schemas, void_op=void_op,
+            raw_response=raw_response, extra_headers=extra_headers)
+
+        cookies = self._get_cookies()
+        log.trace("Calling %s with headers %r, cookies %r"
+                  " and JSON payload %r",
+            url, headers, cookies,  data)
+        req = urllib2.Request(url, data, headers)
+        if timeout == -1:
+            timeout = self._get_operation_timeout(command, data)
+        self._throttle_request()
+        start = time.time()
+        try:
+            resp = self.opener.open(req, timeout=timeout)
+        except Exception as e:
+            self._log_details(e)
+            raise
+        if record_latency:
+            self.link_stats.record_latency(self.server_url,
+                                           time.time() - start)
+
+        if raw_response:
+            return resp
+        result, size = self._read_response(resp, url, return_size=True)
+        self.link_stats.record_response_size(self.server_url, command, size)
+        return result
+
+    def _get_operation_request(self, command, op_input, params, schemas=None,
+                               void_op=False, raw_response=False,
+                               extra_headers=None):
+        """Return the URL, headers and JSON body of an operation call"""
+        if schemas is None:
+            schemas = self.document_schemas.get(command,
+                                                ALL_DOCUMENT_SCHEMAS)
 
         url = self.automation_url + command
         headers = {
             "Content-Type": "application/json+nxrequest",
             "Accept": "application/json+nxentity, */*",
-            "X-NXDocumentProperties": "*",
+            "X-NXDocumentProperties": schemas,
         }
         if void_op:
             headers.update({"X-NXVoidOperation": "true"})
+        if not raw_response:
+            # Blob results are streamed as they are
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
         headers.update(self._get_common_headers())
+        if extra_headers is not None:
+            headers.update(extra_headers)
 
-        json_struct = {'params': {}}
+        json_struct = {'params': self._get_json_params(params)}
+        if op_input:
+            json_struct['input'] = op_input
+        log.trace("Dumping JSON structure: %s", json_struct)
+        data = json.dumps(json_struct)
+        if (self.compress_requests
+            and len(data) >= REQUEST_COMPRESSION_MIN_SIZE):
+            data = gzip_compress(data)
+            headers["Content-Encoding"] = "gzip"
+        return url, headers, data
+
+    def _get_json_params(self, params):
+        json_params = {}
         for k, v in params.items():
             if v is None:
                 continue
@@ -270,33 +592,192 @@ class BaseAutomationClient(object):
                 s = ""
                 for propname, propvalue in v.items():
                     s += "%s=%s\n" % (propname, propvalue)
-                json_struct['params'][k] = s.strip()
+                json_params[k] = s.strip()
             else:
-                json_struct['params'][k] = v
-        if op_input:
-            json_struct['input'] = op_input
-        log.trace("Dumping JSON structure: %s", json_struct)
-        data = json.dumps(json_struct)
+                json_params[k] = v
+        return json_params
+
+    def _get_operation_timeout(self, command, data):
+        # Large listings take longer to be sent
+        return self.get_timeout(
+            size=len(data) + self.link_stats.get_response_size(
+                self.server_url, command))
+
+    def can_use_transport(self):
+        """Tell whether the event loop transport can send the requests"""
+        return not self.is_proxy and self._error is None
+
+    def execute_async(self, command, op_input=None, check_params=True,
+                      void_op=False, schemas=None, idempotent=False,
+                      **params):
+        """Execute an Automation operation with the event loop transport
+
+        Return the Future of the result. Only the idempotent operations, the
+        ones without side effect, are sent again after a connection failure.
+        """
+        if not self.can_use_transport():
+            return completed_future(self.execute, command, op_input=op_input,
+                                    check_params=check_params,
+                                    void_op=void_op, schemas=schemas,
+                                    **params)
+        if check_params:
+            self._check_params(command, params)
+        return chain(
+            self._submit_operation(command, op_input, params, schemas=schemas,
+                                   void_op=void_op, idempotent=idempotent),
+            lambda response: self._get_operation_result(command, response))
 
-        cookies = self._get_cookies()
-        log.trace("Calling %s with headers %r, cookies %r"
-                  " and JSON payload %r",
-            url, headers, cookies,  data)
-        req = urllib2.Request(url, data, headers)
-        timeout = self.timeout if timeout == -1 else timeout
+    def execute_read_async(self, command, **params):
+        """Asynchronous execute_read
+
+        The identical calls in flight are not coalesced, the results of the
+        conditional_operations are revalidated as with execute_read.
+        """
+        if (not self.can_use_transport()
+            or command not in self.conditional_operations):
+            return self.execute_async(command, idempotent=True, **params)
+        self._check_params(command, params)
+        key = (self.automation_url, self.user_id, command,
+               tuple(sorted(params.items())))
+        cached = self.response_cache.get(key)
+        extra_headers = None
+        if cached is not None:
+            extra_headers = {'If-None-Match': cached[0]}
+
+        def on_response(response):
+            if response.status == 304:
+                log.trace("Reusing the cached result of %s%r", command,
+                          params)
+                self.response_cache.hit()
+                return cached[1]
+            result = self._get_operation_result(command, response)
+            etag = response.headers.get('ETag')
+            if etag is not None:
+                self.response_cache.put(key, etag, result)
+            else:
+                self.response_cache.discard(key)
+            return result
+
+        future = self._submit_operation(command, None, params,
+                                        extra_headers=extra_headers,
+                                        not_modified=cached is not None,
+                                        idempotent=True)
+        return chain(future, on_response)
+
+    def _submit_operation(self, command, op_input, params, schemas=None,
+                          void_op=False, extra_headers=None,
+                          not_modified=False, idempotent=False):
+        url, headers, data = self._get_operation_request(
+            command, op_input, params, schemas=schemas, void_op=void_op,
+            extra_headers=extra_headers)
+        log.trace("Submitting %s with headers %r and JSON payload %r", url,
+                  headers, data)
+        self._throttle_request()
+        return self.submit(url, method='POST', headers=headers, body=data,
+                           timeout=self._get_operation_timeout(command, data),
+                           not_modified=not_modified, idempotent=idempotent)
+
+    def _get_operation_result(self, command, response):
+        body = decode_body(response.headers, response.body)
+        self.link_stats.record_response_size(self.server_url, command,
+                                             len(body))
+        return self._parse_body(response.headers, body, response.url)
+
+    def submit(self, url, method='GET', headers=None, body=None,
+               timeout=None, sink_factory=None, not_modified=False,
+               idempotent=None):
+        """Send a request with the event loop transport
+
+        Return the Future of the nxdrive.client.transport.Response. Fails
+        with urllib2.HTTPError for the error status codes, and for 304 Not
+        Modified unless not_modified is True. See
+        nxdrive.client.transport.Request for idempotent.
+        """
+        headers = dict(headers or {})
+        if self.cookie_jar is not None:
+            cookie_request = urllib2.Request(url)
+            self.cookie_jar.add_cookie_header(cookie_request)
+            headers.update(cookie_request.unredirected_hdrs)
+        request = Request(url, method=method, headers=headers, body=body,
+                          timeout=timeout, sink_factory=sink_factory,
+                          idempotent=idempotent)
+
+        def on_response(response):
+            self.link_stats.record_latency(self.server_url, response.latency)
+            if self.cookie_jar is not None:
+                self.cookie_jar.extract_cookies(response,
+                                                urllib2.Request(url))
+            if response.status < 300 or (response.status == 304
+                                         and not_modified):
+                return response
+            error = urllib2.HTTPError(url, response.status, response.reason,
+                                      response.headers,
+                                      StringIO(response.body or ''))
+            if response.status != 304:
+                self._log_details(error)
+                error.fp.seek(0)
+            raise error
+
+        return chain(self.transport.submit(request), on_response)
+
+    def execute_read(self, command, **params):
+        """Execute an operation without side effect, without input
+
+        The result is shared with the identical calls made at the same time
+        by the other threads, with the same credentials, and must not be
+        modified.
+        """
+        key = (self.automation_url, self.user_id, command,
+               tuple(sorted(params.items())))
+        if command in self.conditional_operations:
+            return self.single_flight.do(key, self._execute_conditional,
+                                         key, command, **params)
+        return self.single_flight.do(key, self.execute, command, **params)
+
+    def _execute_conditional(self, key, command, **params):
+        """Execute an operation, reusing its cached result if not modified"""
+        cached = self.response_cache.get(key)
+        # Compressed JSON result read with _read_response
+        extra_headers = {'Accept-Encoding': ACCEPT_ENCODING}
+        if cached is not None:
+            extra_headers['If-None-Match'] = cached[0]
         try:
-            resp = self.opener.open(req, timeout=timeout)
-        except Exception as e:
-            self._log_details(e)
+            response = self.execute(command, raw_response=True,
+                                    extra_headers=extra_headers, **params)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                log.trace("Reusing the cached result of %s%r", command,
+                          params)
+                self.response_cache.hit()
+                return cached[1]
             raise
-
-        return self._read_response(resp, url)
+        try:
+            result = self._read_response(response,
+                                         self.automation_url + command)
+        finally:
+            response.close()
+        etag = response.info().get('ETag')
+        if etag is not None:
+            self.response_cache.put(key, etag, result)
+        else:
+            self.response_cache.discard(key)
+        return result
 
     def execute_with_blob(self, command, blob_content, filename, **params):
         """Execute an Automation operation with a blob input
 
         Beware that the whole content is loaded in memory when calling this.
         """
+        return self.execute_with_blobs(command, [(blob_content, filename)],
+                                       **params)
+
+    def execute_with_blobs(self, command, blobs, **params):
+        """Execute an Automation operation with a blob list input
+
+        blobs is a list of (content, filename) tuples sent in a single
+        request. Beware that all the contents are loaded in memory when
+        calling this.
+        """
         self._check_params(command, params)
         url = self.automation_url.encode('ascii') + command
 
@@ -323,70 +804,79 @@ class BaseAutomationClient(object):
         json_part.set_payload(json_data)
         container.attach(json_part)
 
-        ctype, _ = mimetypes.guess_type(filename)
-        if ctype:
-            maintype, subtype = ctype.split('/', 1)
-        else:
-            maintype, subtype = "application", "octet-stream"
-        blob_part = MIMEBase(maintype, subtype)
-        blob_part.add_header("Content-ID", "input")
-        blob_part.add_header("Content-Transfer-Encoding", "binary")
-
-        # Quote UTF-8 filenames even though JAX-RS does not seem to be able
-        # to retrieve them as per: https://tools.ietf.org/html/rfc5987
-        filename = safe_filename(filename)
-        quoted_filename = urllib2.quote(filename.encode('utf-8'))
-        content_disposition = ("attachment; filename*=UTF-8''%s"
-                                % quoted_filename)
-        blob_part.add_header("Content-Disposition", content_disposition)
-        blob_part.set_payload(blob_content)
-        container.attach(blob_part)
-
-        data = (
-            "--%s\r\n"
-            "%s\r\n"
-            "--%s\r\n"
-            "%s\r\n"
-            "--%s--"
-        ) % (
-            boundary,
-            json_part.as_string(),
-            boundary,
-            blob_part.as_string(),
-            boundary,
-        )
+        parts = [json_part]
+        for i, (blob_content, filename) in enumerate(blobs):
+            ctype, _ = mimetypes.guess_type(filename)
+            if ctype:
+                maintype, subtype = ctype.split('/', 1)
+            else:
+                maintype, subtype = "application", "octet-stream"
+            blob_part = MIMEBase(maintype, subtype)
+            # Several input parts make a blob list input
+            blob_part.add_header("Content-ID",
+                                 "input" if i == 0 else "input%d" % i)
+            blob_part.add_header("Content-Transfer-Encoding", "binary")
+
+            # Quote UTF-8 filenames even though JAX-RS does not seem to be
+            # able to retrieve them as per: https://tools.ietf.org/html/rfc5987
+            filename = safe_filename(filename)
+            quoted_filename = urllib2.quote(filename.encode('utf-8'))
+            content_disposition = ("attachment; filename*=UTF-8''%s"
+                                    % quoted_filename)
+            blob_part.add_header("Content-Disposition", content_disposition)
+            blob_part.set_payload(blob_content)
+            container.attach(blob_part)
+            parts.append(blob_part)
+
+        data = ''.join("--%s\r\n%s\r\n" % (boundary, _part_to_string(part))
+                       for part in parts) + "--%s--" % boundary
 
         cookies = self._get_cookies()
-        log.trace("Calling %s with headers %r and cookies %r for file %s",
-            url, headers, cookies, filename)
+        log.trace("Calling %s with headers %r and cookies %r for files %s",
+            url, headers, cookies, [filename for _, filename in blobs])
         req = urllib2.Request(url, data, headers)
+        self._throttle_request()
+        if self.throttle is not None:
+            self.throttle.upload(len(data))
+        start = time.time()
         try:
-            resp = self.opener.open(req, timeout=self.blob_timeout)
+            resp = self.opener.open(req, timeout=self.get_blob_timeout())
         except Exception as e:
             self._log_details(e)
             raise
+        self.link_stats.record_transfer(self.server_url, len(data),
+                                        time.time() - start, upload=True)
 
         return self._read_response(resp, url)
 
     def execute_with_blob_streaming(self, command, file_path, filename=None,
-                                    **params):
+                                    digester=None, **params):
         """Execute an Automation operation using a batch upload as an input
 
-        Upload is streamed.
+        Upload is streamed. If a hashlib digester is provided, it is updated
+        with the uploaded bytes.
         """
         batch_id = self._generate_unique_id()
-        upload_result = self.upload(batch_id, file_path, filename=filename)
+        upload_result = self.upload(batch_id, file_path, filename=filename,
+                                    digester=digester)
         if upload_result['uploaded'] == 'true':
             return self.execute_batch(command, batch_id, '0', **params)
         else:
             raise ValueError("Bad response from batch upload with id '%s'"
                              " and file path '%s'" % (batch_id, file_path))
 
-    def upload(self, batch_id, file_path, filename=None, file_index=0):
+    def upload(self, batch_id, file_path, filename=None, file_index=0,
+               digester=None):
         """Upload a file through an Automation batch
 
         Uses poster.httpstreaming to stream the upload
         and not load the whole file in memory.
+
+        If a hashlib digester is provided, it is updated with the uploaded
+        bytes to compute the digest of the file without reading it again.
+
+        The file is gzip compressed to a tmp file before being uploaded if
+        its MIME type matches upload_compression_types and if it is worth it.
         """
         # Request URL
         url = self.automation_url.encode('ascii') + self.batch_upload_url
@@ -415,38 +905,159 @@ class BaseAutomationClient(object):
         }
         headers.update(self._get_common_headers())
 
-        # Request data
-        input_file = open(file_path, 'rb')
-        # Use file system block size if available for streaming buffer
-        if sys.platform != 'win32':
-            fs_block_size = os.fstatvfs(input_file.fileno()).f_bsize
-        else:
-            fs_block_size = DEFAULT_STREAMING_BUFFER_SIZE
-        log.trace("Using file system block size"
-                  " for the streaming upload buffer: %u bytes", fs_block_size)
-        data = self._read_data(input_file, fs_block_size)
+        compressed_path = self._compress_upload(file_path, file_size,
+                                                mime_type, digester=digester)
+        if compressed_path is not None:
+            # The digester has been fed with the original content
+            digester = None
+            compressed_size = os.path.getsize(compressed_path)
+            headers["Content-Encoding"] = "gzip"
+            headers["Content-Length"] = compressed_size
+
+        # Request data: unbuffered file to read the content in place in the
+        # streaming buffer
+        input_file = io.open(compressed_path or file_path, 'rb', buffering=0)
+        # Use a multiple of the file system block size for streaming buffer
+        buffer_size = get_buffer_size(input_file)
+        log.trace("Using a %u bytes streaming upload buffer", buffer_size)
+        watchdog = self.get_watchdog(size=headers["Content-Length"],
+                                     upload=True)
+        data = self._read_data(input_file, buffer_size, digester=digester,
+                               watchdog=watchdog)
 
         # Execute request
         cookies = self._get_cookies()
         log.trace("Calling %s with headers %r and cookies %r for file %s",
             url, headers, cookies, file_path)
         req = urllib2.Request(url, data, headers)
+        self._throttle_request()
         try:
-            resp = self.streaming_opener.open(req, timeout=self.blob_timeout)
+            resp = self.streaming_opener.open(req,
+                                              timeout=self.get_blob_timeout())
         except Exception as e:
             self._log_details(e)
             raise
         finally:
             input_file.close()
-
+            # Partial uploads are measured too, for the retries to be given
+            # more time on a slow link
+            self.link_stats.record_transfer(self.server_url,
+                                            watchdog.n_bytes,
+                                            watchdog.get_duration(),
+                                            upload=True)
+            if compressed_path is not None:
+                os.remove(compressed_path)
+
+        if compressed_path is not None:
+            self.upload_bytes_saved += file_size - compressed_size
+            log.info("Uploaded '%s' compressed from %d to %d bytes (%d bytes"
+                     " saved in total)", file_path, file_size,
+                     compressed_size, self.upload_bytes_saved)
         return self._read_response(resp, url)
 
+    def _compress_upload(self, file_path, file_size, mime_type,
+                         digester=None):
+        """Compress a file to upload to a tmp file if it is worth it
+
+        Return the path of the gzip compressed tmp file, or None if the file
+        is to be uploaded as is. In the first case the digester is fed with
+        the original content.
+        """
+        if (file_size < UPLOAD_COMPRESSION_MIN_SIZE
+            or not any(fnmatch(mime_type, pattern)
+                       for pattern in self.upload_compression_types)):
+            return None
+        with io.open(file_path, 'rb', buffering=0) as f:
+            sample = f.read(UPLOAD_COMPRESSION_SAMPLE_SIZE)
+        ratio = (len(zlib.compress(sample, UPLOAD_COMPRESSION_LEVEL))
+                 / float(max(len(sample), 1)))
+        if ratio > MAX_UPLOAD_COMPRESSION_RATIO:
+            log.debug("Uploading '%s' as is: compression ratio of %.2f",
+                      file_path, ratio)
+            return None
+        fd, compressed_path = tempfile.mkstemp(
+            suffix=u'-nxdrive-compressed-upload', dir=self.upload_tmp_dir)
+        compressor = zlib.compressobj(UPLOAD_COMPRESSION_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        try:
+            with io.open(fd, 'wb') as out:
+                with io.open(file_path, 'rb', buffering=0) as f:
+                    for chunk in iter_file(f, get_buffer_size(f)):
+                        if digester is not None:
+                            digester.update(chunk)
+                        # zlib does not support memoryview
+                        out.write(compressor.compress(chunk.tobytes()))
+                out.write(compressor.flush())
+        except:
+            os.remove(compressed_path)
+            raise
+        return compressed_path
+
     def execute_batch(self, op_id, batch_id, file_idx, **params):
         """Execute a file upload Automation batch"""
         return self.execute(self.batch_execute_url,
                      operationId=op_id, batchId=batch_id, fileIdx=file_idx,
                      check_params=False, **params)
 
+    def is_chaining_supported(self):
+        return CHAIN_OPERATION in self.operations
+
+    def execute_chain(self, operations, batch_id=None):
+        """Execute a chain of operations, see nxdrive.client.operation_chain
+
+        operations is a list of ChainedOperation instances. Return the
+        results of the calls that were run: the chain stops after a guard
+        call returning false. Raise ChainError if a call fails.
+
+        If batch_id is given, the blob of the batch upload is the input of
+        the calls without op_input.
+
+        The calls are sent in a single request if the server supports it,
+        one by one otherwise.
+        """
+        for operation in operations:
+            params = dict(operation.params)
+            params.update(dict.fromkeys(operation.refs, ''))
+            self._check_params(operation.command, params)
+        if not self.is_chaining_supported():
+            return self._execute_chain_sequentially(operations, batch_id)
+        data = json.dumps([
+            operation.to_json(self._get_json_params(operation.params))
+            for operation in operations])
+        if batch_id is not None:
+            outcomes = self.execute_batch(CHAIN_OPERATION, batch_id, '0',
+                                          operations=data)
+        else:
+            outcomes = self.execute(CHAIN_OPERATION, operations=data)
+        results = []
+        for index, outcome in enumerate(outcomes):
+            error = outcome.get('error')
+            if error is not None:
+                raise ChainError(index, operations[index].command, results,
+                                 error.get('status'), error.get('message'))
+            results.append(outcome.get('result'))
+        return results
+
+    def _execute_chain_sequentially(self, operations, batch_id):
+        results = []
+        for index, operation in enumerate(operations):
+            params = operation.resolve_params(results)
+            try:
+                if operation.op_input is None and batch_id is not None:
+                    result = self.execute_batch(operation.command, batch_id,
+                                                '0', **params)
+                else:
+                    result = self.execute(operation.command,
+                                          op_input=operation.op_input,
+                                          check_params=False, **params)
+            except urllib2.HTTPError as e:
+                raise ChainError(index, operation.command, results, e.code,
+                                 e.msg)
+            results.append(result)
+            if operation.guard and not result:
+                break
+        return results
+
     def is_addon_installed(self):
         return 'NuxeoDrive.GetRoots' in self.operations
 
@@ -475,7 +1086,7 @@ class BaseAutomationClient(object):
                 url, headers, cookies)
         req = urllib2.Request(url, headers=headers)
         try:
-            token = self.opener.open(req, timeout=self.timeout).read()
+            token = self.opener.open(req, timeout=self.get_timeout()).read()
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
@@ -545,33 +1156,21 @@ class BaseAutomationClient(object):
         return list(self.cookie_jar) if self.cookie_jar is not None else []
 
     def _check_params(self, command, params):
-        if command not in self.operations:
-            raise ValueError("'%s' is not a registered operations." % command)
-        method = self.operations[command]
-        required_params = []
-        other_params = []
-        for param in method['params']:
-            if param['required']:
-                required_params.append(param['name'])
-            else:
-                other_params.append(param['name'])
-
-        for param in params.keys():
-            if (not param in required_params
-                and not param in other_params):
-                raise ValueError("Unexpected param '%s' for operation '%s"
-                                 % (param, command))
-        for param in required_params:
-            if not param in params:
-                raise ValueError(
-                    "Missing required param '%s' for operation '%s'" % (
-                        param, command))
-
+        self._registry.check_params(command, params)
         # TODO: add typechecking
 
-    def _read_response(self, response, url):
-        info = response.info()
-        s = response.read()
+    def _read_response(self, response, url, return_size=False):
+        """Return the decoded response body
+
+        If return_size is True, return a (result, body_size) tuple.
+        """
+        s = read_body(response)
+        result = self._parse_body(response.info(), s, url)
+        if return_size:
+            return result, len(s)
+        return result
+
+    def _parse_body(self, info, s, url):
         content_type = info.get('content-type', '')
         cookies = self._get_cookies()
         if content_type.startswith("application/json"):
@@ -585,7 +1184,10 @@ class BaseAutomationClient(object):
 
     def _log_details(self, e):
         if hasattr(e, "fp"):
-            detail = e.fp.read()
+            try:
+                detail = read_body(e)
+            except zlib.error:
+                detail = "Could not decompress the error response"
             try:
                 exc = json.loads(detail)
                 log.debug(exc['message'])
@@ -600,9 +1202,22 @@ class BaseAutomationClient(object):
 
         return str(time.time()) + '_' + str(random.randint(0, 1000000000))
 
-    def _read_data(self, file_object, buffer_size):
-        while True:
-            r = file_object.read(buffer_size)
-            if not r:
-                break
-            yield r
+    def _throttle_request(self):
+        if self.throttle is not None:
+            self.throttle.request()
+
+    def _read_data(self, file_object, buffer_size, digester=None,
+                   watchdog=None):
+        for chunk in iter_file(file_object, buffer_size):
+            if watchdog is not None:
+                # Time since the previous chunk was handed over
+                watchdog.update(len(chunk))
+            if digester is not None:
+                digester.update(chunk)
+            if self.throttle is not None:
+                # Wait for the upload bandwidth to be available before
+                # handing over the chunk to the socket
+                delay = self.throttle.upload(len(chunk))
+                if watchdog is not None:
+                    watchdog.pause(delay)
+            yield chunk
@@ -0,0 +1,142 @@
+"""Notifications of the remote changes by long polling.
+
+When the server provides the WAIT_FOR_CHANGES_OPERATION, a ChangeNotifier
+thread keeps a request pending with the state of the last change summary
+fetched by the synchronizer: its lastSyncDate and
+lastSyncActiveRootDefinitions parameters. The server replies
+{"hasChanges": true} as soon as a change affects one of the
+synchronization roots of the user, or {"hasChanges": false} after maxWait
+seconds without change. A change wakes the synchronization loop up, which
+then fetches the change summary as usual.
+
+The polling of the change summary stays as a fallback: at the regular
+delay while the notifications are not available (unsupported operation,
+network or server errors), at a much longer delay while they are.
+"""
+
+from threading import Condition
+from threading import Thread
+from nxdrive.client.retry import NOTIFICATION_OPERATIONS
+from nxdrive.client.retry import get_retry_policy
+from nxdrive.client.retry import get_retry_after
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Long poll operation of the remote changes
+WAIT_FOR_CHANGES_OPERATION = 'NuxeoDrive.WaitForChanges'
+
+# Maximum time in seconds the server holds a request without change: below
+# the idle timeout of the usual proxies and load balancers
+DEFAULT_MAX_WAIT = 50
+
+# Retry policy of the failed long poll requests
+NOTIFIER_RETRY_POLICY = get_retry_policy(NOTIFICATION_OPERATIONS)
+
+
+class ChangeNotifier(object):
+    """Long poll a server for the remote changes in a thread
+
+    get_client is called from the notifier thread to get the remote file
+    system client. on_change is called from the notifier thread when the
+    server reports changes after the cursor set by update_cursor: the
+    notifier then waits for the next update_cursor call, which tells that
+    the changes have been fetched.
+    """
+
+    def __init__(self, get_client, on_change, max_wait=DEFAULT_MAX_WAIT,
+                 retry_policy=NOTIFIER_RETRY_POLICY, name='ChangeNotifier'):
+        self._get_client = get_client
+        self._on_change = on_change
+        self.max_wait = max_wait
+        self.retry_policy = retry_policy
+        self._condition = Condition()
+        self._cursor = None
+        self._stopped = False
+        # False once the server is known not to support the notifications
+        self.supported = True
+        # True while the last long poll request succeeded
+        self.connected = False
+        # True from a change notification until the next cursor update
+        self.changes = False
+        self.failures = 0
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop the notifier, a pending request is not interrupted"""
+        with self._condition:
+            self._stopped = True
+            self.connected = False
+            self._condition.notify_all()
+
+    def is_active(self):
+        """Tell whether the changes are notified: polling can slow down"""
+        return self.supported and self.connected and not self._stopped
+
+    def has_changes(self):
+        return self.changes
+
+    def update_cursor(self, sync_date, root_definitions):
+        """Set the state of the last change summary fetched"""
+        with self._condition:
+            self._cursor = sync_date, root_definitions
+            self.changes = False
+            self._condition.notify_all()
+
+    def _run(self):
+        client = None
+        while True:
+            with self._condition:
+                # Wait for the changes to be fetched
+                while not self._stopped and (self._cursor is None
+                                             or self.changes):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                cursor = self._cursor
+            try:
+                if client is None:
+                    client = self._get_client()
+                    if not client.is_change_notification_supported():
+                        log.debug("No change notification from %s: polling"
+                                  " the changes", client.server_url)
+                        self.supported = False
+                        return
+                has_changes = client.wait_for_changes(
+                    last_sync_date=cursor[0],
+                    last_root_definitions=cursor[1],
+                    max_wait=self.max_wait)
+            except Exception as e:
+                self.connected = False
+                self.failures += 1
+                delay = self.retry_policy.get_delay(
+                    self.failures, retry_after=get_retry_after(e))
+                log.debug("Change notification request failed, retrying in"
+                          " %0.1fs: %s", delay, e)
+                # Get a new client: the credentials may have been updated
+                client = None
+                with self._condition:
+                    if not self._stopped:
+                        self._condition.wait(delay)
+                continue
+            self.failures = 0
+            with self._condition:
+                if self._stopped:
+                    return
+                # Nothing new or already fetched by a regular poll otherwise
+                notify = has_changes and self._cursor == cursor
+                # Flag the changes first: the synchronizer reads the flags
+                # without locking
+                if notify:
+                    self.changes = True
+                self.connected = True
+                if not notify:
+                    continue
+            log.debug("Remote changes notified by %s", client.server_url)
+            self._on_change()
@@ -1,11 +1,16 @@
 """Common utilities for local and remote clients."""
 
+import hashlib
 import re
 
 
 class NotFound(Exception):
     pass
 
+
+class CorruptedFile(Exception):
+    pass
+
 DEFAULT_IGNORED_PREFIXES = [
     '.',  # hidden Unix files
     '~$',  # Windows lock files
@@ -25,3 +30,11 @@ BUFFER_SIZE = 1024 ** 2
 def safe_filename(name, replacement=u'-'):
     """Replace invalid character in candidate filename"""
     return re.sub(ur'(/|\\|\*|:|\||"|<|>|\?)', replacement, name)
+
+
+def get_digester(digest_func):
+    """Return a new hashlib digester or None if the algorithm is unknown"""
+    if not digest_func:
+        return None
+    digester = getattr(hashlib, digest_func.lower(), None)
+    return digester() if digester is not None else None
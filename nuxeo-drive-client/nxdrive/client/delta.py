@@ -0,0 +1,425 @@
+"""rsync-style delta transfer of modified files.
+
+The signature of a file is made of a rolling checksum (Adler-32) and a
+second checksum (CRC-32) for each of its fixed size blocks. They are computed
+while transferring the files of at least DELTA_MIN_SIZE bytes: a block
+collision is caught by the digest of the whole file that is checked by the
+server when applying the delta. The delta of a new version of the file is
+computed against the signature of the previous one: the blocks found in the
+previous version, at any offset, are encoded as block references and
+everything else as literal bytes.
+
+Delta format: the DELTA_MAGIC header followed by a sequence of operations:
+
+- 'C' + first block index + block count (big endian uint32): copy blocks of
+  the previous version
+- 'L' + length (big endian uint32) + bytes: literal bytes
+- 'E': end of the delta
+"""
+
+import hashlib
+import os
+import shutil
+import struct
+import zlib
+from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.streaming import iter_file
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# Files smaller than this are always fully uploaded
+DELTA_MIN_SIZE = 4 * 1024 ** 2
+
+# Give up the delta when more than this ratio of the file is made of
+# literal bytes: rolling the checksum over unmatched bytes is slow
+MAX_LITERAL_RATIO = 0.5
+MIN_LITERAL_CHECK = BUFFER_SIZE
+
+DELTA_MAGIC = 'NXDELTA1'
+SIGNATURE_MAGIC = 'NXSIG001'
+
+ADLER_MOD = 65521
+
+_COPY = struct.Struct('>cII')
+_LITERAL = struct.Struct('>cI')
+_BLOCK = struct.Struct('>II')
+_SIGNATURE_HEADER = struct.Struct('>8sIQ64s')
+
+
+class DeltaTooBig(Exception):
+    """The delta would not be significantly smaller than the file"""
+
+
+class InvalidDelta(Exception):
+    pass
+
+
+def weak_checksum(data):
+    """Adler-32 checksum of a block, as an unsigned int"""
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_checksum(data):
+    """CRC-32 checksum of a block, as an unsigned int"""
+    return zlib.crc32(data) & 0xffffffff
+
+
+def roll(checksum, out_byte, in_byte, block_size):
+    """Slide the Adler-32 checksum window of one byte"""
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+class Signature(object):
+    """Block checksums of a given version of a file
+
+    digest is the digest of the whole file content, used to check that the
+    signature matches the remote version the delta is applied to.
+    """
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, size=0, digest=None,
+                 blocks=None):
+        self.block_size = block_size
+        self.size = size
+        self.digest = digest
+        self.blocks = blocks if blocks is not None else []
+        self._index = None
+
+    def __repr__(self):
+        return "Signature<digest=%s, size=%d, blocks=%d>" % (
+            self.digest, self.size, len(self.blocks))
+
+    def find_block(self, weak, data):
+        """Return the index of a block with the given content, or None"""
+        if self._index is None:
+            self._index = {}
+            for i, (block_weak, strong) in enumerate(self.blocks):
+                self._index.setdefault(block_weak, []).append((strong, i))
+        candidates = self._index.get(weak)
+        if candidates is None:
+            return None
+        strong = strong_checksum(data)
+        for block_strong, i in candidates:
+            if block_strong == strong:
+                return i
+        return None
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_SIGNATURE_HEADER.pack(SIGNATURE_MAGIC, self.block_size,
+                                           self.size, self.digest or ''))
+            f.write(''.join(_BLOCK.pack(weak, strong)
+                            for weak, strong in self.blocks))
+        # Atomic replacement of the previous signature
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, block_size, size, digest = _SIGNATURE_HEADER.unpack_from(data)
+        if magic != SIGNATURE_MAGIC:
+            raise ValueError("Invalid signature file: %s" % path)
+        offset = _SIGNATURE_HEADER.size
+        blocks = [_BLOCK.unpack_from(data, offset + i * _BLOCK.size)
+                  for i in range((len(data) - offset) // _BLOCK.size)]
+        return cls(block_size=block_size, size=size,
+                   digest=digest.rstrip('\0') or None, blocks=blocks)
+
+
+class SignatureBuilder(object):
+    """Compute the signature of a content fed by chunks
+
+    Can be used in place of a hashlib digester for the streaming transfers:
+    the chunks are also fed to the wrapped digester, used to compute the
+    digest of the signature.
+
+    The chunks are not copied nor concatenated: the checksums of the blocks
+    are computed on buffers of the chunks. The zlib functions of Python 2 do
+    not accept memoryview chunks though: their blocks, as well as the bytes
+    of a block spanning several chunks, are copied to a preallocated block
+    buffer.
+
+    The signature is only useful for the contents of at least min_size
+    bytes: when the size of a content is known to be smaller, see
+    set_expected_size, only its digest is computed.
+    """
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, digester=None,
+                 min_size=DELTA_MIN_SIZE):
+        self.block_size = block_size
+        self.digester = (digester if digester is not None
+                         else hashlib.md5())
+        self.min_size = min_size
+        self.size = 0
+        self._skip_blocks = False
+        self._blocks = []
+        self._block = bytearray(block_size)
+        # Number of bytes of the next block already in the block buffer
+        self._pending = 0
+
+    @property
+    def name(self):
+        return self.digester.name
+
+    def set_expected_size(self, size):
+        """Skip the block checksums if the content is too small"""
+        if size is not None and size < self.min_size and self.size == 0:
+            self._skip_blocks = True
+
+    def update(self, data):
+        self.digester.update(data)
+        size = len(data)
+        self.size += size
+        if self._skip_blocks:
+            return
+        block_size = self.block_size
+        offset = 0
+        if self._pending:
+            # Complete the block started by the previous chunks
+            offset = min(block_size - self._pending, size)
+            self._block[self._pending:self._pending + offset] = data[:offset]
+            self._pending += offset
+            if self._pending < block_size:
+                return
+            self._add_block(buffer(self._block))
+            self._pending = 0
+        while size - offset >= block_size:
+            self._add_block(self._get_buffer(data, offset, block_size))
+            offset += block_size
+        if offset < size:
+            self._block[:size - offset] = data[offset:]
+            self._pending = size - offset
+
+    def _get_buffer(self, data, offset, length):
+        if isinstance(data, memoryview):
+            self._block[:length] = data[offset:offset + length]
+            return buffer(self._block, 0, length)
+        return buffer(data, offset, length)
+
+    def _add_block(self, block):
+        self._blocks.append((weak_checksum(block), strong_checksum(block)))
+
+    def hexdigest(self):
+        return self.digester.hexdigest()
+
+    def signature(self):
+        """Return the Signature of the content, None if it was skipped"""
+        if self._skip_blocks:
+            return None
+        blocks = list(self._blocks)
+        if self._pending:
+            # The last block is shorter
+            last = buffer(self._block, 0, self._pending)
+            blocks.append((weak_checksum(last), strong_checksum(last)))
+        return Signature(block_size=self.block_size, size=self.size,
+                         digest=self.hexdigest(), blocks=blocks)
+
+
+def set_expected_size(digesters, size):
+    """Announce the size of a downloaded content to the SignatureBuilders"""
+    for digester in digesters:
+        if isinstance(digester, SignatureBuilder):
+            digester.set_expected_size(size)
+
+
+class _DeltaWriter(object):
+
+    def __init__(self, out):
+        self.out = out
+        self.literal_size = 0
+        self.copied_blocks = 0
+        self._copy = None
+        out.write(DELTA_MAGIC)
+
+    def literal(self, data, start, end):
+        if end <= start:
+            return
+        self._flush_copy()
+        self.out.write(_LITERAL.pack('L', end - start))
+        self.out.write(buffer(data, start, end - start))
+        self.literal_size += end - start
+
+    def copy(self, block_index):
+        self.copied_blocks += 1
+        if self._copy is not None:
+            first, count = self._copy
+            if first + count == block_index:
+                self._copy = first, count + 1
+                return
+            self._flush_copy()
+        self._copy = block_index, 1
+
+    def _flush_copy(self):
+        if self._copy is not None:
+            self.out.write(_COPY.pack('C', *self._copy))
+            self._copy = None
+
+    def end(self):
+        self._flush_copy()
+        self.out.write('E')
+
+
+def compute_delta(file_object, signature, out, builder=None,
+                  buffer_size=BUFFER_SIZE,
+                  max_literal_ratio=MAX_LITERAL_RATIO,
+                  min_literal_check=MIN_LITERAL_CHECK):
+    """Write the delta of a file opened with io.open against a signature
+
+    If a SignatureBuilder (or a digester) is provided, it is fed with the
+    content of the file. Return the number of literal bytes of the delta.
+
+    Raise DeltaTooBig if the delta is not worth it.
+    """
+    block_size = signature.block_size
+    writer = _DeltaWriter(out)
+    chunks = iter_file(file_object, buffer_size)
+    # Sliding window of the file content: data[pos:pos + block_size] is the
+    # current block candidate and data[literal:pos] the pending literal bytes
+    data = ''
+    pos = literal = 0
+    processed = 0
+    weak = None
+    eof = False
+    while True:
+        if len(data) - pos <= block_size and not eof:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                continue
+            chunk = chunk.tobytes()
+            if builder is not None:
+                builder.update(chunk)
+            # The bytes before pos are already matched or literal
+            writer.literal(data, literal, pos)
+            processed += pos
+            data = data[pos:] + chunk
+            pos = literal = 0
+            continue
+        if len(data) - pos < block_size:
+            # Last block shorter than the block size
+            break
+        if weak is None:
+            weak = weak_checksum(buffer(data, pos, block_size))
+        block_index = signature.find_block(
+            weak, buffer(data, pos, block_size))
+        if block_index is not None:
+            writer.literal(data, literal, pos)
+            writer.copy(block_index)
+            pos += block_size
+            literal = pos
+            weak = None
+            continue
+        if pos + block_size >= len(data):
+            # No more byte to roll over
+            break
+        weak = roll(weak, ord(data[pos]), ord(data[pos + block_size]),
+                    block_size)
+        pos += 1
+        unmatched = writer.literal_size + pos - literal
+        if (unmatched > min_literal_check
+            and unmatched > max_literal_ratio * (processed + pos)):
+            raise DeltaTooBig("More than %d%% of the first %d bytes differ" % (
+                max_literal_ratio * 100, processed + pos))
+
+    # Trailing bytes: try to match the shorter last block of the signature
+    tail = data[pos:]
+    if tail and signature.blocks:
+        last = len(signature.blocks) - 1
+        if (signature.size % block_size == len(tail)
+            and signature.find_block(weak_checksum(tail), tail) == last):
+            writer.literal(data, literal, pos)
+            writer.copy(last)
+            literal = len(data)
+    writer.literal(data, literal, len(data))
+    writer.end()
+    log.trace("Delta computed: %d blocks copied, %d literal bytes",
+              writer.copied_blocks, writer.literal_size)
+    return writer.literal_size
+
+
+def apply_delta(base_file, delta_file, out, block_size):
+    """Rebuild the new version of a file from its previous version and delta
+
+    base_file is the previous version opened for reading, delta_file the
+    delta opened for reading and out the file object to write to.
+    """
+    if delta_file.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise InvalidDelta("Invalid delta header")
+    while True:
+        op = delta_file.read(1)
+        if op == 'E':
+            return
+        elif op == 'C':
+            first, count = struct.unpack('>II', delta_file.read(8))
+            base_file.seek(first * block_size)
+            _copy(base_file, out, count * block_size, exact=False)
+        elif op == 'L':
+            length, = struct.unpack('>I', delta_file.read(4))
+            _copy(delta_file, out, length)
+        else:
+            raise InvalidDelta("Unexpected delta operation: %r" % op)
+
+
+def _copy(source, out, length, exact=True):
+    while length > 0:
+        data = source.read(min(length, BUFFER_SIZE))
+        if not data:
+            if exact:
+                raise InvalidDelta("Truncated delta")
+            # Last block of the previous version is shorter
+            return
+        out.write(data)
+        length -= len(data)
+
+
+class SignatureStore(object):
+    """Signatures of the last synchronized version of files, on disk"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _get_path(self, local_folder, remote_ref):
+        binding_key = hashlib.md5(local_folder.encode('utf-8')).hexdigest()
+        file_key = hashlib.md5(remote_ref.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, binding_key, file_key)
+
+    def get(self, local_folder, remote_ref):
+        path = self._get_path(local_folder, remote_ref)
+        if not os.path.exists(path):
+            return None
+        try:
+            return Signature.load(path)
+        except (IOError, ValueError, struct.error):
+            log.debug("Ignoring invalid signature file %s", path,
+                      exc_info=True)
+            return None
+
+    def save(self, local_folder, remote_ref, signature):
+        path = self._get_path(local_folder, remote_ref)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        signature.save(path)
+
+    def delete(self, local_folder, remote_ref):
+        path = self._get_path(local_folder, remote_ref)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def delete_all(self, local_folder):
+        binding_key = hashlib.md5(local_folder.encode('utf-8')).hexdigest()
+        folder = os.path.join(self.folder, binding_key)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
@@ -3,6 +3,7 @@
 import unicodedata
 from datetime import datetime
 import hashlib
+import io
 import os
 import shutil
 import re
@@ -15,6 +16,11 @@ from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.utils import normalized_path
 from nxdrive.utils import safe_long_path
 from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.common import get_digester
+from nxdrive.client.streaming import DURABILITY_NONE
+from nxdrive.client.streaming import StreamWriter
+from nxdrive.client.streaming import iter_file
+from nxdrive.client.streaming import reflink
 
 
 log = get_logger(__name__)
@@ -29,7 +35,7 @@ class FileInfo(object):
     """Data Transfer Object for file info on the Local FS"""
 
     def __init__(self, root, path, folderish, last_modification_time,
-                 digest_func='md5'):
+                 digest_func='md5', digest=None):
         root = unicodedata.normalize('NFKC', root)
         path = unicodedata.normalize('NFKC', path)
         self.root = root  # the sync root folder local path
@@ -42,6 +48,9 @@ class FileInfo(object):
         # Function to use
         self._digest_func = digest_func.lower()
 
+        # Digest already known, e.g. computed while downloading the file
+        self._digest = digest
+
         # Precompute base name once and for all are it's often useful in
         # practice
         self.name = os.path.basename(path)
@@ -53,6 +62,8 @@ class FileInfo(object):
         """Lazy computation of the digest"""
         if self.folderish:
             return None
+        if self._digest is not None:
+            return self._digest
         digester = getattr(hashlib, self._digest_func, None)
         if digester is None:
             raise ValueError('Unknow digest method: ' + self.digest_func)
@@ -91,7 +102,13 @@ class LocalClient(object):
         self._digest_func = digest_func
 
     # Getters
-    def get_info(self, ref, raise_if_missing=True):
+    def get_info(self, ref, raise_if_missing=True, digest=None):
+        """Fetch the info of the file or folder with the given ref
+
+        digest can be provided when the digest of the file content is
+        already known (e.g. computed while streaming it) to avoid reading
+        the file again.
+        """
         os_path = self._abspath(ref)
         if not os.path.exists(os_path):
             if raise_if_missing:
@@ -109,7 +126,14 @@ class LocalClient(object):
         # to have Windows specific bugs, let's not use the unix inode at all.
         # uid = str(stat_info.st_ino)
         return FileInfo(self.base_folder, path, folderish, mtime,
-                        digest_func=self._digest_func)
+                        digest_func=self._digest_func, digest=digest)
+
+    def get_digester(self):
+        """Return a new hashlib digester for the digest function"""
+        digester = get_digester(self._digest_func)
+        if digester is None:
+            raise ValueError('Unknow digest method: ' + self._digest_func)
+        return digester
 
     def get_content(self, ref):
         return open(self._abspath(ref), "rb").read()
@@ -174,6 +198,45 @@ class LocalClient(object):
         with open(self._abspath(ref), "wb") as f:
             f.write(content)
 
+    def copy_content(self, ref, os_path, digester=None,
+                     durability=DURABILITY_NONE):
+        """Copy the content of a file to the given OS path
+
+        The blocks of the file are shared with a reflink if the file system
+        supports it, otherwise they are copied. If a hashlib digester is
+        provided, it is fed with the content of the copy to verify it.
+
+        Return True if a reflink was made.
+        """
+        source_os_path = self._abspath(ref)
+        with io.open(source_os_path, 'rb', buffering=0) as source:
+            with io.open(os_path, 'wb', buffering=0) as target:
+                reflinked = reflink(source, target)
+            if not reflinked:
+                size = os.fstat(source.fileno()).st_size
+                with StreamWriter(os_path, size=size,
+                                  durability=durability) as target:
+                    for chunk in iter_file(source):
+                        if digester is not None:
+                            digester.update(chunk)
+                        target.write(chunk)
+                return False
+        if digester is not None or durability != DURABILITY_NONE:
+            with io.open(os_path, 'rb', buffering=0) as target:
+                if durability != DURABILITY_NONE:
+                    os.fsync(target.fileno())
+                if digester is not None:
+                    for chunk in iter_file(target):
+                        digester.update(chunk)
+        return True
+
+    def update_digester(self, ref, digester):
+        """Feed a hashlib digester with the content of a file"""
+        with io.open(self._abspath(ref), 'rb', buffering=0) as f:
+            for chunk in iter_file(f):
+                digester.update(chunk)
+        return digester
+
     def delete(self, ref):
         # TODO: add support the OS trash?
         os_path = self._abspath(ref)
@@ -0,0 +1,76 @@
+"""Chains of Automation operations sent in a single request.
+
+Dependent remote calls, such as a move followed by a rename, cost a round
+trip each. When the server provides the CHAIN_OPERATION, they are sent in
+a single request with its 'operations' parameter, a JSON list of:
+
+    {"id": <operation id>, "params": {...}, "input": <optional input>,
+     "refs": {<param name>: [<call index>, <result key>]},
+     "guard": <optional boolean>}
+
+The calls are run in order. A parameter listed in refs gets the value of
+the key of the result of a previous call, e.g. the id of a moved item. The
+calls without input get the input of the chain, such as the blob of a
+batch upload. The chain stops after a guard call returning false, or after
+the first failing call: the previous calls are not rolled back.
+
+The response is the list of the outcomes of the calls that were run:
+{"result": <result>} (null for a blob) or, for the failed one,
+{"error": {"status": <HTTP status>, "message": <message>}}.
+"""
+
+
+# Operation running a chain of operations
+CHAIN_OPERATION = 'NuxeoDrive.ExecuteChain'
+
+
+class ChainedOperation(object):
+    """Call of an operation in a chain
+
+    refs maps parameter names to (index, key) tuples: the parameter gets the
+    key of the result of the index-th call of the chain. If guard is True,
+    the chain stops after this call if its result is false.
+    """
+
+    def __init__(self, command, op_input=None, refs=None, guard=False,
+                 **params):
+        self.command = command
+        self.op_input = op_input
+        self.refs = refs if refs is not None else {}
+        self.guard = guard
+        self.params = params
+
+    def resolve_params(self, results):
+        """Return the parameters with the values of the references"""
+        params = dict(self.params)
+        for name, (index, key) in self.refs.items():
+            params[name] = results[index][key]
+        return params
+
+    def to_json(self, json_params):
+        call = {'id': self.command, 'params': json_params}
+        if self.op_input is not None:
+            call['input'] = self.op_input
+        if self.refs:
+            call['refs'] = dict((name, list(ref))
+                                for name, ref in self.refs.items())
+        if self.guard:
+            call['guard'] = True
+        return call
+
+
+class ChainError(Exception):
+    """Failure of a call of a chain
+
+    index is the index of the failed call, results the results of the
+    calls run before it.
+    """
+
+    def __init__(self, index, command, results, code, message):
+        super(ChainError, self).__init__(
+            "Call %d (%s) of the operation chain failed with HTTP error"
+            " %s: %s" % (index, command, code, message))
+        self.index = index
+        self.command = command
+        self.results = results
+        self.code = code
@@ -0,0 +1,166 @@
+"""Cache of the Automation operation registries of the servers.
+
+Downloading and parsing the registry of a server is needed to check the
+parameters of the operations. The registries are kept in memory, and on
+disk if a folder is given, along with their ETag / Last-Modified validators
+to be revalidated with a conditional request instead of being downloaded
+again by each new client. The registries sent without validator are reused
+without any request until they are older than the time to live of the cache.
+"""
+
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+# Time in seconds the registries without validator are reused for
+REGISTRY_TTL = 300
+
+
+class OperationRegistry(object):
+    """Operations of an Automation server by id
+
+    The parameter validators of the operations are compiled on first use.
+    fetch_time is the time the registry was downloaded at.
+    """
+
+    def __init__(self, operations, etag=None, last_modified=None,
+                 fetch_time=None):
+        self.operations = dict((operation['id'], operation)
+                               for operation in operations)
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetch_time = (fetch_time if fetch_time is not None
+                           else time.time())
+        self._validators = {}
+
+    def has_validators(self):
+        """Tell whether the registry can be revalidated"""
+        return self.etag is not None or self.last_modified is not None
+
+    def is_fresh(self, ttl, now=None):
+        """Tell whether the registry is younger than ttl seconds"""
+        now = time.time() if now is None else now
+        return 0 <= now - self.fetch_time < ttl
+
+    def _get_validator(self, command):
+        validator = self._validators.get(command)
+        if validator is None:
+            operation = self.operations.get(command)
+            if operation is None:
+                raise ValueError("'%s' is not a registered operations."
+                                 % command)
+            required = frozenset(param['name']
+                                 for param in operation['params']
+                                 if param['required'])
+            allowed = frozenset(param['name']
+                                for param in operation['params'])
+            validator = self._validators[command] = required, allowed
+        return validator
+
+    def check_params(self, command, params):
+        required, allowed = self._get_validator(command)
+        for param in params:
+            if param not in allowed:
+                raise ValueError("Unexpected param '%s' for operation '%s"
+                                 % (param, command))
+        for param in required:
+            if param not in params:
+                raise ValueError(
+                    "Missing required param '%s' for operation '%s'" % (
+                        param, command))
+
+    def to_json(self):
+        return json.dumps({
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'fetch_time': self.fetch_time,
+            'operations': self.operations.values(),
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data['operations'], etag=data.get('etag'),
+                   last_modified=data.get('last_modified'),
+                   fetch_time=data.get('fetch_time', 0))
+
+
+class RegistryCache(object):
+    """Operation registries by Automation URL
+
+    The registries without validator are reused for ttl seconds, see
+    get_fresh. Thread safe: can be shared by all the clients of a process.
+    """
+
+    def __init__(self, folder=None, ttl=REGISTRY_TTL):
+        self.folder = folder
+        self.ttl = ttl
+        self._registries = {}
+        self._lock = Lock()
+
+    def _get_path(self, url):
+        return os.path.join(self.folder,
+                            hashlib.md5(url.encode('utf-8')).hexdigest()
+                            + '.json')
+
+    def get(self, url):
+        with self._lock:
+            registry = self._registries.get(url)
+        if registry is not None or self.folder is None:
+            return registry
+        path = self._get_path(url)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                registry = OperationRegistry.from_json(f.read())
+        except (IOError, ValueError, KeyError):
+            log.debug("Ignoring invalid operation registry cache %s", path,
+                      exc_info=True)
+            return None
+        with self._lock:
+            self._registries.setdefault(url, registry)
+        return registry
+
+    def get_fresh(self, url):
+        """Return the registry of url if it can be used without request
+
+        The registries that cannot be revalidated are used until they
+        expire.
+        """
+        registry = self.get(url)
+        if (registry is None or registry.has_validators()
+            or not registry.is_fresh(self.ttl)):
+            return None
+        return registry
+
+    def put(self, url, registry):
+        with self._lock:
+            self._registries[url] = registry
+        if self.folder is None:
+            return
+        path = self._get_path(url)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            with open(tmp_path, 'wb') as f:
+                f.write(registry.to_json())
+            # Atomic replacement of the previous registry
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            # The registry is still cached in memory
+            log.debug("Could not save the operation registry cache %s",
+                      path, exc_info=True)
+
+
+# Shared by the clients that are not given a cache
+DEFAULT_REGISTRY_CACHE = RegistryCache()
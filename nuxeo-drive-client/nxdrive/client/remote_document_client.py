@@ -5,10 +5,13 @@ from collections import namedtuple
 from datetime import datetime
 import hashlib
 import os
+import sys
+from threading import Thread
 import urllib2
 from nxdrive.client.common import safe_filename
 from nxdrive.logging_config import get_logger
 from nxdrive.client.common import NotFound
+from nxdrive.client.operation_chain import ChainedOperation
 from nxdrive.client.base_automation_client import BaseAutomationClient
 
 
@@ -24,6 +27,20 @@ DEFAULT_TYPES = ('File', 'Workspace', 'Folder', 'SocialFolder')
 
 MAX_CHILDREN = 1000
 
+# Number of documents by page of the paged queries
+QUERY_PAGE_SIZE = 100
+
+# Schemas read when converting the documents to NuxeoDocumentInfo: the title
+# and the main blob digest
+INFO_SCHEMAS = 'dublincore, file'
+
+# Operation copying a document on the server side, e.g. to create a file
+# whose content is already stored by the server
+COPY_OPERATION = 'Document.Copy'
+
+# Maximum number of parent uids cached by path
+PARENT_UID_CACHE_SIZE = 1000
+
 # Data transfer objects
 
 BaseNuxeoDocumentInfo = namedtuple('NuxeoDocumentInfo', [
@@ -57,6 +74,15 @@ class RemoteDocumentClient(BaseAutomationClient):
     Kept here for tests and later extraction of a generic API.
     """
 
+    # Only the document ids or infos are used from the results
+    document_schemas = {
+        'Document.Query': INFO_SCHEMAS,
+        'Document.GetChildren': INFO_SCHEMAS,
+        'Document.Create': INFO_SCHEMAS,
+        'NuxeoDrive.GetRoots': INFO_SCHEMAS,
+        COPY_OPERATION: INFO_SCHEMAS,
+    }
+
     # Override constructor to initialize base folder
     # which is specific to RemoteDocumentClient
     def __init__(self, server_url, user_id, device_id, client_version,
@@ -64,7 +90,8 @@ class RemoteDocumentClient(BaseAutomationClient):
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
                  base_folder=None, timeout=20, blob_timeout=None,
-                 cookie_jar=None, upload_tmp_dir=None):
+                 cookie_jar=None, upload_tmp_dir=None, throttle=None,
+                 registry_cache=None, link_stats=None, transport=None):
         super(RemoteDocumentClient, self).__init__(
             server_url, user_id, device_id, client_version,
             proxies=proxies, proxy_exceptions=proxy_exceptions,
@@ -73,12 +100,18 @@ class RemoteDocumentClient(BaseAutomationClient):
             ignored_suffixes=ignored_suffixes,
             timeout=timeout, blob_timeout=blob_timeout,
             cookie_jar=cookie_jar,
-            upload_tmp_dir=upload_tmp_dir)
+            upload_tmp_dir=upload_tmp_dir,
+            throttle=throttle, registry_cache=registry_cache,
+            link_stats=link_stats, transport=transport)
+
+        # Uids of the parent documents by path, to convert documents to
+        # NuxeoDocumentInfo without fetching their parent
+        self._parent_uids = {}
 
         # fetch the root folder ref
         self.base_folder = base_folder
         if base_folder is not None:
-            base_folder_doc = self.fetch(base_folder)
+            base_folder_doc = self.fetch(base_folder, schemas=INFO_SCHEMAS)
             self._base_folder_ref = base_folder_doc['uid']
             self._base_folder_path = base_folder_doc['path']
         else:
@@ -89,14 +122,14 @@ class RemoteDocumentClient(BaseAutomationClient):
     #
     def get_info(self, ref, raise_if_missing=True, fetch_parent_uid=True,
                  use_trash=True, include_versions=False):
-        if not self.exists(ref, use_trash=use_trash,
-                           include_versions=include_versions):
+        doc = self._find(ref, use_trash=use_trash,
+                         include_versions=include_versions)
+        if doc is None:
             if raise_if_missing:
                 raise NotFound("Could not find '%s' on '%s'" % (
                     self._check_ref(ref), self.server_url))
             return None
-        return self._doc_to_info(self.fetch(self._check_ref(ref)),
-                                 fetch_parent_uid=fetch_parent_uid)
+        return self._doc_to_info(doc, fetch_parent_uid=fetch_parent_uid)
 
     def get_content(self, ref):
         """Download and return the binary content of a document
@@ -110,16 +143,25 @@ class RemoteDocumentClient(BaseAutomationClient):
     # See RemoteFileSystemClient.stream_content
 
     def get_children_info(self, ref, types=DEFAULT_TYPES, limit=MAX_CHILDREN):
+        """Return the infos of the children of a folder
+
+        All the children are listed page by page if the server supports
+        paged queries, else at most limit of them.
+        """
         ref = self._check_ref(ref)
         query = (
             "SELECT * FROM Document"
             "       WHERE ecm:parentId = '%s'"
             "       AND ecm:primaryType IN ('%s')"
             "       AND ecm:currentLifeCycleState != 'deleted'"
-            "       ORDER BY dc:title, dc:created LIMIT %d"
-        ) % (ref, "', '".join(types), limit)
-
-        entries = self.query(query)[u'entries']
+            "       ORDER BY dc:title, dc:created"
+        ) % (ref, "', '".join(types))
+        if self.is_paging_supported():
+            # All the children have the same parent
+            return self._filtered_results(self.iter_query(query),
+                                          parent_uid=ref)
+
+        entries = self.query(query + " LIMIT %d" % limit)[u'entries']
         if len(entries) == MAX_CHILDREN:
             # TODO: how to best handle this case? A warning and return an empty
             # list, a dedicated exception?
@@ -127,7 +169,8 @@ class RemoteDocumentClient(BaseAutomationClient):
                                "maximum number of children: %d" % (
                                    ref, self.server_url, MAX_CHILDREN))
 
-        return self._filtered_results(entries)
+        # All the children have the same parent
+        return self._filtered_results(entries, parent_uid=ref)
 
     def make_folder(self, parent, name, doc_type=FOLDER_TYPE):
         # TODO: make it possible to configure context dependent:
@@ -145,21 +188,44 @@ class RemoteDocumentClient(BaseAutomationClient):
 
         Creates a temporary file from the content then streams it.
         """
+        if content is not None:
+            file_path = self.make_tmp_file(content)
+            try:
+                return self.stream_file(parent, name, file_path,
+                                        filename=name, doc_type=doc_type)
+            finally:
+                os.remove(file_path)
         parent = self._check_ref(parent)
         doc = self.create(parent, doc_type, name=name,
                           properties={'dc:title': name})
-        ref = doc[u'uid']
-        if content is not None:
-            self.attach_blob(ref, content, name)
-        return ref
+        return doc[u'uid']
 
     def stream_file(self, parent, name, file_path, filename=None,
                     doc_type=FILE_TYPE):
-        """Create a document by streaming the file with the given path"""
-        ref = self.make_file(parent, name, doc_type=doc_type)
-        self.execute_with_blob_streaming("Blob.Attach", file_path,
-                                         filename=filename, document=ref)
-        return ref
+        """Create a document by streaming the file with the given path
+
+        The file is uploaded first, then the document is created and the
+        file attached to it with a single operation chain. Without chaining
+        support, the document is created before attaching the streamed file.
+        """
+        parent = self._check_ref(parent)
+        if not self.is_chaining_supported():
+            ref = self.make_file(parent, name, doc_type=doc_type)
+            self.execute_with_blob_streaming("Blob.Attach", file_path,
+                                             filename=filename, document=ref)
+            return ref
+        batch_id = self._generate_unique_id()
+        upload_result = self.upload(batch_id, file_path, filename=filename)
+        if upload_result['uploaded'] != 'true':
+            raise ValueError("Bad response from batch upload with id '%s'"
+                             " and file path '%s'" % (batch_id, file_path))
+        doc = self.execute_chain([
+            ChainedOperation("Document.Create", op_input="doc:" + parent,
+                             type=doc_type, name=safe_filename(name),
+                             properties={'dc:title': name}),
+            ChainedOperation("Blob.Attach", refs={'document': (0, 'uid')}),
+        ], batch_id=batch_id)[0]
+        return doc[u'uid']
 
     def update_content(self, ref, content, filename=None):
         """Update a document with the given content
@@ -177,6 +243,8 @@ class RemoteDocumentClient(BaseAutomationClient):
                                          filename=filename, document=ref)
 
     def delete(self, ref, use_trash=True):
+        # The path of the document can be reused by a new one
+        self._parent_uids.clear()
         op_input = "doc:" + self._check_ref(ref)
         if use_trash:
             try:
@@ -198,6 +266,14 @@ class RemoteDocumentClient(BaseAutomationClient):
         return self.delete_blob(self._check_ref(ref), xpath=xpath)
 
     def exists(self, ref, use_trash=True, include_versions=False):
+        return self._find(ref, use_trash=use_trash,
+                          include_versions=include_versions) is not None
+
+    def _find(self, ref, use_trash=True, include_versions=False):
+        """Return the document with the given ref, or None if not found
+
+        The existence check and the document are a single query.
+        """
         ref = self._check_ref(ref)
         id_prop = 'ecm:path' if ref.startswith('/') else 'ecm:uuid'
         if use_trash:
@@ -212,8 +288,8 @@ class RemoteDocumentClient(BaseAutomationClient):
         query = ("SELECT * FROM Document WHERE %s = '%s' %s %s"
                  " LIMIT 1") % (
             id_prop, ref, lifecyle_pred, version_pred)
-        results = self.query(query)
-        return len(results[u'entries']) == 1
+        entries = self.query(query)[u'entries']
+        return entries[0] if entries else None
 
     def check_writable(self, ref):
         # TODO: which operation can be used to perform a permission check?
@@ -254,9 +330,8 @@ class RemoteDocumentClient(BaseAutomationClient):
             else:
                 digest = blob.get('digest')
 
-        # XXX: we need another roundtrip just to fetch the parent uid...
         if parent_uid is None and fetch_parent_uid:
-            parent_uid = self.fetch(os.path.dirname(doc['path']))['uid']
+            parent_uid = self._get_parent_uid(doc)
 
         # Normalize using NFKC to make the tests more intuitive
         name = props['dc:title']
@@ -267,14 +342,29 @@ class RemoteDocumentClient(BaseAutomationClient):
             doc['path'], folderish, last_update, digest, self.repository,
             doc['type'])
 
+    def _get_parent_uid(self, doc):
+        """Return the parent uid of a document, fetching it if not known"""
+        # Sent by the recent servers
+        parent_uid = doc.get('parentRef')
+        if parent_uid is not None:
+            return parent_uid
+        parent_path = os.path.dirname(doc['path'])
+        parent_uid = self._parent_uids.get(parent_path)
+        if parent_uid is None:
+            parent_uid = self.fetch(parent_path, schemas=INFO_SCHEMAS)['uid']
+            if len(self._parent_uids) >= PARENT_UID_CACHE_SIZE:
+                self._parent_uids.clear()
+            self._parent_uids[parent_path] = parent_uid
+        return parent_uid
+
     def _filtered_results(self, entries, fetch_parent_uid=True,
                           parent_uid=None):
         # Filter out filenames that would be ignored by the file system client
         # so as to be consistent.
         filtered = []
-        for info in [self._doc_to_info(d, fetch_parent_uid=fetch_parent_uid,
+        for info in (self._doc_to_info(d, fetch_parent_uid=fetch_parent_uid,
                                        parent_uid=parent_uid)
-                     for d in entries]:
+                     for d in entries):
             ignore = False
 
             for suffix in self.ignored_suffixes:
@@ -324,15 +414,20 @@ class RemoteDocumentClient(BaseAutomationClient):
         return self.execute("Document.Unlock", op_input="doc:" + ref)
 
     def move(self, ref, target, name=None):
+        # The paths of the moved documents change
+        self._parent_uids.clear()
         return self.execute("Document.Move",
                             op_input="doc:" + self._check_ref(ref),
                             target=self._check_ref(target), name=name)
 
     def copy(self, ref, target, name=None):
-        return self.execute("Document.Copy",
+        return self.execute(COPY_OPERATION,
                             op_input="doc:" + self._check_ref(ref),
                             target=self._check_ref(target), name=name)
 
+    def is_copy_supported(self):
+        return COPY_OPERATION in self.operations
+
     def create_version(self, ref, increment='None'):
         doc = self.execute("Document.CreateVersion",
                             op_input="doc:" + self._check_ref(ref),
@@ -351,23 +446,79 @@ class RemoteDocumentClient(BaseAutomationClient):
 
     # These ones are special: no 'op_input' parameter
 
-    def fetch(self, ref):
+    def fetch(self, ref, schemas=None):
+        """Fetch a document with all its schemas or the given ones"""
         try:
-            return self.execute("Document.Fetch", value=ref)
+            return self.execute("Document.Fetch", value=ref, schemas=schemas)
         except urllib2.HTTPError as e:
             if e.code == 404:
                 raise NotFound("Failed to fetch document %r on server %r" % (
                     ref, self.server_url))
             raise e
 
-    def query(self, query, language=None):
-        return self.execute("Document.Query", query=query, language=language)
+    def query(self, query, language=None, page_size=None, page_index=None):
+        """Execute a query, returning the given page of the results if any
+
+        The server has to support paged queries to give a page, see
+        is_paging_supported.
+        """
+        if page_size is None:
+            return self.execute("Document.Query", query=query,
+                                language=language)
+        return self.execute("Document.Query", query=query, language=language,
+                            pageSize=page_size, currentPageIndex=page_index)
+
+    def is_paging_supported(self):
+        operation = self.operations.get("Document.Query")
+        return operation is not None and 'currentPageIndex' in set(
+            param['name'] for param in operation['params'])
+
+    def iter_query(self, query, language=None, page_size=QUERY_PAGE_SIZE,
+                   prefetch=False):
+        """Yield the documents of the results of a query, page by page
+
+        Only the current page is kept in memory. With prefetch, the next
+        page is requested in a background thread while the caller processes
+        the current one. The query should be ordered for the pages to be
+        consistent.
+
+        Fall back on a single query if the server does not support paged
+        queries.
+        """
+        if not self.is_paging_supported():
+            for doc in self.query(query, language=language)[u'entries']:
+                yield doc
+            return
+
+        page_index = 0
+        page = self.query(query, language=language, page_size=page_size,
+                          page_index=page_index)
+        while True:
+            entries = page[u'entries']
+            has_next = page.get(u'isNextPageAvailable')
+            if has_next is None:
+                # Servers that do not send the pagination details
+                has_next = len(entries) == page_size
+            next_page = None
+            if has_next and prefetch:
+                next_page = _PageFetcher(self, query, language, page_size,
+                                         page_index + 1)
+            for doc in entries:
+                yield doc
+            if not has_next:
+                return
+            page_index += 1
+            if next_page is not None:
+                page = next_page.get()
+            else:
+                page = self.query(query, language=language,
+                                  page_size=page_size, page_index=page_index)
 
     # Blob category
 
     def get_blob(self, ref):
         return self.execute("Blob.Get", op_input="doc:" + ref,
-                            timeout=self.blob_timeout)
+                            timeout=self.get_blob_timeout())
 
     def attach_blob(self, ref, blob, filename):
         file_path = self.make_tmp_file(blob)
@@ -406,3 +557,30 @@ class RemoteDocumentClient(BaseAutomationClient):
     def deactivate_profile(self, profile):
         self.execute("NuxeoDrive.SetActiveFactories", profile=profile,
                      enable=False)
+
+
+class _PageFetcher(object):
+    """Query a page of results in a background thread"""
+
+    def __init__(self, client, query, language, page_size, page_index):
+        self._page = None
+        self._exc_info = None
+        self._thread = Thread(target=self._run, args=(
+            client, query, language, page_size, page_index))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, client, query, language, page_size, page_index):
+        try:
+            self._page = client.query(query, language=language,
+                                      page_size=page_size,
+                                      page_index=page_index)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def get(self):
+        """Wait for the page, raising the error of the query if any"""
+        self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._page
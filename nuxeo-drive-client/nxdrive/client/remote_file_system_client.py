@@ -4,10 +4,30 @@ import unicodedata
 from collections import namedtuple
 from datetime import datetime
 import urllib2
+import io
 import os
+import tarfile
+import tempfile
+import time
+from collections import deque
+from threading import Lock
 from nxdrive.logging_config import get_logger
 from nxdrive.client.common import NotFound
+from nxdrive.client.common import CorruptedFile
+from nxdrive.client.common import get_digester
 from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.client.change_notifier import DEFAULT_MAX_WAIT
+from nxdrive.client.change_notifier import WAIT_FOR_CHANGES_OPERATION
+from nxdrive.client.operation_chain import ChainedOperation
+from nxdrive.client.streaming import iter_response
+from nxdrive.client.streaming import StreamWriter
+from nxdrive.client.transport import Future
+from nxdrive.client.transport import chain
+from nxdrive.client.transport import completed_future
+from nxdrive.client.delta import DeltaTooBig
+from nxdrive.client.delta import SignatureBuilder
+from nxdrive.client.delta import set_expected_size
+from nxdrive.client.delta import compute_delta
 from nxdrive.client.base_automation_client import Unauthorized
 from nxdrive.client.base_automation_client import BaseAutomationClient
 
@@ -17,6 +37,33 @@ log = get_logger(__name__)
 DOWNLOAD_TMP_FILE_PREFIX = '.'
 DOWNLOAD_TMP_FILE_SUFFIX = '.part'
 
+# Operation updating a file from a delta against its current content
+APPLY_DELTA_OPERATION = 'NuxeoDrive.UpdateFileFromDelta'
+
+# Factories of the file system items adapting a document: their ids are
+# made of the factory name, the repository and the uid of the document
+FILE_ITEM_FACTORY = 'defaultFileSystemItemFactory'
+DOCUMENT_ITEM_FACTORIES = (FILE_ITEM_FACTORY,
+                           'defaultSyncRootFolderItemFactory')
+
+# Operation creating the files of a blob list input in a folder, in a
+# single request. Returns the list of the created file system items.
+CREATE_FILES_OPERATION = 'NuxeoDrive.CreateFiles'
+
+# Operation returning a tar archive of the content of a list of file system
+# items: each member is named after the id of its item and has 'digest' and
+# 'digestAlgorithm' pax headers. Unknown items are skipped.
+DOWNLOAD_ARCHIVE_OPERATION = 'NuxeoDrive.GetFilesArchive'
+
+# Limits of the bundles of small files created with a single request
+BUNDLE_MAX_FILE_SIZE = 256 * 1024
+BUNDLE_MAX_SIZE = 4 * 1024 ** 2
+BUNDLE_MAX_FILES = 500
+
+# Chunks received for a download waiting for the workers of the transport:
+# the connection is not read beyond
+SINK_MAX_PENDING_CHUNKS = 4
+
 # Data transfer objects
 
 BaseRemoteFileInfo = namedtuple('RemoteFileInfo', [
@@ -50,12 +97,29 @@ class RemoteFileSystemClient(BaseAutomationClient):
     Uses the FileSystemItem API.
     """
 
+    # Listings sent again by the server only if they have changed
+    conditional_operations = frozenset([
+        'NuxeoDrive.GetTopLevelFolder',
+        'NuxeoDrive.GetTopLevelChildren',
+        'NuxeoDrive.GetChildren',
+    ])
+
     #
     # API common with the local client API
     #
 
     def get_info(self, fs_item_id, raise_if_missing=True):
-        fs_item = self.get_fs_item(fs_item_id)
+        return self._get_info(self.get_fs_item(fs_item_id), fs_item_id,
+                              raise_if_missing)
+
+    def get_info_async(self, fs_item_id, raise_if_missing=True):
+        """Return the Future of get_info"""
+        future = self.execute_read_async("NuxeoDrive.GetFileSystemItem",
+                                         id=fs_item_id)
+        return chain(future, lambda fs_item: self._get_info(
+            fs_item, fs_item_id, raise_if_missing))
+
+    def _get_info(self, fs_item, fs_item_id, raise_if_missing):
         if fs_item is None:
             if raise_if_missing:
                 raise NotFound("Could not find '%s' on '%s'" % (
@@ -64,7 +128,7 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return self.file_to_info(fs_item)
 
     def get_filesystem_root_info(self):
-        toplevel_folder = self.execute("NuxeoDrive.GetTopLevelFolder")
+        toplevel_folder = self.execute_read("NuxeoDrive.GetTopLevelFolder")
         return self.file_to_info(toplevel_folder)
 
     def get_content(self, fs_item_id):
@@ -80,25 +144,206 @@ class RemoteFileSystemClient(BaseAutomationClient):
         content, _ = self._do_get(download_url)
         return content
 
-    def stream_content(self, fs_item_id, file_path):
+    def stream_content(self, fs_item_id, file_path, digester=None):
         """Stream the binary content of a file system item to a tmp file
 
+        The digest of the content is computed while streaming and checked
+        against the digest of the file system item. If a hashlib digester
+        is provided, it is updated with the downloaded bytes.
+
         Raises NotFound if file system item with id fs_item_id
         cannot be found
+
+        Raises CorruptedFile if the digest of the downloaded content does
+        not match, the tmp file is deleted in that case
         """
         fs_item_info = self.get_info(fs_item_id)
+        download_url, file_out, digesters, checker = self._prepare_download(
+            fs_item_info, file_path, digester)
+        _, tmp_file = self._do_get(download_url, file_out=file_out,
+                                   digesters=digesters)
+        return self._check_download(fs_item_info, download_url, tmp_file,
+                                    checker)
+
+    def stream_content_async(self, fs_item_id, file_path, digester=None):
+        """Return the Future of stream_content
+
+        The content received by the event loop of the transport is written
+        to the tmp file by the workers of the transport.
+        """
+        if (not self.can_use_transport()
+            or (self.throttle is not None and self.throttle.is_active()
+                and self.throttle.download_bucket.is_limited())):
+            # The bandwidth limit would block the event loop
+            return completed_future(self.stream_content, fs_item_id,
+                                    file_path, digester=digester)
+        # Take the token of the download request here: waiting for it in
+        # the callback would block the event loop
+        self._throttle_request()
+
+        def download(fs_item_info):
+            download_url, file_out, digesters, checker = (
+                self._prepare_download(fs_item_info, file_path, digester))
+            sinks = []
+
+            def get_sink(response):
+                size = response.headers.get('Content-Length')
+                size = int(size) if size is not None else None
+                set_expected_size(digesters, size)
+                sink = _DownloadSink(
+                    self, StreamWriter(file_out, size=size,
+                                       durability=self.durability),
+                    digesters, self.get_watchdog(size=size))
+                sinks.append(sink)
+                return sink
+
+            def check(response):
+                # Wait for the writes of the workers
+                return chain(sinks[0].done, lambda _: self._check_download(
+                    fs_item_info, download_url, file_out, checker))
+
+            log.trace("Submitting download of %s", download_url)
+            future = self.submit(download_url,
+                                 headers=self._get_common_headers(),
+                                 timeout=self.get_blob_timeout(),
+                                 sink_factory=get_sink)
+            return chain(future, check)
+
+        return chain(self.get_info_async(fs_item_id), download)
+
+    def _prepare_download(self, fs_item_info, file_path, digester):
+        """Return the URL, tmp file, digesters and checker of a download"""
         download_url = self.server_url + fs_item_info.download_url
         file_dir = os.path.dirname(file_path)
         file_name = os.path.basename(file_path)
         file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
                                 + DOWNLOAD_TMP_FILE_SUFFIX)
-        _, tmp_file = self._do_get(download_url, file_out=file_out)
+
+        digesters = [digester] if digester is not None else []
+        algorithm = (fs_item_info.digest_algorithm or '').lower()
+        if digester is not None and digester.name.lower() == algorithm:
+            checker = digester
+        else:
+            checker = get_digester(algorithm)
+            if checker is not None:
+                digesters.append(checker)
+        return download_url, file_out, digesters, checker
+
+    def _check_download(self, fs_item_info, download_url, tmp_file, checker):
+        if checker is not None:
+            digest = checker.hexdigest()
+            if digest != fs_item_info.digest:
+                os.remove(tmp_file)
+                raise CorruptedFile(
+                    "Digest mismatch for '%s' downloaded from '%s':"
+                    " expected %s, got %s" % (
+                        fs_item_info.name, download_url,
+                        fs_item_info.digest, digest))
         return tmp_file
 
+    def stream_contents(self, files):
+        """Stream the content of several file system items to tmp files
+
+        files is a list of (fs_item_id, file_path, digester) tuples, where
+        the optional hashlib digester is updated with the downloaded bytes.
+        The contents are downloaded with a single request, as an archive
+        that is unpacked on the fly to the tmp files of the file paths.
+
+        Return a dict of (tmp_file, digest) tuples by file system item id.
+        Items missing from the archive or whose content is corrupted are
+        not part of it.
+        """
+        files = dict((fs_item_id, (file_path, digester))
+                     for fs_item_id, file_path, digester in files)
+        results = {}
+        response = self.execute(DOWNLOAD_ARCHIVE_OPERATION,
+                                raw_response=True,
+                                timeout=self.get_blob_timeout(),
+                                ids=','.join(files))
+        # The size of the archive is not known in advance
+        watchdog = self.get_watchdog()
+        try:
+            archive = tarfile.open(fileobj=response, mode='r|')
+            for member in archive:
+                if not member.isfile() or member.name not in files:
+                    continue
+                file_path, digester = files[member.name]
+                result = self._extract_member(archive, member, file_path,
+                                              digester, watchdog)
+                if result is not None:
+                    results[member.name] = result
+        except:
+            # Do not leave the files already extracted behind
+            for tmp_file, _ in results.values():
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            raise
+        finally:
+            response.close()
+            self.link_stats.record_transfer(self.server_url,
+                                            watchdog.n_bytes,
+                                            watchdog.get_duration())
+        return results
+
+    def _extract_member(self, archive, member, file_path, digester,
+                        watchdog):
+        file_out = os.path.join(os.path.dirname(file_path),
+                                DOWNLOAD_TMP_FILE_PREFIX
+                                + os.path.basename(file_path)
+                                + DOWNLOAD_TMP_FILE_SUFFIX)
+        expected_digest = member.pax_headers.get('digest')
+        algorithm = member.pax_headers.get('digestAlgorithm', '').lower()
+        digesters = [digester] if digester is not None else []
+        if digester is not None and digester.name.lower() == algorithm:
+            checker = digester
+        else:
+            checker = get_digester(algorithm)
+            if checker is not None:
+                digesters.append(checker)
+        set_expected_size(digesters, member.size)
+        source = archive.extractfile(member)
+        try:
+            with StreamWriter(file_out, size=member.size,
+                              durability=self.durability) as f:
+                while True:
+                    buffer_ = source.read(BUFFER_SIZE)
+                    if not buffer_:
+                        break
+                    watchdog.update(len(buffer_))
+                    if self.throttle is not None:
+                        watchdog.pause(self.throttle.download(len(buffer_)))
+                    for d in digesters:
+                        d.update(buffer_)
+                    f.write(buffer_)
+        except:
+            # Partially extracted file
+            if os.path.exists(file_out):
+                os.remove(file_out)
+            raise
+        if checker is None:
+            return file_out, None
+        digest = checker.hexdigest()
+        if digest != expected_digest:
+            log.warning("Digest mismatch for '%s' in the archive: expected"
+                        " %s, got %s", member.name, expected_digest, digest)
+            os.remove(file_out)
+            return None
+        return file_out, digest
+
+    def is_archive_supported(self):
+        return DOWNLOAD_ARCHIVE_OPERATION in self.operations
+
     def get_children_info(self, fs_item_id):
-        children = self.execute("NuxeoDrive.GetChildren", id=fs_item_id)
+        children = self.execute_read("NuxeoDrive.GetChildren", id=fs_item_id)
         return [self.file_to_info(fs_item) for fs_item in children]
 
+    def get_children_info_async(self, fs_item_id):
+        """Return the Future of get_children_info"""
+        future = self.execute_read_async("NuxeoDrive.GetChildren",
+                                         id=fs_item_id)
+        return chain(future, lambda children: [self.file_to_info(fs_item)
+                                               for fs_item in children])
+
     def make_folder(self, parent_id, name):
         fs_item = self.execute("NuxeoDrive.CreateFolder",
             parentId=parent_id, name=name)
@@ -114,12 +359,70 @@ class RemoteFileSystemClient(BaseAutomationClient):
             file_path, filename=name, parentId=parent_id)
         return fs_item['id']
 
-    def stream_file(self, parent_id, file_path, filename=None):
-        """Create a document by streaming the file with the given path"""
+    def stream_file(self, parent_id, file_path, filename=None, digester=None):
+        """Create a document by streaming the file with the given path
+
+        If a hashlib digester is provided, it is updated with the uploaded
+        bytes.
+        """
         fs_item = self.execute_with_blob_streaming("NuxeoDrive.CreateFile",
-            file_path, filename=filename, parentId=parent_id)
+            file_path, filename=filename, digester=digester,
+            parentId=parent_id)
         return fs_item['id']
 
+    def stream_files(self, parent_id, files, callback=None):
+        """Create documents for a list of small files in the same folder
+
+        files is a list of (file_path, filename, digester) tuples, where the
+        optional hashlib digester is updated with the content of the file.
+        The files are sent by bundles of up to BUNDLE_MAX_SIZE bytes, each
+        bundle with a single request.
+
+        If callback is given, it is called with the list of the
+        RemoteFileInfo of each bundle as soon as it is created, so that the
+        caller can record the created files even if a later bundle fails.
+
+        Return the list of the RemoteFileInfo of the created files, in the
+        order of files.
+        """
+        infos = []
+        bundle = []
+        bundle_size = 0
+        for file_path, filename, digester in files:
+            if filename is None:
+                filename = os.path.basename(file_path)
+            with open(file_path, 'rb') as f:
+                content = f.read()
+            if digester is not None:
+                digester.update(content)
+            if bundle and (bundle_size + len(content) > BUNDLE_MAX_SIZE
+                           or len(bundle) >= BUNDLE_MAX_FILES):
+                infos.extend(self._create_files(parent_id, bundle, callback))
+                bundle = []
+                bundle_size = 0
+            bundle.append((content, filename))
+            bundle_size += len(content)
+        if bundle:
+            infos.extend(self._create_files(parent_id, bundle, callback))
+        return infos
+
+    def _create_files(self, parent_id, bundle, callback=None):
+        log.debug("Creating %d files with a single %d bytes request",
+                  len(bundle), sum(len(content) for content, _ in bundle))
+        fs_items = self.execute_with_blobs(CREATE_FILES_OPERATION, bundle,
+                                           parentId=parent_id)
+        if len(fs_items) != len(bundle):
+            raise ValueError("Bad response from %s: %d files created"
+                             " instead of %d" % (CREATE_FILES_OPERATION,
+                                                 len(fs_items), len(bundle)))
+        infos = [self.file_to_info(fs_item) for fs_item in fs_items]
+        if callback is not None:
+            callback(infos)
+        return infos
+
+    def is_bundle_supported(self):
+        return CREATE_FILES_OPERATION in self.operations
+
     def update_content(self, fs_item_id, content, filename=None):
         """Update a document with the given content
 
@@ -131,10 +434,99 @@ class RemoteFileSystemClient(BaseAutomationClient):
         self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
             file_path, filename=filename, id=fs_item_id)
 
-    def stream_update(self, fs_item_id, file_path, filename=None):
-        """Update a document by streaming the file with the given path"""
+    def stream_update(self, fs_item_id, file_path, filename=None,
+                      digester=None):
+        """Update a document by streaming the file with the given path
+
+        If a hashlib digester is provided, it is updated with the uploaded
+        bytes.
+        """
         self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
-            file_path, filename=filename, id=fs_item_id)
+            file_path, filename=filename, digester=digester, id=fs_item_id)
+
+    def stream_update_delta(self, fs_item_id, file_path, signature,
+                            filename=None, digester=None):
+        """Update a document by uploading the delta of the file
+
+        signature is the nxdrive.client.delta.Signature of the current
+        content of the document. Only the blocks of the file that cannot be
+        found in this content are uploaded. Fall back on a full upload if
+        the server cannot apply deltas, if the delta is not worth it or if
+        it cannot be applied.
+
+        digester is a new hashlib digester for the digest of the file.
+
+        Return the SignatureBuilder fed with the uploaded content: it holds
+        the digest and the signature of the new content of the document.
+        """
+        if self.is_delta_supported():
+            builder = SignatureBuilder(
+                signature.block_size,
+                digester=digester.copy() if digester is not None else None)
+            if self._upload_delta(fs_item_id, file_path, signature, builder,
+                                  filename=filename):
+                return builder
+        builder = SignatureBuilder(signature.block_size, digester=digester)
+        self.stream_update(fs_item_id, file_path, filename=filename,
+                           digester=builder)
+        return builder
+
+    def get_document_ref(self, fs_item_id):
+        """Return the (repository, doc uid) of the document of an item
+
+        Only the ids of the items of the default document adapter factories
+        are made of the repository and uid of their document: return None
+        for the other items, e.g. the top level folder.
+        """
+        parts = fs_item_id.split('#') if fs_item_id else []
+        if (len(parts) != 3 or parts[0] not in DOCUMENT_ITEM_FACTORIES
+            or not all(parts)):
+            return None
+        return parts[1], parts[2]
+
+    def get_file_item_id(self, repository, doc_uid):
+        """Return the id of the file system item of a file document"""
+        return '#'.join((FILE_ITEM_FACTORY, repository, doc_uid))
+
+    def is_delta_supported(self):
+        return APPLY_DELTA_OPERATION in self.operations
+
+    def _upload_delta(self, fs_item_id, file_path, signature, builder,
+                      filename=None):
+        fd, delta_path = tempfile.mkstemp(suffix=u'-nxdrive-delta-to-upload',
+                                          dir=self.upload_tmp_dir)
+        os.close(fd)
+        try:
+            try:
+                with io.open(file_path, 'rb', buffering=0) as f:
+                    with open(delta_path, 'wb') as out:
+                        literal_size = compute_delta(f, signature, out,
+                                                     builder=builder)
+            except DeltaTooBig as e:
+                log.debug("Uploading the whole content of '%s': %s",
+                          file_path, e)
+                return False
+            delta_size = os.path.getsize(delta_path)
+            log.debug("Uploading a %d bytes delta with %d literal bytes"
+                      " instead of the %d bytes of '%s'", delta_size,
+                      literal_size, builder.size, file_path)
+            try:
+                self.execute_with_blob_streaming(
+                    APPLY_DELTA_OPERATION, delta_path, filename=filename,
+                    id=fs_item_id, baseDigest=signature.digest,
+                    digest=builder.hexdigest(),
+                    blockSize=signature.block_size)
+            except urllib2.HTTPError as e:
+                if e.code in (401, 403):
+                    raise
+                # e.g. the remote content has changed in the mean time
+                log.debug("Delta of '%s' could not be applied (HTTP error"
+                          " %d), uploading the whole content", file_path,
+                          e.code)
+                return False
+            return True
+        finally:
+            os.remove(delta_path)
 
     def delete(self, fs_item_id):
         self.execute("NuxeoDrive.Delete", id=fs_item_id)
@@ -158,6 +550,48 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return self.execute("NuxeoDrive.CanMove", srcId=fs_item_id,
             destId=new_parent_id)
 
+    def get_infos(self, fs_item_ids):
+        """Return the infos of several items with a single operation chain
+
+        The items that cannot be found get None.
+        """
+        fs_items = self.execute_chain([
+            ChainedOperation("NuxeoDrive.GetFileSystemItem", id=fs_item_id)
+            for fs_item_id in fs_item_ids])
+        return [self.file_to_info(fs_item) if fs_item is not None else None
+                for fs_item in fs_items]
+
+    def move_and_rename(self, fs_item_id, new_parent_id=None, new_name=None):
+        """Move and / or rename an item with a single operation chain
+
+        The move is only performed if allowed by NuxeoDrive.CanMove. Return
+        the info of the moved and renamed item, or None if the move is not
+        allowed.
+        """
+        operations = []
+        if new_parent_id is not None:
+            operations.append(ChainedOperation(
+                "NuxeoDrive.CanMove", guard=True, srcId=fs_item_id,
+                destId=new_parent_id))
+            operations.append(ChainedOperation(
+                "NuxeoDrive.Move", srcId=fs_item_id, destId=new_parent_id))
+        if new_name is not None:
+            if operations:
+                # The move can change the id of the item
+                operations.append(ChainedOperation(
+                    "NuxeoDrive.Rename", refs={'id': (1, 'id')},
+                    name=new_name))
+            else:
+                operations.append(ChainedOperation(
+                    "NuxeoDrive.Rename", id=fs_item_id, name=new_name))
+        if not operations:
+            raise ValueError("Nothing to move or rename for %s" % fs_item_id)
+        results = self.execute_chain(operations)
+        if len(results) < len(operations):
+            # Stopped by the CanMove guard
+            return None
+        return self.file_to_info(results[-1])
+
     def conflicted_name(self, original_name):
         """Generate a new name suitable for conflict deduplication."""
         return self.execute("NuxeoDrive.GenerateConflictedItemName",
@@ -192,7 +626,7 @@ class RemoteFileSystemClient(BaseAutomationClient):
             download_url, fs_item['canRename'], fs_item['canDelete'],
             can_update, can_create_child)
 
-    def _do_get(self, url, file_out=None):
+    def _do_get(self, url, file_out=None, digesters=()):
         if self._error is not None:
             # Simulate a configurable (e.g. network or server) error for the
             # tests
@@ -205,18 +639,43 @@ class RemoteFileSystemClient(BaseAutomationClient):
         try:
             log.trace("Calling '%s' with headers: %r", url, headers)
             req = urllib2.Request(url, headers=headers)
-            response = self.opener.open(req, timeout=self.blob_timeout)
+            self._throttle_request()
+            start = time.time()
+            response = self.opener.open(req, timeout=self.get_blob_timeout())
+            self.link_stats.record_latency(self.server_url,
+                                           time.time() - start)
 
             if file_out is not None:
-                with open(file_out, "wb") as f:
-                    while True:
-                        buffer_ = response.read(BUFFER_SIZE)
-                        if buffer_ == '':
-                            break
-                        f.write(buffer_)
+                size = response.info().get('Content-Length')
+                size = int(size) if size is not None else None
+                set_expected_size(digesters, size)
+                watchdog = self.get_watchdog(size=size)
+                try:
+                    with StreamWriter(file_out, size=size,
+                                      durability=self.durability) as f:
+                        for buffer_ in iter_response(response, BUFFER_SIZE,
+                                                     watchdog=watchdog):
+                            if self.throttle is not None:
+                                watchdog.pause(
+                                    self.throttle.download(len(buffer_)))
+                            for digester in digesters:
+                                digester.update(buffer_)
+                            f.write(buffer_)
+                finally:
+                    # Partial downloads are measured too, for the retries to
+                    # be given more time on a slow link
+                    self.link_stats.record_transfer(self.server_url,
+                                                    watchdog.n_bytes,
+                                                    watchdog.get_duration())
                 return None, file_out
             else:
-                return response.read(), None
+                content = response.read()
+                self.link_stats.record_transfer(self.server_url,
+                                                len(content),
+                                                time.time() - start)
+                if self.throttle is not None:
+                    self.throttle.download(len(content))
+                return content, None
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
@@ -233,13 +692,109 @@ class RemoteFileSystemClient(BaseAutomationClient):
     #
 
     def get_fs_item(self, fs_item_id):
-        return self.execute("NuxeoDrive.GetFileSystemItem", id=fs_item_id)
+        return self.execute_read("NuxeoDrive.GetFileSystemItem",
+                                 id=fs_item_id)
 
     def get_top_level_children(self):
-        return self.execute("NuxeoDrive.GetTopLevelChildren")
+        return self.execute_read("NuxeoDrive.GetTopLevelChildren")
 
     def get_changes(self, last_sync_date=None, last_root_definitions=None):
         return self.execute(
             'NuxeoDrive.GetChangeSummary',
             lastSyncDate=last_sync_date,
             lastSyncActiveRootDefinitions=last_root_definitions)
+
+    def is_change_notification_supported(self):
+        return WAIT_FOR_CHANGES_OPERATION in self.operations
+
+    def wait_for_changes(self, last_sync_date=None,
+                         last_root_definitions=None,
+                         max_wait=DEFAULT_MAX_WAIT):
+        """Wait up to max_wait seconds for remote changes
+
+        Return True if changes happened after the given state of the last
+        change summary, see nxdrive.client.change_notifier.
+        """
+        result = self.execute(
+            WAIT_FOR_CHANGES_OPERATION, timeout=max_wait + self.get_timeout(),
+            record_latency=False, lastSyncDate=last_sync_date,
+            lastSyncActiveRootDefinitions=last_root_definitions,
+            maxWait=max_wait)
+        return result['hasChanges']
+
+
+class _DownloadSink(object):
+    """Write a body received by the transport to a StreamWriter
+
+    The event loop thread only checks the watchdog: the digests and the
+    writes, up to the fsync of close, are done by the workers of the
+    transport not to hold the other requests back. At most
+    SINK_MAX_PENDING_CHUNKS chunks wait for them: the transport does not
+    read the connection while is_full. done is the Future of the writes.
+    """
+
+    def __init__(self, client, writer, digesters, watchdog):
+        self.client = client
+        self.writer = writer
+        self.digesters = digesters
+        self.watchdog = watchdog
+        self.done = Future()
+        self._pending = deque()
+        self._lock = Lock()
+        self._scheduled = False
+
+    def is_full(self):
+        return len(self._pending) >= SINK_MAX_PENDING_CHUNKS
+
+    def write(self, data):
+        self.watchdog.update(len(data))
+        if self.done.done():
+            # The writes failed: abort the download
+            self.done.result()
+        self._push(data)
+
+    def close(self):
+        self._push(None)
+        self.client.link_stats.record_transfer(self.client.server_url,
+                                               self.watchdog.n_bytes,
+                                               self.watchdog.get_duration())
+
+    def _push(self, data):
+        with self._lock:
+            self._pending.append(data)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.client.transport.workers.submit(self._drain)
+
+    def _drain(self):
+        # One chunk by task: the workers are shared by the downloads
+        with self._lock:
+            was_full = self.is_full()
+            data = self._pending.popleft()
+        if was_full:
+            self.client.transport.wake()
+        if not self.done.done():
+            try:
+                self._process(data)
+            except Exception:
+                self.done.set_exception()
+                try:
+                    self.writer.close()
+                except Exception:
+                    log.debug("Could not close %r", self.writer,
+                              exc_info=True)
+        with self._lock:
+            self._scheduled = len(self._pending) > 0
+            if not self._scheduled:
+                return
+        self.client.transport.workers.submit(self._drain)
+
+    def _process(self, data):
+        if data is None:
+            self.writer.close()
+            self.done.set_result(None)
+            return
+        for digester in self.digesters:
+            digester.update(data)
+        self.writer.write(data)
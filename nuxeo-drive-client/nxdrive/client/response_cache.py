@@ -0,0 +1,60 @@
+"""Cache of the remote listings revalidated with conditional requests.
+
+The decoded results of the listing operations are kept along with their
+ETag. The next identical request is sent with If-None-Match: the server
+replies 304 Not Modified without a body if the listing has not changed and
+the cached result is reused.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+# Maximum number of cached listings
+DEFAULT_MAX_SIZE = 256
+
+
+class ResponseCache(object):
+    """Least recently used results of operations, with their ETag
+
+    Thread safe: can be shared by all the clients of a process. The cached
+    results must not be modified by the callers. hits counts the results
+    reused after a 304 response.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the (etag, result) tuple cached for key, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Most recently used
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, etag, result):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = etag, result
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared by the clients that are not given a cache
+DEFAULT_RESPONSE_CACHE = ResponseCache()
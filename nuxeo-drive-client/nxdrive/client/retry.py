@@ -0,0 +1,177 @@
+"""Retry policies and circuit breakers for the requests to the servers.
+
+Failed operations are retried after a jittered exponential backoff, so that
+the clients of a struggling server do not all come back at the same time.
+Each class of operations has its own retry policy.
+The Retry-After header of the 503 (or 429) responses is honored.
+
+A circuit breaker by server stops sending requests to a server after
+consecutive failures, until the retry delay has elapsed: then a single
+trial pass is let through to probe the server.
+"""
+
+import calendar
+import httplib
+import random
+import socket
+import time
+import urllib2
+from email.utils import parsedate_tz
+from threading import RLock
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Status codes of the server overload / unavailability
+RETRYABLE_HTTP_STATUS = (429, 502, 503, 504)
+
+
+class RetryPolicy(object):
+    """Jittered exponential backoff
+
+    The delay before the attempt following n consecutive failures is drawn
+    between half and the whole of base_delay * multiplier ** (n - 1),
+    bounded by max_delay. A Retry-After delay sent by the server is used
+    instead if longer, still bounded by max_delay.
+    """
+
+    def __init__(self, base_delay, max_delay, multiplier=2,
+                 rng=random.random):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self._rng = rng
+
+    def get_delay(self, failures, retry_after=None):
+        exponent = max(0, failures - 1)
+        # Avoid computing huge powers after many failures
+        delay = self.base_delay
+        for _ in range(exponent):
+            delay *= self.multiplier
+            if delay >= self.max_delay:
+                break
+        delay = min(delay, self.max_delay)
+        delay = delay / 2.0 + self._rng() * delay / 2.0
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+# Operation classes, each one with its own retry policy
+# Synchronization passes of a server: change summary, remote scans...
+SERVER_OPERATIONS = 'server'
+# Long polling of the change notifications
+NOTIFICATION_OPERATIONS = 'notification'
+# Synchronization of the pairs transferring file contents: the retries of
+# big uploads and downloads are costly, they back off for longer
+TRANSFER_OPERATIONS = 'transfer'
+# Synchronization of the other pairs: folder creations, renames, moves and
+# deletions
+METADATA_OPERATIONS = 'metadata'
+
+RETRY_POLICIES = {
+    SERVER_OPERATIONS: RetryPolicy(5, 600),
+    NOTIFICATION_OPERATIONS: RetryPolicy(5, 300),
+    TRANSFER_OPERATIONS: RetryPolicy(300, 6 * 3600),
+    METADATA_OPERATIONS: RetryPolicy(300, 3600),
+}
+
+SERVER_RETRY_POLICY = RETRY_POLICIES[SERVER_OPERATIONS]
+
+
+def get_retry_policy(operation_class):
+    """Return the retry policy of an operation class"""
+    return RETRY_POLICIES[operation_class]
+
+
+def get_retry_after(error, now=None):
+    """Return the Retry-After delay in seconds of an HTTP error, or None"""
+    headers = getattr(error, 'hdrs', None)
+    if headers is None:
+        return None
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        log.debug("Ignoring invalid Retry-After header: %r", value)
+        return None
+    if date[9] is None:
+        timestamp = calendar.timegm(date[:9])
+    else:
+        timestamp = calendar.timegm(date[:9]) - date[9]
+    now = time.time() if now is None else now
+    return max(0, timestamp - now)
+
+
+def is_server_failure(error):
+    """Tell whether an error is caused by the server or the network
+
+    Authentication and permission errors are not.
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in RETRYABLE_HTTP_STATUS or error.code >= 500
+    return isinstance(error, (urllib2.URLError, httplib.HTTPException,
+                              socket.error))
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing server until its retry delay has elapsed
+
+    Closed while the server works. Opened after failure_threshold
+    consecutive failures (or right away with a Retry-After delay) for the
+    retry delay of the policy. Once the delay elapsed, allow_request lets
+    a trial through: its success closes the breaker, its failure opens it
+    again for a longer delay.
+    """
+
+    def __init__(self, policy=SERVER_RETRY_POLICY, failure_threshold=3,
+                 clock=time.time):
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self._clock = clock
+        self._lock = RLock()
+        self.failures = 0
+        self.retry_time = None
+        # Number of requests not sent while open
+        self.rejected = 0
+
+    def is_open(self):
+        with self._lock:
+            return (self.retry_time is not None
+                    and self._clock() < self.retry_time)
+
+    def allow_request(self):
+        with self._lock:
+            if self.is_open():
+                self.rejected += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.failures:
+                log.debug("Closing circuit breaker after %d failures",
+                          self.failures)
+            self.failures = 0
+            self.retry_time = None
+
+    def record_failure(self, retry_after=None):
+        """Count a failure, return the retry delay if the breaker opens"""
+        with self._lock:
+            self.failures += 1
+            if (self.failures < self.failure_threshold
+                and retry_after is None):
+                return None
+            delay = self.policy.get_delay(
+                self.failures - self.failure_threshold + 1,
+                retry_after=retry_after)
+            self.retry_time = self._clock() + delay
+            log.debug("Opening circuit breaker for %0.1fs after %d failures",
+                      delay, self.failures)
+            return delay
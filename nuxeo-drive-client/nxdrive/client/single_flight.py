@@ -0,0 +1,73 @@
+"""Coalescing of identical concurrent requests.
+
+Threads sharing a controller (GUI, synchronization, protocol handler) often
+read the same remote items at the same time. Only the first of identical
+concurrent calls, the leader, is run: the others wait for it and share its
+result, or its error.
+"""
+
+import sys
+from threading import Event
+from threading import Lock
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Run identical concurrent calls only once
+
+    The shared results must not be modified by the callers.
+
+    Thread safe: can be shared by all the clients of a process. calls counts
+    the calls actually run and coalesced the ones that shared their result.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            log.trace("Waiting for the identical call in flight: %r", key)
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+        try:
+            call.result = function(*args, **kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def get_metrics(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced}
+
+
+# Shared by the clients that are not given one
+DEFAULT_SINGLE_FLIGHT = SingleFlight()
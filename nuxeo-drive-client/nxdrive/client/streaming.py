@@ -0,0 +1,318 @@
+"""Allocation free buffers for the streaming uploads and downloads.
+
+The chunks yielded by the generators of this module are memoryview slices of
+a single preallocated buffer: they are only valid until the next iteration
+and must be consumed (sent, written, hashed...) right away.
+
+Downloaded files are written with StreamWriter that preallocates the file
+and keeps the transferred content out of the page cache.
+"""
+
+import httplib
+import io
+import os
+import sys
+from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.logging_config import get_logger
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+log = get_logger(__name__)
+
+
+# Durability policies of the downloaded files
+DURABILITY_NONE = 'none'
+# fsync the downloaded file before it is renamed
+DURABILITY_FSYNC = 'fsync'
+# Also fsync the parent directory once the file is renamed
+DURABILITY_FSYNC_DIR = 'fsync_dir'
+DURABILITY_POLICIES = (DURABILITY_NONE, DURABILITY_FSYNC,
+                       DURABILITY_FSYNC_DIR)
+
+# Linux values of the posix_fadvise and sync_file_range flags
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# Size of the ranges written back and dropped from the page cache
+WRITEBACK_WINDOW = 8 * BUFFER_SIZE
+
+# Linux ioctl sharing the blocks of a file on copy on write file systems
+FICLONE = 0x40049409
+
+
+def _load_libc_functions():
+    """Find the optional libc file functions not exposed by Python 2"""
+    functions = {}
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return functions
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return functions
+    off64 = ctypes.c_int64
+    signatures = {
+        'posix_fallocate': ('posix_fallocate64', [ctypes.c_int, off64, off64]),
+        'posix_fadvise': ('posix_fadvise64',
+                          [ctypes.c_int, off64, off64, ctypes.c_int]),
+        'sync_file_range': ('sync_file_range',
+                            [ctypes.c_int, off64, off64, ctypes.c_uint]),
+    }
+    for name, (symbol, argtypes) in signatures.items():
+        function = getattr(libc, symbol, None)
+        if function is None:
+            continue
+        function.argtypes = argtypes
+        function.restype = ctypes.c_int
+        functions[name] = function
+    return functions
+
+_LIBC = _load_libc_functions()
+
+
+def preallocate(file_object, size):
+    """Allocate the disk space of a file to avoid its fragmentation
+
+    Return True if the space could be allocated.
+    """
+    posix_fallocate = _LIBC.get('posix_fallocate')
+    if posix_fallocate is None or size <= 0:
+        return False
+    # posix_fallocate returns the error number instead of setting errno
+    return posix_fallocate(file_object.fileno(), 0, size) == 0
+
+
+def advise(file_object, advice, offset=0, length=0):
+    """Declare an access pattern of the file content to the kernel"""
+    posix_fadvise = _LIBC.get('posix_fadvise')
+    if posix_fadvise is None:
+        return False
+    return posix_fadvise(file_object.fileno(), offset, length, advice) == 0
+
+
+def reflink(source_file, target_file):
+    """Share the blocks of a file with an empty file, without copying them
+
+    Return True if the file system supports it (e.g. Btrfs or XFS).
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    except (IOError, OSError) as e:
+        log.trace("Cannot reflink %r: %s", source_file.name, e)
+        return False
+    return True
+
+
+def fsync_directory(path):
+    """Make the entries (e.g. a renaming) of a directory durable"""
+    if sys.platform == 'win32':
+        # Directories cannot be opened, NTFS journals the metadata changes
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_buffer_size(file_object, buffer_size=BUFFER_SIZE):
+    """Round the buffer size to a multiple of the file system block size"""
+    if sys.platform == 'win32':
+        return buffer_size
+    try:
+        block_size = os.fstatvfs(file_object.fileno()).f_bsize
+    except (OSError, AttributeError):
+        return buffer_size
+    if block_size <= 0:
+        return buffer_size
+    return max(block_size, buffer_size - buffer_size % block_size)
+
+
+def iter_file(file_object, buffer_size=BUFFER_SIZE):
+    """Yield the content of a file opened with io.open by chunks
+
+    The chunks are read with readinto in a single preallocated buffer.
+    """
+    buffer_ = bytearray(buffer_size)
+    view = memoryview(buffer_)
+    while True:
+        n = file_object.readinto(buffer_)
+        if not n:
+            break
+        yield view[:n]
+
+
+def _get_raw_socket(response):
+    """Find the socket of an urllib2 response if it can be read directly
+
+    urllib2 wraps the httplib response in a socket file object that reads the
+    body through string allocating calls. For a body with a known length and
+    no transfer encoding, the bytes can be received directly in the
+    preallocated buffer from the underlying socket, once the few bytes
+    already buffered while parsing the headers have been consumed.
+
+    Return a (socket, httplib_response, buffered_bytes) tuple or None.
+    """
+    wrapper = getattr(response, 'fp', None)
+    http_response = getattr(wrapper, '_sock', None)
+    if not isinstance(http_response, httplib.HTTPResponse):
+        return None
+    if http_response.chunked or http_response.length is None:
+        return None
+    socket_file = http_response.fp
+    sock = getattr(socket_file, '_sock', None)
+    if sock is None or not hasattr(sock, 'recv_into'):
+        return None
+    wrapper_rbuf = getattr(wrapper, '_rbuf', None)
+    rbuf = getattr(socket_file, '_rbuf', None)
+    if (wrapper_rbuf is None or len(wrapper_rbuf.getvalue()) > 0
+        or rbuf is None):
+        return None
+    # The socket file read buffer only holds unread bytes
+    buffered = rbuf.getvalue()
+    rbuf.seek(0)
+    rbuf.truncate()
+    return sock, http_response, buffered
+
+
+def iter_response(response, buffer_size=BUFFER_SIZE, watchdog=None):
+    """Yield the body of an urllib2 response by chunks
+
+    When possible the bytes are received with recv_into in a single
+    preallocated buffer that is filled before being yielded. Fall back on
+    regular reads otherwise (e.g. chunked transfer encoding).
+
+    If given, the watchdog, a nxdrive.client.timeouts.ReadWatchdog
+    instance, is updated after each read to abort the stalled transfers.
+    """
+    raw = _get_raw_socket(response)
+    if raw is None:
+        log.trace("Falling back to allocating reads for %r", response)
+        while True:
+            data = response.read(buffer_size)
+            if watchdog is not None:
+                watchdog.update(len(data))
+            if not data:
+                break
+            yield data
+        return
+
+    sock, http_response, buffered = raw
+    buffer_ = bytearray(buffer_size)
+    view = memoryview(buffer_)
+    while buffered:
+        # Bytes read ahead by httplib
+        chunk, buffered = buffered[:buffer_size], buffered[buffer_size:]
+        http_response.length -= len(chunk)
+        if watchdog is not None:
+            watchdog.update(len(chunk))
+        view[:len(chunk)] = chunk
+        yield view[:len(chunk)]
+    while http_response.length > 0:
+        filled = 0
+        to_fill = min(http_response.length, buffer_size)
+        while filled < to_fill:
+            n = sock.recv_into(view[filled:to_fill])
+            if watchdog is not None:
+                watchdog.update(n)
+            if n == 0:
+                # Connection closed before the end of the body
+                http_response.close()
+                raise httplib.IncompleteRead(
+                    '', http_response.length - filled)
+            filled += n
+        http_response.length -= filled
+        yield view[:filled]
+    http_response.close()
+
+
+class StreamWriter(object):
+    """Write a streamed download to a file
+
+    The file is preallocated when its size is known. Written ranges are
+    handed over to the kernel writeback as they are completed and dropped
+    from the page cache, so that big downloads do not evict the working set
+    of the user.
+
+    The durability policy tells whether the file is fsynced on close, see
+    the DURABILITY_* constants. The parent directory is to be fsynced by
+    the caller after renaming the file with DURABILITY_FSYNC_DIR.
+    """
+
+    def __init__(self, path, size=None, durability=DURABILITY_NONE,
+                 window=WRITEBACK_WINDOW):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError("Unknown durability policy %r, expected one of"
+                             " %r" % (durability, DURABILITY_POLICIES))
+        self.path = path
+        self.durability = durability
+        self.window = window
+        self.written = 0
+        self._flushed = 0
+        self._file = io.open(path, 'wb', buffering=0)
+        self.preallocated = (size is not None
+                             and preallocate(self._file, size))
+        advise(self._file, POSIX_FADV_SEQUENTIAL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        # Unbuffered raw file: make sure that everything is written
+        view = memoryview(data)
+        while view:
+            n = self._file.write(view)
+            view = view[n:]
+            self.written += n
+        if self.written - self._flushed >= self.window:
+            self._writeback()
+
+    def _writeback(self):
+        sync_file_range = _LIBC.get('sync_file_range')
+        if sync_file_range is None:
+            return
+        fd = self._file.fileno()
+        start, length = self._flushed, self.written - self._flushed
+        # Start the asynchronous writeback of the new range
+        sync_file_range(fd, start, length, SYNC_FILE_RANGE_WRITE)
+        if start > 0:
+            # Wait for the previous range to be written: its clean pages
+            # can be dropped from the page cache
+            previous = max(0, start - self.window)
+            sync_file_range(fd, previous, start - previous,
+                            SYNC_FILE_RANGE_WAIT_BEFORE
+                            | SYNC_FILE_RANGE_WRITE
+                            | SYNC_FILE_RANGE_WAIT_AFTER)
+            advise(self._file, POSIX_FADV_DONTNEED, previous,
+                   start - previous)
+        self._flushed = self.written
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if self.preallocated:
+                # Do not leave preallocated bytes after an incomplete
+                # download
+                self._file.truncate(self.written)
+            if self.durability != DURABILITY_NONE:
+                os.fsync(self._file.fileno())
+            advise(self._file, POSIX_FADV_DONTNEED)
+        finally:
+            self._file.close()
@@ -0,0 +1,179 @@
+"""Bandwidth and request rate limiting for the remote clients."""
+
+import time
+from datetime import datetime
+from threading import RLock
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class TokenBucket(object):
+    """Thread safe token bucket
+
+    rate is the number of tokens (bytes or requests) refilled per second. A
+    rate of None or 0 means no limit. burst is the maximum number of tokens
+    that can be accumulated while idle, it defaults to one second worth of
+    tokens.
+
+    Consuming more tokens than available puts the bucket in debt: the caller
+    sleeps long enough for the debt to be refilled. This makes it possible to
+    consume chunks bigger than the burst size (e.g. a 1MB download buffer with
+    a 100KB/s limit).
+    """
+
+    def __init__(self, rate=None, burst=None, clock=time.time,
+                 sleep=time.sleep):
+        self._lock = RLock()
+        self._clock = clock
+        self._sleep = sleep
+        self.rate = None
+        self.burst = None
+        self._tokens = 0.0
+        self._last = clock()
+        self.set_rate(rate, burst=burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate of the bucket: effective for the next consume"""
+        with self._lock:
+            rate = float(rate) if rate else None
+            if rate is None:
+                burst = None
+            elif burst is None:
+                burst = rate
+            self._refill()
+            previous_rate = self.rate
+            self.rate = rate
+            self.burst = float(burst) if burst is not None else None
+            if self.burst is None:
+                self._tokens = 0.0
+            elif previous_rate is None:
+                # Start with a full bucket
+                self._tokens = self.burst
+            else:
+                self._tokens = min(self._tokens, self.burst)
+
+    def is_limited(self):
+        return self.rate is not None
+
+    def consume(self, amount=1):
+        """Take amount tokens from the bucket, sleeping if needed
+
+        Return the time spent sleeping in seconds.
+        """
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            delay = -self._tokens / self.rate
+        # Sleep outside of the lock: concurrent consumers are already
+        # accounted for by the debt
+        self._sleep(delay)
+        return delay
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(0.0, now - self._last)
+        self._last = now
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+
+def parse_schedule(schedule):
+    """Parse a 'HH:MM-HH:MM' time of day range into a pair of minute counts
+
+    The range can wrap over midnight, e.g. '22:00-06:00'. Return None for an
+    empty schedule.
+    """
+    if not schedule:
+        return None
+    try:
+        start, end = schedule.split('-')
+        bounds = []
+        for bound in (start, end):
+            hours, minutes = bound.strip().split(':')
+            hours, minutes = int(hours), int(minutes)
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                raise ValueError(bound)
+            bounds.append(hours * 60 + minutes)
+    except ValueError:
+        raise ValueError("Invalid schedule %r: expected format is"
+                         " 'HH:MM-HH:MM'" % schedule)
+    return tuple(bounds)
+
+
+def in_schedule(schedule_bounds, now=None):
+    """Check whether now is in the parsed schedule range"""
+    if schedule_bounds is None:
+        return True
+    now = datetime.now() if now is None else now
+    start, end = schedule_bounds
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    # Range wrapping over midnight
+    return minute >= start or minute < end
+
+
+class Throttle(object):
+    """Upload, download and request rate limits shared by remote clients
+
+    Rates are expressed in bytes per second for the transfers and in
+    requests per second for the Automation calls. None means no limit.
+
+    If a schedule is provided, the limits only apply during this time of day
+    range, e.g. '08:00-18:00' for office hours.
+
+    The limits can be changed at runtime with configure: the new rates are
+    taken into account by the transfers in progress.
+    """
+
+    def __init__(self, upload_rate=None, download_rate=None,
+                 request_rate=None, schedule=None, clock=time.time,
+                 sleep=time.sleep):
+        self.upload_bucket = TokenBucket(clock=clock, sleep=sleep)
+        self.download_bucket = TokenBucket(clock=clock, sleep=sleep)
+        self.request_bucket = TokenBucket(clock=clock, sleep=sleep)
+        self.schedule = None
+        self._schedule_bounds = None
+        self.configure(upload_rate=upload_rate, download_rate=download_rate,
+                       request_rate=request_rate, schedule=schedule)
+
+    def configure(self, upload_rate=None, download_rate=None,
+                  request_rate=None, schedule=None):
+        schedule_bounds = parse_schedule(schedule)
+        if (upload_rate != self.upload_bucket.rate
+            or download_rate != self.download_bucket.rate
+            or request_rate != self.request_bucket.rate
+            or schedule != self.schedule):
+            log.debug("Setting transfer limits: upload=%r B/s,"
+                      " download=%r B/s, requests=%r/s, schedule=%r",
+                      upload_rate, download_rate, request_rate, schedule)
+        self.upload_bucket.set_rate(upload_rate)
+        self.download_bucket.set_rate(download_rate)
+        # Allow a single request at once for the Automation calls
+        self.request_bucket.set_rate(request_rate, burst=1)
+        self.schedule = schedule
+        self._schedule_bounds = schedule_bounds
+
+    def is_active(self, now=None):
+        return in_schedule(self._schedule_bounds, now=now)
+
+    def upload(self, n_bytes):
+        if self.is_active():
+            return self.upload_bucket.consume(n_bytes)
+        return 0.0
+
+    def download(self, n_bytes):
+        if self.is_active():
+            return self.download_bucket.consume(n_bytes)
+        return 0.0
+
+    def request(self):
+        if self.is_active():
+            return self.request_bucket.consume(1)
+        return 0.0
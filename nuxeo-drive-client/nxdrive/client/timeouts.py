@@ -0,0 +1,194 @@
+"""Adaptive timeouts of the requests to the servers.
+
+The latency and the throughput of the link to each server are estimated
+from the completed requests. As for the TCP retransmission timeout, a
+request times out after the smoothed latency plus four times its
+variation, plus the expected transfer time of its payload at the
+estimated throughput: a slow but healthy link gets longer timeouts, a
+fast one detects failures sooner.
+
+The socket timeout only bounds each blocking read or write. A transfer
+trickling a few bytes at a time is detected by the ReadWatchdog of the
+streaming loops. The time spent waiting for the bandwidth limits is not
+counted against the watchdog: the limits can change during a transfer.
+"""
+
+import socket
+import time
+from threading import Lock
+
+
+# Upper bound of the latency part of the timeouts in seconds
+MAX_LATENCY_TIMEOUT = 300
+
+# Minimum timeout of the blob transfers in seconds: the server can take a
+# while to start streaming a blob (e.g. from a remote binary store)
+MIN_BLOB_TIMEOUT = 60
+
+# Throughput assumed before the first transfer, in bytes per second
+DEFAULT_THROUGHPUT = 32 * 1024
+
+# Transfers smaller than this are dominated by the latency and do not give
+# a throughput estimate
+MIN_THROUGHPUT_SAMPLE_SIZE = 64 * 1024
+
+# Expected transfer times are multiplied by this factor: a transfer is only
+# aborted if the link gets much slower than usual
+TRANSFER_TIME_FACTOR = 4
+
+# Smoothing factors of RFC 6298
+LATENCY_ALPHA = 0.125
+LATENCY_BETA = 0.25
+THROUGHPUT_ALPHA = 0.25
+
+
+class TransferTimeout(socket.timeout):
+    """Raised when a transfer stalls or lasts much longer than expected"""
+
+
+class _LinkEstimate(object):
+
+    def __init__(self):
+        self.latency = None
+        self.latency_variation = None
+        self.download_rate = None
+        self.upload_rate = None
+        # Size of the last response of each operation
+        self.response_sizes = {}
+
+
+class LinkStats(object):
+    """Latency and throughput estimates of the links to the servers
+
+    Thread safe: can be shared by all the clients of a process. The
+    estimates are exponentially weighted moving averages of the response
+    times and of the transfer rates of each server URL.
+    """
+
+    def __init__(self):
+        self._links = {}
+        self._lock = Lock()
+
+    def _get_link(self, server_url):
+        link = self._links.get(server_url)
+        if link is None:
+            link = self._links[server_url] = _LinkEstimate()
+        return link
+
+    def record_latency(self, server_url, latency):
+        """Record the time a server took to send the response headers"""
+        with self._lock:
+            link = self._get_link(server_url)
+            if link.latency is None:
+                link.latency = latency
+                link.latency_variation = latency / 2.0
+            else:
+                link.latency_variation = (
+                    (1 - LATENCY_BETA) * link.latency_variation
+                    + LATENCY_BETA * abs(link.latency - latency))
+                link.latency = ((1 - LATENCY_ALPHA) * link.latency
+                                + LATENCY_ALPHA * latency)
+
+    def record_transfer(self, server_url, n_bytes, duration, upload=False):
+        """Record a transfer of n_bytes, complete or not, in duration"""
+        if n_bytes < MIN_THROUGHPUT_SAMPLE_SIZE or duration <= 0:
+            return
+        rate = float(n_bytes) / duration
+        attribute = 'upload_rate' if upload else 'download_rate'
+        with self._lock:
+            link = self._get_link(server_url)
+            previous_rate = getattr(link, attribute)
+            if previous_rate is not None:
+                rate = ((1 - THROUGHPUT_ALPHA) * previous_rate
+                        + THROUGHPUT_ALPHA * rate)
+            setattr(link, attribute, rate)
+
+    def record_response_size(self, server_url, command, size):
+        with self._lock:
+            self._get_link(server_url).response_sizes[command] = size
+
+    def get_response_size(self, server_url, command):
+        """Return the size of the last response to command, or 0"""
+        with self._lock:
+            link = self._links.get(server_url)
+            if link is None:
+                return 0
+            return link.response_sizes.get(command, 0)
+
+    def get_throughput(self, server_url, upload=False):
+        with self._lock:
+            link = self._links.get(server_url)
+            rate = None
+            if link is not None:
+                rate = link.upload_rate if upload else link.download_rate
+        return rate if rate is not None else DEFAULT_THROUGHPUT
+
+    def get_timeout(self, server_url, size=0, upload=False, min_timeout=0):
+        """Return the timeout of a request transferring size bytes
+
+        The latency part is at least min_timeout.
+        """
+        with self._lock:
+            link = self._links.get(server_url)
+            latency_timeout = min_timeout
+            if link is not None and link.latency is not None:
+                latency_timeout = max(
+                    min_timeout,
+                    link.latency + 4 * link.latency_variation)
+        latency_timeout = min(latency_timeout,
+                              max(min_timeout, MAX_LATENCY_TIMEOUT))
+        transfer_time = (float(size) / self.get_throughput(server_url,
+                                                           upload=upload)
+                         * TRANSFER_TIME_FACTOR)
+        return latency_timeout + transfer_time
+
+
+class ReadWatchdog(object):
+    """Detect the stalled transfers in a streaming loop
+
+    update is called for each chunk of the transfer: TransferTimeout is
+    raised if no chunk was transferred for idle_timeout seconds, or if
+    the transfer lasts beyond the deadline time.
+
+    The time spent sleeping for the bandwidth limits is given to pause: it
+    postpones the deadline and is not counted as idle time.
+    """
+
+    def __init__(self, idle_timeout, deadline=None, clock=time.time):
+        self.idle_timeout = idle_timeout
+        self.deadline = deadline
+        self._clock = clock
+        self.start_time = self.last_progress = clock()
+        self.n_bytes = 0
+        self.paused_time = 0.0
+
+    def get_duration(self):
+        """Return the duration of the transfer, pauses excluded"""
+        return self._clock() - self.start_time - self.paused_time
+
+    def pause(self, duration):
+        """Exclude duration seconds of throttling from the timeouts"""
+        if not duration:
+            return
+        self.paused_time += duration
+        self.last_progress += duration
+        if self.deadline is not None:
+            self.deadline += duration
+
+    def update(self, n_bytes):
+        now = self._clock()
+        if (self.idle_timeout is not None
+            and now - self.last_progress > self.idle_timeout):
+            raise TransferTimeout("Transfer stalled for %0.1fs after %d"
+                                  " bytes" % (now - self.last_progress,
+                                              self.n_bytes))
+        if self.deadline is not None and now > self.deadline:
+            raise TransferTimeout("Transfer too slow: only %d bytes in"
+                                  " %0.1fs" % (self.n_bytes,
+                                               now - self.start_time))
+        self.n_bytes += n_bytes
+        self.last_progress = now
+
+
+# Shared by the clients that are not given one
+DEFAULT_LINK_STATS = LinkStats()
@@ -0,0 +1,819 @@
+"""Non-blocking HTTP transport driven by an event loop.
+
+A single thread multiplexes the HTTP/1.1 connections of many requests in
+flight with select, instead of blocking a thread per request as urllib2
+does. Requests are submitted from any thread and return a Future.
+
+The connections are kept alive and reused, up to max_connections by server:
+the requests beyond are queued. Plain HTTP and TLS are supported, proxies
+are not: the clients fall back on their synchronous API in that case.
+
+A request failing on a kept alive connection before its response started
+is sent again on a new connection, unless it is not idempotent: the server
+may have processed it already.
+
+The callbacks of the futures are called by the event loop thread: they must
+not block. The blocking work, e.g. writing a downloaded body to the disk, is
+handed over to the small WorkerPool of the transport. A sink that cannot
+keep up stops the reading of its connection until it is drained.
+"""
+
+import errno
+import httplib
+import select
+import socket
+import ssl
+import sys
+import time
+from collections import deque
+from cStringIO import StringIO
+from Queue import Queue
+from threading import Condition
+from threading import Lock
+from threading import Thread
+from urlparse import urlparse
+from nxdrive.client.common import BUFFER_SIZE
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Maximum number of connections to a server: far below the FD_SETSIZE limit
+# of select
+DEFAULT_MAX_CONNECTIONS = 32
+
+# Number of threads running the blocking tasks of the sinks
+DEFAULT_MAX_WORKERS = 4
+
+# Idle keep-alive connections are closed after this delay in seconds
+IDLE_CONNECTION_TIMEOUT = 30
+
+# Maximum delay in seconds between two checks of the timeouts
+SWEEP_INTERVAL = 0.5
+
+# Maximum size of the response headers
+MAX_HEADERS_SIZE = 64 * 1024
+
+_CONNECTING_ERRORS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                      getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+_RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Methods of the requests that can be sent again after a failure
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+class Future(object):
+    """Result of an asynchronous call
+
+    result and exception block until the call is done or the timeout in
+    seconds expires.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        with self._condition:
+            return self._done
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise socket.timeout("Future not done after %ss" % timeout)
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, callback):
+        """Call callback with the future once done"""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exc_info=None):
+        """Fail with exc_info, or the exception being handled"""
+        self._set(None, exc_info or sys.exc_info())
+
+    def _set(self, result, exc_info):
+        with self._condition:
+            if self._done:
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.error("Error in the callback of %r", self, exc_info=True)
+
+
+def completed_future(function, *args, **kwargs):
+    """Run a function right away, return a done Future of its result"""
+    future = Future()
+    try:
+        future.set_result(function(*args, **kwargs))
+    except Exception:
+        future.set_exception()
+    return future
+
+
+def chain(future, function):
+    """Return the Future of function called with the result of future
+
+    function can return a value or another Future.
+    """
+    chained = Future()
+
+    def on_result(result):
+        if isinstance(result, Future):
+            result.add_done_callback(forward)
+        else:
+            chained.set_result(result)
+
+    def forward(done):
+        if done._exc_info is not None:
+            chained.set_exception(done._exc_info)
+        else:
+            chained.set_result(done._result)
+
+    def on_done(done):
+        if done._exc_info is not None:
+            chained.set_exception(done._exc_info)
+            return
+        try:
+            on_result(function(done._result))
+        except Exception:
+            chained.set_exception()
+
+    future.add_done_callback(on_done)
+    return chained
+
+
+class Response(object):
+    """Response of a request
+
+    headers is a httplib.HTTPMessage. body is the raw body (not decoded),
+    or None if the body was written to the sink of the request. latency is
+    the time in seconds taken by the response headers.
+    """
+
+    def __init__(self, url, status, reason, headers, latency):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.latency = latency
+        self.body = None
+
+    def info(self):
+        # Same as urllib2 responses, e.g. for cookielib
+        return self.headers
+
+
+class Request(object):
+    """HTTP request to submit to the transport
+
+    timeout is the maximum delay in seconds without any data exchanged with
+    the server. If sink_factory is given, it is called with the Response
+    once its headers are received, and must return a file like object the
+    body is written to: the transport closes it. If the sink has an is_full
+    method, the connection is not read while it returns True: the sink
+    calls wake on the transport once it can take more data.
+
+    idempotent tells whether the request can be sent again after a failure,
+    it defaults to True for the IDEMPOTENT_METHODS only: e.g. the POST of
+    an Automation operation without side effect can set it.
+    """
+
+    def __init__(self, url, method='GET', headers=None, body=None,
+                 timeout=None, sink_factory=None, idempotent=None):
+        self.url = url
+        self.method = method
+        self.headers = headers if headers is not None else {}
+        self.body = body
+        self.timeout = timeout
+        self.sink_factory = sink_factory
+        parsed = urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.future = Future()
+        self.idempotent = (method in IDEMPOTENT_METHODS if idempotent is None
+                           else idempotent)
+        self.retried = False
+
+    @property
+    def key(self):
+        return self.scheme, self.host, self.port
+
+    def to_bytes(self):
+        host = self.host if self.port in (80, 443) else '%s:%d' % (
+            self.host, self.port)
+        lines = ['%s %s HTTP/1.1' % (self.method, self.path),
+                 'Host: %s' % host]
+        body = self.body or ''
+        headers = dict(self.headers)
+        if body or self.method not in ('GET', 'HEAD'):
+            headers['Content-Length'] = str(len(body))
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        data = '\r\n'.join(lines) + '\r\n\r\n'
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data + body
+
+
+# States of the connections
+_CONNECTING = 'connecting'
+_HANDSHAKE = 'handshake'
+_SENDING = 'sending'
+_RECEIVING = 'receiving'
+_IDLE = 'idle'
+
+
+class _Connection(object):
+    """Non-blocking HTTP/1.1 connection to a server"""
+
+    def __init__(self, key, address, ssl_context=None):
+        self.key = key
+        self.sock = socket.socket(address[0], socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.ssl_context = ssl_context
+        self.state = _CONNECTING
+        self.want_write = True
+        self.last_activity = time.time()
+        self.request = None
+        self.sink = None
+        self.reused = False
+        result = self.sock.connect_ex(address[4])
+        if result not in (0,) + _CONNECTING_ERRORS:
+            self.sock.close()
+            raise socket.error(result, "Could not connect to %s:%s"
+                               % key[1:])
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def is_paused(self):
+        """Tell whether the sink of the response cannot take more data"""
+        is_full = getattr(self.sink, 'is_full', None)
+        return is_full is not None and is_full()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def start(self, request):
+        self.request = request
+        self.out = request.to_bytes()
+        self.buffer = ''
+        self.response = None
+        self.sink = None
+        self.body_parts = []
+        self.chunk_left = None
+        self.content_left = None
+        self.keep_alive = False
+        self.start_time = self.last_activity = time.time()
+        if self.state == _IDLE:
+            self.reused = True
+            self.state = _SENDING
+            self.want_write = True
+
+    # Event handlers: return True once the response is complete
+
+    def on_writable(self):
+        self.last_activity = time.time()
+        if self.state == _CONNECTING:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, "Could not connect to %s:%s"
+                                   % self.key[1:])
+            if self.ssl_context is not None:
+                self.sock = self.ssl_context.wrap_socket(
+                    self.sock, server_hostname=self.key[1],
+                    do_handshake_on_connect=False)
+                self.state = _HANDSHAKE
+                return self._handshake()
+            self.state = _SENDING
+        if self.state == _HANDSHAKE:
+            return self._handshake()
+        if self.state == _SENDING:
+            try:
+                sent = self.sock.send(self.out[:BUFFER_SIZE])
+            except ssl.SSLWantWriteError:
+                return False
+            except socket.error as e:
+                if e.args[0] in _RETRY_ERRORS:
+                    return False
+                raise
+            self.out = self.out[sent:]
+            if not self.out:
+                self.state = _RECEIVING
+                self.want_write = False
+        return False
+
+    def _handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want_write = False
+            return False
+        except ssl.SSLWantWriteError:
+            self.want_write = True
+            return False
+        self.state = _SENDING
+        self.want_write = True
+        return False
+
+    def on_readable(self):
+        self.last_activity = time.time()
+        if self.state == _HANDSHAKE:
+            return self._handshake()
+        data = self._recv()
+        if data is None:
+            return False
+        if self.state == _IDLE:
+            # Closed by the server, or unexpected data
+            raise socket.error(errno.ECONNRESET, "Idle connection closed")
+        if not data:
+            return self._on_close()
+        self.buffer += data
+        if self.response is None and not self._parse_headers():
+            return False
+        return self._parse_body()
+
+    def _recv(self):
+        try:
+            data = self.sock.recv(BUFFER_SIZE)
+            if isinstance(self.sock, ssl.SSLSocket):
+                # Decrypted bytes already buffered are not signaled by
+                # select
+                while self.sock.pending():
+                    data += self.sock.recv(self.sock.pending())
+            return data
+        except ssl.SSLWantReadError:
+            return None
+        except socket.error as e:
+            if e.args[0] in _RETRY_ERRORS:
+                return None
+            raise
+
+    def _on_close(self):
+        if self.response is not None and self.content_left is None \
+                and self.chunk_left is None:
+            # Body delimited by the end of the connection
+            self.keep_alive = False
+            return True
+        raise httplib.IncompleteRead(self.buffer)
+
+    def _parse_headers(self):
+        end = self.buffer.find('\r\n\r\n')
+        if end < 0:
+            if len(self.buffer) > MAX_HEADERS_SIZE:
+                raise httplib.HTTPException("Response headers too big")
+            return False
+        head, self.buffer = self.buffer[:end], self.buffer[end + 4:]
+        status_line, _, header_lines = head.partition('\r\n')
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise httplib.BadStatusLine(status_line)
+        version, status = parts[0], int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+        headers = httplib.HTTPMessage(StringIO(header_lines + '\r\n\r\n'))
+        request = self.request
+        self.response = Response(request.url, status, reason, headers,
+                                 time.time() - self.start_time)
+        connection = headers.get('Connection', '').lower()
+        self.keep_alive = (version == 'HTTP/1.1' and connection != 'close'
+                           or connection == 'keep-alive')
+        if (request.method == 'HEAD' or status in (204, 304)
+            or 100 <= status < 200):
+            self.content_left = 0
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            self.chunk_left = -1
+        elif headers.get('Content-Length') is not None:
+            self.content_left = int(headers['Content-Length'])
+        else:
+            self.keep_alive = False
+        if status == 200 and request.sink_factory is not None:
+            self.sink = request.sink_factory(self.response)
+        return True
+
+    def _write_body(self, data):
+        if not data:
+            return
+        if self.sink is not None:
+            self.sink.write(data)
+        else:
+            self.body_parts.append(data)
+
+    def _parse_body(self):
+        if self.chunk_left is not None:
+            return self._parse_chunks()
+        if self.content_left is None:
+            data, self.buffer = self.buffer, ''
+            self._write_body(data)
+            return False
+        data = self.buffer[:self.content_left]
+        self.buffer = self.buffer[self.content_left:]
+        self.content_left -= len(data)
+        self._write_body(data)
+        return self.content_left == 0
+
+    def _parse_chunks(self):
+        while True:
+            if self.chunk_left > 0:
+                data = self.buffer[:self.chunk_left]
+                self.buffer = self.buffer[self.chunk_left:]
+                self.chunk_left -= len(data)
+                self._write_body(data)
+                if self.chunk_left > 0:
+                    return False
+                # End of the chunk data
+                self.chunk_left = -2
+            line_end = self.buffer.find('\r\n')
+            if line_end < 0:
+                return False
+            line, self.buffer = (self.buffer[:line_end],
+                                 self.buffer[line_end + 2:])
+            if self.chunk_left == -2:
+                # CRLF after the chunk data
+                self.chunk_left = -1
+                continue
+            if self.chunk_left == -3:
+                # Trailers until an empty line
+                if not line:
+                    self.chunk_left = None
+                    self.content_left = 0
+                    return True
+                continue
+            size = int(line.split(';', 1)[0].strip(), 16)
+            self.chunk_left = size if size > 0 else -3
+
+    def finish(self):
+        """Return the complete response and make the connection idle"""
+        response = self.response
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+        else:
+            response.body = ''.join(self.body_parts)
+        self.request = self.response = None
+        self.body_parts = []
+        self.state = _IDLE
+        self.want_write = False
+        self.last_activity = time.time()
+        return response
+
+    def abort(self):
+        if self.sink is not None:
+            try:
+                self.sink.close()
+            except Exception:
+                log.debug("Could not close the sink of %r", self,
+                          exc_info=True)
+            self.sink = None
+        self.close()
+
+
+class _Waker(object):
+    """Wake up the event loop waiting in select"""
+
+    def __init__(self):
+        if hasattr(socket, 'socketpair'):
+            self._reader, self._writer = socket.socketpair()
+        else:
+            # Windows
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self._writer = socket.create_connection(listener.getsockname())
+            self._reader = listener.accept()[0]
+            listener.close()
+        self._reader.setblocking(0)
+        self._writer.setblocking(0)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def wake(self):
+        try:
+            self._writer.send('x')
+        except socket.error:
+            # Already awake
+            pass
+
+    def consume(self):
+        try:
+            while self._reader.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class WorkerPool(object):
+    """Threads running the blocking tasks handed over by the event loop
+
+    The tasks are run in submission order by up to max_workers daemon
+    threads, started on demand.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS,
+                 name='TransportWorker'):
+        self.max_workers = max_workers
+        self.name = name
+        self._tasks = Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, function, *args):
+        self._tasks.put((function, args))
+        with self._lock:
+            if len(self._threads) < self.max_workers:
+                thread = Thread(target=self._run, name='%s-%d' % (
+                    self.name, len(self._threads)))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+    def stop(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                log.error("Error in a task of %s", self.name, exc_info=True)
+
+
+class EventLoopTransport(object):
+    """Send HTTP requests concurrently from a single event loop thread
+
+    The thread is started by the first request. Thread safe: can be shared
+    by all the clients of a process. requests counts the submitted
+    requests. workers is the WorkerPool of the blocking tasks of the
+    sinks.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 ssl_context=None, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_connections = max_connections
+        self._ssl_context = ssl_context
+        self.workers = WorkerPool(max_workers)
+        self.requests = 0
+        self._lock = Lock()
+        self._submitted = deque()
+        self._waker = None
+        self._thread = None
+        self._stopped = False
+        # Requests waiting for a connection by server
+        self._queued = {}
+        # Connections by server, and the idle ones
+        self._connections = {}
+        self._idle = {}
+        self._addresses = {}
+
+    def submit(self, request):
+        """Send a Request, return the Future of its Response"""
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Transport stopped")
+            if self._thread is None:
+                self._waker = _Waker()
+                self._thread = Thread(target=self._run,
+                                      name='EventLoopTransport')
+                self._thread.daemon = True
+                self._thread.start()
+            self.requests += 1
+            self._submitted.append(request)
+        self._waker.wake()
+        return request.future
+
+    def wake(self):
+        """Wake the event loop up, e.g. when a full sink was drained"""
+        with self._lock:
+            waker = self._waker
+        if waker is not None:
+            waker.wake()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+        if thread is not None:
+            self._waker.wake()
+            thread.join()
+        self.workers.stop()
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                self._poll()
+        finally:
+            self._close_all()
+
+    def _poll(self):
+        with self._lock:
+            submitted, self._submitted = self._submitted, deque()
+        for request in submitted:
+            self._queued.setdefault(request.key, deque()).append(request)
+            self._dispatch(request.key)
+
+        connections = [connection
+                       for connections in self._connections.values()
+                       for connection in connections]
+        # The connections of the full sinks are not read
+        readers = [self._waker] + [c for c in connections
+                                   if not c.want_write
+                                   and not c.is_paused()]
+        writers = [c for c in connections if c.want_write]
+        try:
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  SWEEP_INTERVAL)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for connection in writable:
+            self._handle(connection, connection.on_writable)
+        for connection in readable:
+            if connection is self._waker:
+                connection.consume()
+            elif connection.key in self._connections:
+                self._handle(connection, connection.on_readable)
+        self._sweep()
+
+    def _dispatch(self, key):
+        """Start the queued requests of a server on the available
+        connections"""
+        queued = self._queued.get(key)
+        while queued:
+            idle = self._idle.get(key)
+            if idle:
+                connection = idle.pop()
+            elif len(self._connections.get(key, ())) < self.max_connections:
+                request = queued[0]
+                try:
+                    connection = self._connect(request)
+                except Exception:
+                    queued.popleft()
+                    request.future.set_exception()
+                    continue
+                self._connections.setdefault(key, []).append(connection)
+            else:
+                return
+            connection.start(queued.popleft())
+
+    def _connect(self, request):
+        address = self._addresses.get(request.key)
+        if address is None:
+            # Blocking, only once by server
+            address = socket.getaddrinfo(request.host, request.port, 0,
+                                         socket.SOCK_STREAM)[0]
+            self._addresses[request.key] = address
+        ssl_context = None
+        if request.scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        return _Connection(request.key, address, ssl_context=ssl_context)
+
+    def _handle(self, connection, handler):
+        request = connection.request
+        try:
+            complete = handler()
+        except Exception:
+            exc_info = sys.exc_info()
+            self._remove(connection)
+            connection.abort()
+            if request is None:
+                # Idle connection closed by the server
+                return
+            if (connection.reused and connection.response is None
+                and request.idempotent and not request.retried):
+                # The server closed the kept alive connection before
+                # reading the request: send it again
+                log.trace("Retrying %s on a new connection", request.url)
+                request.retried = True
+                self._queued.setdefault(request.key,
+                                        deque()).appendleft(request)
+            else:
+                request.future.set_exception(exc_info)
+            self._dispatch(connection.key)
+            return
+        if not complete:
+            return
+        keep_alive = connection.keep_alive
+        try:
+            response = connection.finish()
+        except Exception:
+            request.future.set_exception()
+            keep_alive = False
+            response = None
+        if keep_alive:
+            self._idle.setdefault(connection.key, []).append(connection)
+        else:
+            self._remove(connection)
+            connection.close()
+        if response is not None:
+            request.future.set_result(response)
+        self._dispatch(connection.key)
+
+    def _remove(self, connection):
+        connections = self._connections.get(connection.key, [])
+        if connection in connections:
+            connections.remove(connection)
+        idle = self._idle.get(connection.key, [])
+        if connection in idle:
+            idle.remove(connection)
+
+    def _sweep(self):
+        """Abort the requests timing out, close the old idle connections"""
+        now = time.time()
+        for connections in self._connections.values():
+            for connection in list(connections):
+                request = connection.request
+                if request is None:
+                    if now - connection.last_activity > (
+                            IDLE_CONNECTION_TIMEOUT):
+                        self._remove(connection)
+                        connection.close()
+                    continue
+                if connection.is_paused():
+                    # Waiting for the sink, not for the server
+                    connection.last_activity = now
+                    continue
+                if (request.timeout is not None
+                    and now - connection.last_activity > request.timeout):
+                    self._remove(connection)
+                    connection.abort()
+                    try:
+                        raise socket.timeout("timed out")
+                    except socket.timeout:
+                        request.future.set_exception()
+                    self._dispatch(connection.key)
+
+    def _close_all(self):
+        error = RuntimeError("Transport stopped")
+        for connections in self._connections.values():
+            for connection in connections:
+                if connection.request is not None:
+                    connection.request.future.set_exception(
+                        (RuntimeError, error, None))
+                connection.abort()
+        for queued in self._queued.values():
+            for request in queued:
+                request.future.set_exception((RuntimeError, error, None))
+        with self._lock:
+            for request in self._submitted:
+                request.future.set_exception((RuntimeError, error, None))
+            self._submitted.clear()
+        self._connections.clear()
+        self._idle.clear()
+        self._queued.clear()
+        self._waker.close()
+
+
+# Shared by the clients that are not given one
+DEFAULT_TRANSPORT = EventLoopTransport()
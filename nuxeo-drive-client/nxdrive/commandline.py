@@ -13,6 +13,8 @@ except ImportError:
     debugger = pdb
 
 from nxdrive.controller import Controller
+from nxdrive.client.streaming import DURABILITY_NONE
+from nxdrive.client.streaming import DURABILITY_POLICIES
 from nxdrive.daemon import daemonize
 from nxdrive.controller import default_nuxeo_drive_folder
 from nxdrive.logging_config import configure
@@ -25,6 +27,7 @@ from nxdrive import __version__
 
 DEFAULT_NX_DRIVE_FOLDER = default_nuxeo_drive_folder()
 DEFAULT_DELAY = 5.0
+DEFAULT_MAX_DELAY = 30.0
 DEFAULT_MAX_SYNC_STEP = 10
 DEFAULT_HANDSHAKE_TIMEOUT = 60
 DEFAULT_TIMEOUT = 20
@@ -41,6 +44,7 @@ Possible commands:
 - unbind-server
 - bind-root
 - unbind-root
+- set-limits
 
 To get options for a specific command:
 
@@ -54,6 +58,11 @@ PROTOCOL_COMMANDS = {
 }
 
 
+def comma_separated_list(value):
+    """Parse a comma separated command line option value"""
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
 def make_cli_parser(add_subparsers=True):
     """Parse commandline arguments using a git-like subcommands scheme"""
 
@@ -87,6 +96,11 @@ def make_cli_parser(add_subparsers=True):
     common_parser.add_argument(
         "--delay", default=DEFAULT_DELAY, type=float,
         help="Delay in seconds between consecutive sync operations.")
+    common_parser.add_argument(
+        "--max-delay", default=DEFAULT_MAX_DELAY, type=float,
+        help="Maximum delay in seconds between consecutive sync operations:"
+        " the delay increases up to it while there is nothing to"
+        " synchronize.")
     common_parser.add_argument(
         "--max-sync-step", default=DEFAULT_MAX_SYNC_STEP, type=int,
         help="Number of consecutive sync operations to perform"
@@ -96,7 +110,28 @@ def make_cli_parser(add_subparsers=True):
         help="HTTP request timeout in seconds for the handshake.")
     common_parser.add_argument(
         "--timeout", default=DEFAULT_TIMEOUT, type=int,
-        help="HTTP request timeout in seconds for the sync Automation calls.")
+        help="Minimum HTTP request timeout in seconds for the sync Automation"
+             " calls, raised for slow servers and big responses.")
+    common_parser.add_argument(
+        "--durability", default=DURABILITY_NONE, choices=DURABILITY_POLICIES,
+        help="Durability of the downloaded files: 'fsync' flushes them to"
+        " disk before they are renamed, 'fsync_dir' also flushes their"
+        " folder after the renaming.")
+    common_parser.add_argument(
+        "--compress-requests", default=False, action="store_true",
+        help="Compress the big Automation requests: the server has to"
+        " support gzip encoded requests.")
+    common_parser.add_argument(
+        "--compressed-upload-types", default='', type=comma_separated_list,
+        help="Comma separated MIME type patterns of the files to upload"
+        " compressed when it is worth it, e.g. 'text/*,application/json'."
+        " The server has to support gzip encoded uploads.")
+    common_parser.add_argument(
+        "--full-scan-window", default=None, type=float,
+        help="Window in seconds over which the remote full scans of the"
+        " clients of a server are spread when the server has too many"
+        " changes, e.g. after a restart. Each client waits for its own"
+        " slot. 0 to scan right away.")
     common_parser.add_argument(
         # XXX: Make it true by default as the fault tolerant mode is not yet
         # implemented
@@ -189,6 +224,34 @@ def make_cli_parser(add_subparsers=True):
     unbind_root_parser.add_argument(
         "local_root", help="Local sub-folder to de-synchronize.")
 
+    # Limit the bandwidth and request rate of a server binding
+    set_limits_parser = subparsers.add_parser(
+        'set-limits',
+        help='Limit the bandwidth and request rate used to synchronize'
+        ' with a Nuxeo server. Omitted limits are removed.',
+        parents=[common_parser],
+    )
+    set_limits_parser.set_defaults(command='set_limits')
+    set_limits_parser.add_argument(
+        "--local-folder",
+        help="Local folder bound to a Nuxeo server with the 'bind-server'"
+        " command.",
+        default=DEFAULT_NX_DRIVE_FOLDER,
+    )
+    set_limits_parser.add_argument(
+        "--upload-rate", type=float,
+        help="Maximum upload bandwidth in KiB/s.")
+    set_limits_parser.add_argument(
+        "--download-rate", type=float,
+        help="Maximum download bandwidth in KiB/s.")
+    set_limits_parser.add_argument(
+        "--request-rate", type=float,
+        help="Maximum number of Automation requests per second.")
+    set_limits_parser.add_argument(
+        "--schedule",
+        help="Time of day range when the limits apply, e.g. 08:00-18:00."
+        " Limits always apply if omitted.")
+
     # Start / Stop the synchronization daemon
     start_parser = subparsers.add_parser(
         'start', help='Start the synchronization as a GUI-less daemon',
@@ -308,7 +371,12 @@ class CliHandler(object):
         if command != 'test':
             self.controller = Controller(options.nxdrive_home,
                                 handshake_timeout=options.handshake_timeout,
-                                timeout=options.timeout)
+                                timeout=options.timeout,
+                                durability=options.durability,
+                                compress_requests=options.compress_requests,
+                                upload_compression_types=(
+                                    options.compressed_upload_types),
+                                full_scan_window=options.full_scan_window)
 
         # Find the command to execute based on the
         handler = getattr(self, command, None)
@@ -354,20 +422,27 @@ class CliHandler(object):
 
         self.controller = Controller(options.nxdrive_home,
                             handshake_timeout=options.handshake_timeout,
-                            timeout=options.timeout)
+                            timeout=options.timeout,
+                            durability=options.durability,
+                            compress_requests=options.compress_requests,
+                            upload_compression_types=(
+                                options.compressed_upload_types),
+                            full_scan_window=options.full_scan_window)
         self._configure_logger(options)
         self.log.debug("Synchronization daemon started.")
         self.controller.synchronizer.loop(
             delay=getattr(options, 'delay', DEFAULT_DELAY),
             max_sync_step=getattr(options, 'max_sync_step',
-                                  DEFAULT_MAX_SYNC_STEP))
+                                  DEFAULT_MAX_SYNC_STEP),
+            max_delay=getattr(options, 'max_delay', DEFAULT_MAX_DELAY))
         return 0
 
     def console(self, options):
         self.controller.synchronizer.loop(
             delay=getattr(options, 'delay', DEFAULT_DELAY),
             max_sync_step=getattr(options, 'max_sync_step',
-                                  DEFAULT_MAX_SYNC_STEP))
+                                  DEFAULT_MAX_SYNC_STEP),
+            max_delay=getattr(options, 'max_delay', DEFAULT_MAX_DELAY))
         return 0
 
     def stop(self, options=None):
@@ -410,6 +485,18 @@ class CliHandler(object):
         self.controller.unbind_root(options.local_root)
         return 0
 
+    def set_limits(self, options):
+        upload_rate = download_rate = None
+        if options.upload_rate:
+            upload_rate = int(options.upload_rate * 1024)
+        if options.download_rate:
+            download_rate = int(options.download_rate * 1024)
+        self.controller.set_transfer_limits(
+            options.local_folder, upload_rate=upload_rate,
+            download_rate=download_rate, request_rate=options.request_rate,
+            schedule=options.schedule)
+        return 0
+
     def test(self, options):
         import nose
         # Monkeypatch nose usage message as it's complicated to include
@@ -452,6 +539,26 @@ class CliHandler(object):
             "nxdrive.tests.test_integration_versioning",
             "nxdrive.tests.test_integration_windows",
             "nxdrive.tests.test_synchronizer",
+            "nxdrive.tests.test_throttling",
+            "nxdrive.tests.test_streaming",
+            "nxdrive.tests.test_delta",
+            "nxdrive.tests.test_deduplication",
+            "nxdrive.tests.test_scheduling",
+            "nxdrive.tests.test_timeouts",
+            "nxdrive.tests.test_transport",
+            "nxdrive.tests.test_operation_chain",
+            "nxdrive.tests.test_change_notification",
+            "nxdrive.tests.test_change_summary",
+            "nxdrive.tests.test_bundled_upload",
+            "nxdrive.tests.test_archive_download",
+            "nxdrive.tests.test_compression",
+            "nxdrive.tests.test_operation_registry",
+            "nxdrive.tests.test_document_schemas",
+            "nxdrive.tests.test_parent_uid_cache",
+            "nxdrive.tests.test_paged_query",
+            "nxdrive.tests.test_single_flight",
+            "nxdrive.tests.test_conditional_listings",
+            "nxdrive.tests.test_retry",
         ]
         return 0 if nose.run(argv=argv) else 1
 
@@ -21,11 +21,20 @@ from nxdrive.client import LocalClient
 from nxdrive.client import RemoteFileSystemClient
 from nxdrive.client import RemoteDocumentClient
 from nxdrive.client.base_automation_client import get_proxies_for_handler
+from nxdrive.client.operation_registry import RegistryCache
+from nxdrive.client.response_cache import ResponseCache
+from nxdrive.client.single_flight import SingleFlight
+from nxdrive.client.timeouts import LinkStats
+from nxdrive.client.transport import EventLoopTransport
+from nxdrive.client.throttling import Throttle
+from nxdrive.client.throttling import parse_schedule
+from nxdrive.client.streaming import DURABILITY_NONE
 from nxdrive.client import NotFound
 from nxdrive.model import init_db
 from nxdrive.model import DeviceConfig
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
+from nxdrive.model import TransferLimits
 from nxdrive.synchronizer import Synchronizer
 from nxdrive.synchronizer import POSSIBLE_NETWORK_ERROR_TYPES
 from nxdrive.logging_config import get_logger
@@ -121,7 +130,9 @@ class Controller(object):
     remote_fs_client_factory = RemoteFileSystemClient
 
     def __init__(self, config_folder, echo=None, poolclass=None,
-                 handshake_timeout=60, timeout=20, page_size=None):
+                 handshake_timeout=60, timeout=20, page_size=None,
+                 durability=DURABILITY_NONE, compress_requests=False,
+                 upload_compression_types=(), full_scan_window=None):
         # Log the installation location for debug
         nxdrive_install_folder = os.path.dirname(nxdrive.__file__)
         nxdrive_install_folder = os.path.realpath(nxdrive_install_folder)
@@ -138,6 +149,25 @@ class Controller(object):
             echo = os.environ.get('NX_DRIVE_LOG_SQL', None) is not None
         self.handshake_timeout = handshake_timeout
         self.timeout = timeout
+        # Durability policy of the downloaded files
+        self.durability = durability
+        # gzip compression of the big Automation requests
+        self.compress_requests = compress_requests
+        # MIME type patterns of the files uploaded gzip compressed
+        self.upload_compression_types = upload_compression_types
+
+        # Operation registries of the servers, revalidated by each new
+        # remote client
+        self.registry_cache = RegistryCache(
+            os.path.join(self.config_folder, 'registry'))
+        # Coalesces the identical read requests of the threads
+        self.single_flight = SingleFlight()
+        # Remote listings revalidated with conditional requests
+        self.response_cache = ResponseCache()
+        # Latency and throughput of the servers, to adapt the timeouts
+        self.link_stats = LinkStats()
+        # Event loop of the asynchronous requests of the remote clients
+        self.transport = EventLoopTransport()
 
         # Handle connection to the local Nuxeo Drive configuration and
         # metadata sqlite database.
@@ -148,6 +178,10 @@ class Controller(object):
         self._local = local()
         self._client_cache_timestamps = dict()
 
+        # Bandwidth and request rate limits shared by all the threads,
+        # by server binding local folder
+        self._throttles = dict()
+
         self._remote_error = None
 
         device_config = self.get_device_config()
@@ -160,7 +194,8 @@ class Controller(object):
         self.proxy_exceptions = None
         self.refresh_proxies(device_config=device_config)
 
-        self.synchronizer = Synchronizer(self, page_size=page_size)
+        self.synchronizer = Synchronizer(self, page_size=page_size,
+                                         full_scan_window=full_scan_window)
 
         # Make all the automation client related to this controller
         # share cookies using threadsafe jar
@@ -429,7 +464,8 @@ class Controller(object):
         nxclient = self.remote_doc_client_factory(
             server_url, username, self.device_id, self.version,
             proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
-            password=password, timeout=self.handshake_timeout)
+            password=password, timeout=self.handshake_timeout,
+            registry_cache=self.registry_cache)
         token = nxclient.request_token()
         if token is not None:
             # The server supports token based identification: do not store the
@@ -506,7 +542,8 @@ class Controller(object):
                         proxies=self.proxies,
                         proxy_exceptions=self.proxy_exceptions,
                         token=binding.remote_token,
-                        timeout=self.timeout)
+                        timeout=self.timeout,
+                        registry_cache=self.registry_cache)
                 log.info("Revoking token for '%s' with account '%s'",
                          binding.server_url, binding.remote_user)
                 nxclient.revoke_token()
@@ -525,6 +562,8 @@ class Controller(object):
                  local_folder, binding.server_url, binding.remote_user)
         session.delete(binding)
         session.commit()
+        self._throttles.pop(local_folder, None)
+        self.synchronizer.signature_store.delete_all(local_folder)
 
     def unbind_all(self):
         """Unbind all server and revoke all tokens
@@ -570,7 +609,7 @@ class Controller(object):
         nxclient.unregister_as_root(remote_ref)
 
     def list_pending(self, limit=100, local_folder=None, ignore_in_error=None,
-                     session=None):
+                     session=None, offset=0):
         """List pending files to synchronize, ordered by path
 
         Ordering by path makes it possible to synchronize sub folders content
@@ -578,6 +617,8 @@ class Controller(object):
 
         If ingore_in_error is not None and is a duration in second, skip pair
         states that have recently triggered a synchronization error.
+
+        The offset makes it possible to page through the pending pairs.
         """
         if session is None:
             session = self.get_session()
@@ -608,7 +649,7 @@ class Controller(object):
             # Ensure that newly created local folders will be synchronized
             # before their children
             asc(LastKnownState.local_path)
-        ).limit(limit).all()
+        ).offset(offset).limit(limit).all()
 
     def next_pending(self, local_folder=None, session=None):
         """Return the next pending file to synchronize or None"""
@@ -638,7 +679,14 @@ class Controller(object):
                 self.version,
                 proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
                 password=sb.remote_password, token=sb.remote_token,
-                timeout=self.timeout, cookie_jar=self.cookie_jar)
+                timeout=self.timeout, cookie_jar=self.cookie_jar,
+                durability=self.durability,
+                compress_requests=self.compress_requests,
+                upload_compression_types=self.upload_compression_types,
+                registry_cache=self.registry_cache,
+                single_flight=self.single_flight,
+                response_cache=self.response_cache,
+                link_stats=self.link_stats, transport=self.transport)
             if client_cache_timestamp is None:
                 client_cache_timestamp = 0
                 self._client_cache_timestamps[cache_key] = 0
@@ -648,6 +696,9 @@ class Controller(object):
         # balancer affinity (e.g. AWSELB) are shared by all the automation
         # clients managed by a given controller
         remote_client.make_raise(self._remote_error)
+        # The client can be shared by several bindings to the same server
+        # with the same account: use the limits of the requested one
+        remote_client.set_throttle(self.get_throttle(sb))
         return remote_client
 
     def get_remote_doc_client(self, server_binding, repository='default',
@@ -659,7 +710,62 @@ class Controller(object):
             proxies=self.proxies, proxy_exceptions=self.proxy_exceptions,
             password=sb.remote_password, token=sb.remote_token,
             repository=repository, base_folder=base_folder,
-            timeout=self.timeout, cookie_jar=self.cookie_jar)
+            timeout=self.timeout, cookie_jar=self.cookie_jar,
+            throttle=self.get_throttle(sb),
+            registry_cache=self.registry_cache, link_stats=self.link_stats,
+            transport=self.transport)
+
+    def get_throttle(self, server_binding):
+        """Return the throttle shared by the clients of a server binding
+
+        The limits are refreshed from the binding's transfer limits so that
+        changes made by another process (e.g. the command line) are taken
+        into account by the running transfers without restarting.
+        """
+        sb = server_binding
+        throttle = self._throttles.get(sb.local_folder)
+        if throttle is None:
+            throttle = self._throttles.setdefault(sb.local_folder,
+                                                  Throttle())
+        limits = sb.transfer_limits
+        if limits is None:
+            throttle.configure()
+        else:
+            throttle.configure(upload_rate=limits.upload_rate,
+                               download_rate=limits.download_rate,
+                               request_rate=limits.request_rate,
+                               schedule=limits.schedule)
+        return throttle
+
+    def set_transfer_limits(self, local_folder, upload_rate=None,
+                            download_rate=None, request_rate=None,
+                            schedule=None):
+        """Limit the bandwidth and request rate of a server binding
+
+        Rates are in bytes per second for uploads and downloads and in
+        requests per second for Automation calls. None means no limit.
+        schedule is an optional 'HH:MM-HH:MM' time of day range outside of
+        which no limit is applied.
+
+        The new limits apply to the transfers in progress.
+        """
+        # Fail early on invalid schedules
+        parse_schedule(schedule)
+        session = self.get_session()
+        binding = self.get_server_binding(local_folder, raise_if_missing=True,
+                                          session=session)
+        limits = binding.transfer_limits
+        if limits is None:
+            limits = TransferLimits(binding.local_folder)
+            binding.transfer_limits = limits
+        limits.upload_rate = upload_rate
+        limits.download_rate = download_rate
+        limits.request_rate = request_rate
+        limits.schedule = schedule
+        session.commit()
+        log.info("Transfer limits of '%s' set to %r", binding.local_folder,
+                 limits)
+        return self.get_throttle(binding)
 
     def invalidate_client_cache(self, server_url=None):
         for key in self._client_cache_timestamps:
@@ -725,9 +831,11 @@ class Controller(object):
         self._remote_error = error
 
     def dispose(self):
-        """Release all database resources"""
+        """Release all database and network resources"""
+        self.synchronizer.stop_change_notifiers()
         self.get_session().close_all()
         self._engine.pool.dispose()
+        self.transport.stop()
 
     def _normalize_url(self, url):
         """Ensure that user provided url always has a trailing '/'"""
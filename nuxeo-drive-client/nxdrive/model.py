@@ -10,6 +10,7 @@ from sqlalchemy import Integer
 from sqlalchemy import Sequence
 from sqlalchemy import String
 from sqlalchemy import Boolean
+from sqlalchemy import Float
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -141,6 +142,46 @@ class ServerBinding(Base):
         return self.remote_password is None and self.remote_token is None
 
 
+class TransferLimits(Base):
+    """Bandwidth and request rate limits of a server binding
+
+    Stored in a dedicated table to keep the databases of previous Nuxeo Drive
+    client installations compatible. None means no limit.
+    """
+    __tablename__ = 'transfer_limits'
+
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
+                          primary_key=True)
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("transfer_limits", uselist=False,
+                        cascade="all, delete-orphan"))
+
+    # Bytes per second
+    upload_rate = Column(Integer)
+    download_rate = Column(Integer)
+
+    # Automation requests per second
+    request_rate = Column(Float)
+
+    # Optional time of day range for the limits, e.g. '08:00-18:00'
+    schedule = Column(String)
+
+    def __init__(self, local_folder, upload_rate=None, download_rate=None,
+                 request_rate=None, schedule=None):
+        self.local_folder = local_folder
+        self.upload_rate = upload_rate
+        self.download_rate = download_rate
+        self.request_rate = request_rate
+        self.schedule = schedule
+
+    def __repr__(self):
+        return ("TransferLimits<local_folder=%r, upload_rate=%r, "
+                "download_rate=%r, request_rate=%r, schedule=%r>") % (
+                    self.local_folder, self.upload_rate, self.download_rate,
+                    self.request_rate, self.schedule)
+
+
 class LastKnownState(Base):
     """Aggregate state aggregated from last collected events."""
     __tablename__ = 'last_known_states'
@@ -1,8 +1,10 @@
 """Handle synchronization logic."""
+import hashlib
 import re
 import os.path
+import random
 from time import time
-from time import sleep
+from threading import Event
 from datetime import datetime
 import urllib2
 import socket
@@ -15,6 +17,23 @@ from nxdrive.client import DEDUPED_BASENAME_PATTERN
 from nxdrive.client import safe_filename
 from nxdrive.client import NotFound
 from nxdrive.client import Unauthorized
+from nxdrive.client.remote_file_system_client import DOWNLOAD_TMP_FILE_PREFIX
+from nxdrive.client.remote_file_system_client import DOWNLOAD_TMP_FILE_SUFFIX
+from nxdrive.client.remote_file_system_client import BUNDLE_MAX_FILE_SIZE
+from nxdrive.client.change_notifier import DEFAULT_MAX_WAIT
+from nxdrive.client.change_notifier import ChangeNotifier
+from nxdrive.client.streaming import DURABILITY_FSYNC_DIR
+from nxdrive.client.streaming import fsync_directory
+from nxdrive.client.delta import DELTA_MIN_SIZE
+from nxdrive.client.delta import SignatureBuilder
+from nxdrive.client.delta import SignatureStore
+from nxdrive.client.retry import CircuitBreaker
+from nxdrive.client.retry import METADATA_OPERATIONS
+from nxdrive.client.retry import RetryPolicy
+from nxdrive.client.retry import TRANSFER_OPERATIONS
+from nxdrive.client.retry import get_retry_after
+from nxdrive.client.retry import get_retry_policy
+from nxdrive.client.retry import is_server_failure
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
 from nxdrive.logging_config import get_logger
@@ -155,6 +174,37 @@ class Synchronizer(object):
     # client to slow down when the server cannot keep up with the load
     delay = 5
 
+    # Random variation of the polling delay, as a ratio of the delay, so that
+    # the clients started at the same time do not poll the server in
+    # lockstep. The server can also advertise a minimum polling interval in
+    # seconds in the minPollingInterval field of the change summary.
+    polling_jitter = 0.2
+
+    # The delay between two passes of the loop is multiplied by
+    # idle_backoff_factor after each pass without activity, up to max_delay
+    # seconds: right after some activity the loop runs at the base delay
+    max_delay = 30
+    idle_backoff_factor = 1.5
+
+    # On battery or under a high CPU load (in percent), the idle passes are
+    # at least power_saving_delay seconds apart and the active ones at least
+    # the base delay apart, unless power_saving is False
+    power_saving = True
+    power_saving_delay = 60
+    high_cpu_load = 80
+
+    # Window in seconds over which the full scans caused by too many remote
+    # changes are spread: each device waits for its own slot, derived from
+    # its id
+    default_full_scan_window = 300
+
+    # Delay in seconds between two polls of the change summary of a server
+    # notifying its changes: the polling is only a fallback then
+    change_notification_polling_delay = 300
+
+    # Maximum time in seconds the servers hold a change notification request
+    change_notification_max_wait = DEFAULT_MAX_WAIT
+
     # Default number of consecutive sync operations to perform
     # without refreshing the internal state DB.
     max_sync_step = 10
@@ -165,17 +215,61 @@ class Synchronizer(object):
     limit_pending = 100
 
     # Log sync error date and skip document pairs in error while syncing up
-    # to a fixed cooldown period
+    # to a cooldown period, increased (with some jitter) for each consecutive
+    # error of the same pair according to the retry policy of its operation
+    # class
     error_skip_period = 300  # 5 minutes
 
+    # Operation classes of the pair states transferring file contents, the
+    # other ones are metadata operations
+    transfer_pair_states = ('locally_created', 'locally_modified',
+                            'remotely_created', 'remotely_modified')
+
     # Default page size for deleted items detection query in DB
     default_page_size = 100
 
-    def __init__(self, controller, page_size=None):
+    # Maximum number of local files with the same digest tried to avoid a
+    # download
+    max_local_duplicates = 3
+
+    # Minimum number of files created in the same folder to transfer them
+    # by bundles: bundled uploads of small local files, archive downloads of
+    # remote files
+    bundle_min_files = 2
+
+    def __init__(self, controller, page_size=None, full_scan_window=None):
         self._controller = controller
         self._frontend = None
         self.page_size = (page_size if page_size is not None
                           else self.default_page_size)
+        self.full_scan_window = (full_scan_window
+                                 if full_scan_window is not None
+                                 else self.default_full_scan_window)
+        # Minimum polling intervals advertised by the servers by URL
+        self._min_polling_intervals = {}
+        # Time of the delayed full scans by local folder
+        self._scheduled_full_scans = {}
+        # Remote change notifiers and time of the last change summary by
+        # local folder
+        self._change_notifiers = {}
+        self._last_remote_polls = {}
+        # Set to wake the synchronization loop up
+        self._wakeup = Event()
+        # Number of consecutive passes of the loop without activity
+        self._idle_passes = 0
+        # Block signatures of the last synchronized version of the big
+        # files for the delta uploads
+        self.signature_store = SignatureStore(
+            os.path.join(controller.config_folder, 'signatures'))
+        # Number of bytes not downloaded thanks to local copies
+        self.saved_download_bytes = 0
+        # Stop polling the servers that keep failing for a while
+        self._circuit_breakers = {}
+        # Consecutive errors and retry time of the pairs in error by id
+        self._pair_errors = {}
+        # Ids of the pairs that could not be synchronized by an archive
+        # download: they are synchronized file by file
+        self._unbundled_pairs = set()
 
     def register_frontend(self, frontend):
         self._frontend = frontend
@@ -237,6 +331,7 @@ class Synchronizer(object):
                     log.debug("Deleting local %s '%s'",
                               file_or_folder, doc_pair.get_local_abspath())
                     local_client.delete(doc_pair.local_path)
+                self._forget_signature(doc_pair)
                 session.delete(doc_pair)
         else:
             log.debug("Marking local %s '%s' as unsynchronized as it has been"
@@ -510,11 +605,15 @@ class Synchronizer(object):
             doc_pair.update_remote(None)
 
     def _scan_remote_recursive(self, session, client, doc_pair, remote_info,
-        force_recursion=True):
+        force_recursion=True, children_future=None):
         """Recursively scan the bound remote folder looking for updates
 
         If force_recursion is True, recursion is done even on
         non newly created children.
+
+        The children of the subfolders are listed concurrently by the event
+        loop transport of the client: children_future is the Future of the
+        children of remote_info if already requested.
         """
         if remote_info is None:
             raise ValueError("Cannot bind %r to missing remote info" %
@@ -534,7 +633,10 @@ class Synchronizer(object):
         self._mark_unknown_local_recursive(session, doc_pair)
 
         # Detect recently deleted children
-        children_info = client.get_children_info(remote_info.uid)
+        if children_future is not None:
+            children_info = children_future.result()
+        else:
+            children_info = client.get_children_info(remote_info.uid)
         children_refs = set(c.uid for c in children_info)
 
         selectionTag = LastKnownState.select_remote_refs(session,
@@ -547,7 +649,9 @@ class Synchronizer(object):
                             selectionTag):
             self._mark_deleted_remote_recursive(session, deleted)
 
-        # Recursively update children
+        # Align the children first to list the children of the subfolders to
+        # scan at once
+        children_to_scan = []
         for child_info in children_info:
 
             # TODO: detect whether this is a __digit suffix name and relax the
@@ -562,8 +666,17 @@ class Synchronizer(object):
                     doc_pair, child_info, session=session)
 
             if new_pair or force_recursion:
-                self._scan_remote_recursive(session, client, child_pair,
-                                        child_info)
+                children_to_scan.append((child_pair, child_info))
+
+        # Recursively update children
+        futures = dict((child_info.uid,
+                        client.get_children_info_async(child_info.uid))
+                       for _, child_info in children_to_scan
+                       if child_info.folderish)
+        for child_pair, child_info in children_to_scan:
+            self._scan_remote_recursive(
+                session, client, child_pair, child_info,
+                children_future=futures.get(child_info.uid))
 
     def _find_remote_child_match_or_create(self, parent_pair, child_info,
                                            session=None):
@@ -669,14 +782,94 @@ class Synchronizer(object):
         if doc_pair.remote_digest != doc_pair.local_digest:
             log.debug("Updating remote document '%s'.",
                       doc_pair.remote_name)
-            remote_client.stream_update(
-                doc_pair.remote_ref,
-                doc_pair.get_local_abspath(),
-                filename=doc_pair.remote_name,
-            )
-            doc_pair.refresh_remote(remote_client)
+            signature = self._get_delta_signature(doc_pair)
+            if signature is not None:
+                # Only upload the modified blocks
+                digester = remote_client.stream_update_delta(
+                    doc_pair.remote_ref,
+                    doc_pair.get_local_abspath(),
+                    signature,
+                    filename=doc_pair.remote_name,
+                    digester=local_client.get_digester(),
+                )
+            else:
+                digester = self._get_digester(
+                    local_client,
+                    size=os.path.getsize(doc_pair.get_local_abspath()))
+                remote_client.stream_update(
+                    doc_pair.remote_ref,
+                    doc_pair.get_local_abspath(),
+                    filename=doc_pair.remote_name,
+                    digester=digester,
+                )
+            remote_info = doc_pair.refresh_remote(remote_client)
+            if not self._check_uploaded_digest(doc_pair, digester,
+                                               remote_info):
+                self._forget_signature(doc_pair)
+                doc_pair.update_state('modified', 'synchronized')
+                return
+            self._save_signature(doc_pair, digester)
         doc_pair.update_state('synchronized', 'synchronized')
 
+    def _get_delta_signature(self, doc_pair):
+        """Signature of the remote content of a big file, if known"""
+        if os.path.getsize(doc_pair.get_local_abspath()) < DELTA_MIN_SIZE:
+            return None
+        signature = self.signature_store.get(doc_pair.local_folder,
+                                             doc_pair.remote_ref)
+        if signature is None or signature.digest != doc_pair.remote_digest:
+            return None
+        return signature
+
+    def _get_digester(self, local_client, size=None):
+        """Digester of a transferred content, with its signature if needed
+
+        The block signature is only built for the files of at least
+        DELTA_MIN_SIZE bytes. If size is None, the download announces it to
+        the SignatureBuilder.
+        """
+        if size is not None and size < DELTA_MIN_SIZE:
+            return local_client.get_digester()
+        return SignatureBuilder(digester=local_client.get_digester())
+
+    def _save_signature(self, doc_pair, digester):
+        """Keep the signature of the synchronized content of a big file"""
+        if doc_pair.remote_ref is None:
+            return
+        signature = None
+        if (isinstance(digester, SignatureBuilder)
+            and digester.size >= DELTA_MIN_SIZE):
+            signature = digester.signature()
+        if signature is not None:
+            self.signature_store.save(doc_pair.local_folder,
+                                      doc_pair.remote_ref, signature)
+        else:
+            self._forget_signature(doc_pair)
+
+    def _forget_signature(self, doc_pair):
+        if doc_pair.remote_ref is not None and not doc_pair.folderish:
+            self.signature_store.delete(doc_pair.local_folder,
+                                        doc_pair.remote_ref)
+
+    def _check_uploaded_digest(self, doc_pair, digester, remote_info):
+        """Record the digest computed while uploading the local file
+
+        Check it against the digest of the remote content to detect a
+        corrupted upload. Return False in case of mismatch.
+        """
+        doc_pair.local_digest = digester.hexdigest()
+        if (remote_info is None or remote_info.digest_algorithm is None
+            or remote_info.digest_algorithm.lower() != digester.name.lower()):
+            # Cannot be checked
+            return True
+        if remote_info.digest != doc_pair.local_digest:
+            log.warning("Digest of the uploaded content of '%s' (%s) does"
+                        " not match the remote one (%s), will upload it"
+                        " again", doc_pair.get_local_abspath(),
+                        doc_pair.local_digest, remote_info.digest)
+            return False
+        return True
+
     def _synchronize_remotely_modified(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         try:
@@ -684,13 +877,19 @@ class Synchronizer(object):
                 log.debug("Updating content of local file '%s'.",
                           doc_pair.get_local_abspath())
                 os_path = local_client.get_info(doc_pair.local_path).filepath
-                tmp_file = remote_client.stream_content(
-                                            doc_pair.remote_ref, os_path)
+                tmp_file, digester = self._fetch_content(
+                    session, doc_pair, local_client, remote_client,
+                    remote_info, os_path)
                 # Delete original file and rename tmp file
                 local_client.delete(doc_pair.local_path)
                 local_client.rename(local_client.get_path(tmp_file),
                                     doc_pair.local_name)
-                doc_pair.refresh_local(local_client)
+                self._make_rename_durable(remote_client, tmp_file)
+                # No need to read the file again to compute its digest
+                doc_pair.update_local(local_client.get_info(
+                    doc_pair.local_path, raise_if_missing=False,
+                    digest=digester.hexdigest()))
+                self._save_signature(doc_pair, digester)
             else:
                 # digest agree so this might be a renaming and/or a move,
                 # and no need to transfer additional bytes over the network
@@ -733,6 +932,79 @@ class Synchronizer(object):
                 "content %r due to concurrent file access.",
                 doc_pair)
 
+    def _fetch_content(self, session, doc_pair, local_client, remote_client,
+                       remote_info, os_path):
+        """Fetch the remote content of a file to a tmp file next to os_path
+
+        The content is copied from a local file with the same digest if any,
+        otherwise it is downloaded.
+
+        Return the tmp file and the digester fed with its content, see
+        _get_digester.
+        """
+        result = self._copy_local_duplicate(session, doc_pair, local_client,
+                                            remote_client, remote_info,
+                                            os_path)
+        if result is not None:
+            return result
+        digester = self._get_digester(local_client)
+        tmp_file = remote_client.stream_content(
+            doc_pair.remote_ref, os_path, digester=digester)
+        return tmp_file, digester
+
+    def _copy_local_duplicate(self, session, doc_pair, local_client,
+                              remote_client, remote_info, os_path):
+        digest = remote_info.digest
+        algorithm = remote_info.digest_algorithm
+        if (digest is None or algorithm is None
+            or algorithm.lower() != local_client.get_digester().name.lower()):
+            return None
+        duplicates = session.query(LastKnownState).filter_by(
+            local_folder=doc_pair.local_folder,
+            local_digest=digest,
+            folderish=False,
+            pair_state='synchronized',
+        ).filter(LastKnownState.id != doc_pair.id).limit(
+            self.max_local_duplicates).all()
+        tmp_file = os.path.join(
+            os.path.dirname(os_path),
+            DOWNLOAD_TMP_FILE_PREFIX + os.path.basename(os_path)
+            + DOWNLOAD_TMP_FILE_SUFFIX)
+        for duplicate in duplicates:
+            if not local_client.exists(duplicate.local_path):
+                continue
+            size = os.path.getsize(duplicate.get_local_abspath())
+            digester = self._get_digester(local_client, size=size)
+            try:
+                reflinked = local_client.copy_content(
+                    duplicate.local_path, tmp_file, digester=digester,
+                    durability=remote_client.durability)
+            except (IOError, OSError, WindowsError):
+                log.debug("Could not copy local file '%s'",
+                          duplicate.get_local_abspath(), exc_info=True)
+                continue
+            if digester.hexdigest() != digest:
+                # Modified since its last synchronization
+                log.debug("Local file '%s' does not match digest %s"
+                          " anymore", duplicate.get_local_abspath(), digest)
+                os.remove(tmp_file)
+                continue
+            self.saved_download_bytes += size
+            log.info("%s local file '%s' instead of downloading '%s':"
+                     " saved %d bytes (%d bytes in total)",
+                     'Reflinked' if reflinked else 'Copied',
+                     duplicate.get_local_abspath(), remote_info.name,
+                     size, self.saved_download_bytes)
+            return tmp_file, digester
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return None
+
+    def _make_rename_durable(self, remote_client, tmp_file):
+        """Flush the renaming of a downloaded file according to the policy"""
+        if remote_client.durability == DURABILITY_FSYNC_DIR:
+            fsync_directory(os.path.dirname(tmp_file))
+
     def _is_remote_move(self, doc_pair, session):
         local_parent_pair = session.query(LastKnownState).filter_by(
             local_folder=doc_pair.local_folder,
@@ -776,9 +1048,25 @@ class Synchronizer(object):
             else:
                 log.debug("Creating remote document '%s' in folder '%s'",
                           name, parent_pair.remote_name)
-                remote_ref = remote_client.stream_file(
-                    parent_ref, doc_pair.get_local_abspath(), filename=name)
-            doc_pair.update_remote(remote_client.get_info(remote_ref))
+                remote_ref, digester = self._copy_remote_duplicate(
+                    session, doc_pair, local_client, remote_client,
+                    parent_ref, name)
+                if remote_ref is None:
+                    digester = self._get_digester(
+                        local_client,
+                        size=os.path.getsize(doc_pair.get_local_abspath()))
+                    remote_ref = remote_client.stream_file(
+                        parent_ref, doc_pair.get_local_abspath(),
+                        filename=name, digester=digester)
+            remote_info = remote_client.get_info(remote_ref)
+            doc_pair.update_remote(remote_info)
+            if (not doc_pair.folderish
+                and not self._check_uploaded_digest(doc_pair, digester,
+                                                    remote_info)):
+                doc_pair.update_state('modified', 'synchronized')
+                return
+            if not doc_pair.folderish:
+                self._save_signature(doc_pair, digester)
             doc_pair.update_state('synchronized', 'synchronized')
         else:
             child_type = 'folder' if doc_pair.folderish else 'file'
@@ -792,6 +1080,288 @@ class Synchronizer(object):
             # in the UI
             doc_pair.update_state('synchronized', 'synchronized')
 
+    def _copy_remote_duplicate(self, session, doc_pair, local_client,
+                               remote_client, parent_ref, name):
+        """Create a remote file by copying a remote file with the same digest
+
+        Return the id of the created file system item and the digester fed
+        with the local content. The id is None if no copy could be made, the
+        digester is None too if the local content was not read.
+        """
+        if doc_pair.local_digest is None:
+            return None, None
+        duplicate = session.query(LastKnownState).filter_by(
+            local_folder=doc_pair.local_folder,
+            remote_digest=doc_pair.local_digest,
+            folderish=False,
+            pair_state='synchronized',
+        ).filter(LastKnownState.remote_ref != None).filter(
+            LastKnownState.id != doc_pair.id).first()
+        if duplicate is None:
+            return None, None
+        # Only read the local content if the server can copy the duplicate
+        remote_copy = self._get_remote_copy(
+            doc_pair.server_binding, remote_client, duplicate.remote_ref,
+            parent_ref)
+        if remote_copy is None:
+            return None, None
+        # The local file may have been modified since it was scanned
+        size = os.path.getsize(doc_pair.get_local_abspath())
+        digester = local_client.update_digester(
+            doc_pair.local_path, self._get_digester(local_client, size=size))
+        if digester.hexdigest() != duplicate.remote_digest:
+            return None, digester
+        remote_ref = self._copy_remote_file(
+            doc_pair.server_binding, remote_client, duplicate.remote_ref,
+            parent_ref, name, remote_copy=remote_copy)
+        if remote_ref is not None:
+            log.info("Copied remote file '%s' instead of uploading '%s':"
+                     " saved %d bytes", duplicate.remote_name,
+                     doc_pair.get_local_abspath(), size)
+        return remote_ref, digester
+
+    def _get_remote_copy(self, server_binding, remote_client, fs_item_id,
+                         parent_id):
+        """Check whether a remote file can be copied to a remote folder
+
+        Return the document client and the (repository, uid) references of
+        the source document and of the target folder, or None if the server
+        cannot copy the document.
+        """
+        source = remote_client.get_document_ref(fs_item_id)
+        target = remote_client.get_document_ref(parent_id)
+        if source is None or target is None or source[0] != target[0]:
+            return None
+        doc_client = self._controller.get_remote_doc_client(
+            server_binding, repository=source[0])
+        if not doc_client.is_copy_supported():
+            return None
+        return doc_client, source, target
+
+    def _copy_remote_file(self, server_binding, remote_client, fs_item_id,
+                          parent_id, name, remote_copy=None):
+        """Copy the document of a remote file to a remote folder
+
+        The document is copied on the server side, then its file system item
+        is renamed: the copy keeps the title and blob filename of the
+        source. remote_copy is the result of _get_remote_copy if already
+        checked.
+
+        Return the id of the new file system item, or None if the copy is
+        not possible: the content has to be uploaded then.
+        """
+        if remote_copy is None:
+            remote_copy = self._get_remote_copy(server_binding, remote_client,
+                                                fs_item_id, parent_id)
+            if remote_copy is None:
+                return None
+        doc_client, source, target = remote_copy
+        repository = source[0]
+        try:
+            doc = doc_client.copy(source[1], target[1], name=name)
+        except urllib2.HTTPError as e:
+            if e.code in (401, 403):
+                raise
+            log.debug("Could not copy '%s' to '%s' (HTTP error %d)",
+                      fs_item_id, parent_id, e.code)
+            return None
+        copy_id = remote_client.get_file_item_id(repository, doc['uid'])
+        try:
+            return remote_client.rename(copy_id, name).uid
+        except urllib2.HTTPError as e:
+            if e.code in (401, 403):
+                raise
+            log.debug("Could not rename the copy '%s' of '%s' (HTTP error"
+                      " %d)", copy_id, fs_item_id, e.code)
+        try:
+            remote_client.delete(copy_id)
+        except Exception:
+            log.warning("Could not delete the copy '%s' of '%s'", copy_id,
+                        fs_item_id, exc_info=True)
+        return None
+
+    def _synchronize_bundle(self, pending, session, limit=None):
+        """Synchronize several pending pairs with bundled transfers
+
+        Return the number of synchronized pairs, 0 if no bundle was made.
+        """
+        return (self._synchronize_locally_created_bundle(pending, session,
+                                                         limit=limit)
+                or self._synchronize_remotely_created_bundle(
+                    pending, session, limit=limit))
+
+    def _synchronize_locally_created_bundle(self, pending, session,
+                                            limit=None):
+        """Create small files of a local folder with bundled uploads
+
+        Look for the biggest group of small files locally created in the same
+        folder among the pending pairs and create them with a few requests if
+        the server supports it.
+
+        Return the number of synchronized pairs, 0 if no bundle was made.
+        """
+        groups = {}
+        for doc_pair in pending:
+            if (doc_pair.pair_state == 'locally_created'
+                and not doc_pair.folderish
+                and doc_pair.remote_ref is None
+                and doc_pair.local_path is not None):
+                key = doc_pair.local_folder, doc_pair.local_parent_path
+                groups.setdefault(key, []).append(doc_pair)
+        for (local_folder, parent_path), doc_pairs in sorted(
+            groups.items(), key=lambda group: -len(group[1])):
+            if len(doc_pairs) < self.bundle_min_files:
+                break
+            # Let the files of a binding with local deletions be created
+            # one by one to detect the moves
+            if session.query(LastKnownState).filter_by(
+                local_folder=local_folder,
+                pair_state='locally_deleted').first() is not None:
+                continue
+            parent_pair = session.query(LastKnownState).filter_by(
+                local_folder=local_folder, local_path=parent_path).first()
+            if (parent_pair is None or parent_pair.remote_ref is None
+                or not parent_pair.remote_can_create_child):
+                continue
+            remote_client = self.get_remote_fs_client(
+                parent_pair.server_binding)
+            if not remote_client.is_bundle_supported():
+                continue
+            bundle = []
+            for doc_pair in doc_pairs[:limit]:
+                local_client = doc_pair.get_local_client()
+                if doc_pair.refresh_local(local_client) is None:
+                    continue
+                if (os.path.getsize(doc_pair.get_local_abspath())
+                    > BUNDLE_MAX_FILE_SIZE):
+                    continue
+                bundle.append((doc_pair, local_client.get_digester()))
+            if len(bundle) < self.bundle_min_files:
+                continue
+            return self._create_bundle(session, parent_pair, remote_client,
+                                       bundle)
+        return 0
+
+    def _create_bundle(self, session, parent_pair, remote_client, bundle):
+        log.debug("Creating %d remote documents in folder '%s'",
+                  len(bundle), parent_pair.remote_name)
+        pairs = iter(bundle)
+        created = []
+
+        def update_pairs(remote_infos):
+            # Record the files of each request right away: if a later
+            # request fails, they must not be created again one by one
+            for remote_info in remote_infos:
+                doc_pair, digester = next(pairs)
+                created.append(doc_pair)
+                doc_pair.update_remote(remote_info)
+                if self._check_uploaded_digest(doc_pair, digester,
+                                               remote_info):
+                    doc_pair.update_state('synchronized', 'synchronized')
+                else:
+                    doc_pair.update_state('modified', 'synchronized')
+                doc_pair.last_sync_date = datetime.now()
+            session.commit()
+
+        try:
+            remote_client.stream_files(
+                parent_pair.remote_ref,
+                [(doc_pair.get_local_abspath(),
+                  os.path.basename(doc_pair.local_path), digester)
+                 for doc_pair, digester in bundle],
+                callback=update_pairs)
+        except Exception:
+            if not created:
+                raise
+            # The other files are left pending
+            log.warning("Failed to create remote documents in folder '%s'"
+                        " after the first %d ones", parent_pair.remote_name,
+                        len(created), exc_info=True)
+        return len(created)
+
+    def _synchronize_remotely_created_bundle(self, pending, session,
+                                             limit=None):
+        """Download files remotely created in the same folder as an archive
+
+        Look for the biggest group of files remotely created in the same
+        folder among the pending pairs and download them with a single
+        request if the server supports it. The files missing from the
+        archive, or whose content does not match the known remote digest,
+        are left to the file by file synchronization: they are not part of
+        the next archives.
+
+        Return the number of synchronized pairs, 0 if no bundle was made.
+        """
+        groups = {}
+        for doc_pair in pending:
+            if (doc_pair.pair_state == 'remotely_created'
+                and not doc_pair.folderish
+                and doc_pair.local_path is None
+                and doc_pair.remote_ref is not None
+                and doc_pair.remote_digest is not None
+                and doc_pair.id not in self._unbundled_pairs):
+                key = doc_pair.local_folder, doc_pair.remote_parent_ref
+                groups.setdefault(key, []).append(doc_pair)
+        for (local_folder, parent_ref), doc_pairs in sorted(
+            groups.items(), key=lambda group: -len(group[1])):
+            if len(doc_pairs) < self.bundle_min_files:
+                break
+            parent_pair = session.query(LastKnownState).filter_by(
+                local_folder=local_folder, remote_ref=parent_ref).first()
+            if parent_pair is None or parent_pair.local_path is None:
+                continue
+            remote_client = self.get_remote_fs_client(
+                parent_pair.server_binding)
+            if not remote_client.is_archive_supported():
+                continue
+            return self._download_bundle(session, parent_pair,
+                                         remote_client, doc_pairs[:limit])
+        return 0
+
+    def _download_bundle(self, session, parent_pair, remote_client,
+                         doc_pairs):
+        local_client = parent_pair.get_local_client()
+        files = {}
+        names = set()
+        for doc_pair in doc_pairs:
+            path, os_path, name = local_client.get_new_file(
+                parent_pair.local_path, doc_pair.remote_name)
+            if name in names:
+                # Let the file by file synchronization deduplicate the name
+                self._unbundled_pairs.add(doc_pair.id)
+                continue
+            names.add(name)
+            files[doc_pair.remote_ref] = (
+                doc_pair, path, os_path, name,
+                self._get_digester(local_client))
+        log.debug("Downloading %d files to local folder '%s' as an archive",
+                  len(files), parent_pair.get_local_abspath())
+        results = remote_client.stream_contents(
+            [(remote_ref, os_path, digester)
+             for remote_ref, (_, _, os_path, _, digester) in files.items()])
+        synchronized = 0
+        for remote_ref, (doc_pair, _, _, _, _) in files.items():
+            if remote_ref not in results:
+                # Missing from the archive or corrupted
+                self._unbundled_pairs.add(doc_pair.id)
+        for remote_ref, (tmp_file, _) in results.items():
+            doc_pair, path, _, name, digester = files[remote_ref]
+            digest = digester.hexdigest()
+            if digest != doc_pair.remote_digest:
+                # Modified since the last remote scan
+                os.remove(tmp_file)
+                self._unbundled_pairs.add(doc_pair.id)
+                continue
+            local_client.rename(local_client.get_path(tmp_file), name)
+            self._make_rename_durable(remote_client, tmp_file)
+            self._save_signature(doc_pair, digester)
+            doc_pair.update_local(local_client.get_info(path, digest=digest))
+            doc_pair.update_state('synchronized', 'synchronized')
+            doc_pair.last_sync_date = datetime.now()
+            synchronized += 1
+        session.commit()
+        return synchronized
+
     def _synchronize_remotely_created(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         name = remote_info.name
@@ -821,16 +1391,22 @@ class Synchronizer(object):
             log.debug('Remote recursive scan of the content of %s', name)
             self._scan_remote_recursive(session, remote_client, doc_pair,
                                         remote_info, force_recursion=False)
+            digest = None
         else:
             path, os_path, name = local_client.get_new_file(local_parent_path,
                                                             name)
             log.debug("Creating local file '%s' in '%s'", name,
                       parent_pair.get_local_abspath())
-            tmp_file = remote_client.stream_content(
-                                            doc_pair.remote_ref, os_path)
+            tmp_file, digester = self._fetch_content(
+                session, doc_pair, local_client, remote_client, remote_info,
+                os_path)
             # Rename tmp file
             local_client.rename(local_client.get_path(tmp_file), name)
-        doc_pair.update_local(local_client.get_info(path))
+            self._make_rename_durable(remote_client, tmp_file)
+            digest = digester.hexdigest()
+            self._save_signature(doc_pair, digester)
+        # No need to read the downloaded file again to compute its digest
+        doc_pair.update_local(local_client.get_info(path, digest=digest))
         doc_pair.update_state('synchronized', 'synchronized')
 
     def _synchronize_locally_deleted(self, doc_pair, session,
@@ -999,14 +1575,7 @@ class Synchronizer(object):
         moved_or_renamed = False
         remote_ref = source_doc_pair.remote_ref
 
-        remote_info = remote_client.get_info(remote_ref,
-                                             raise_if_missing=False)
-        # check that the target still exists
-        if remote_info is None:
-            # Nothing to do: the regular deleted / created handling will
-            # work in this case.
-            return False
-
+        parent_doc_pair = None
         if (target_doc_pair.local_parent_path
             != source_doc_pair.local_parent_path):
             # This is (at least?) a move operation
@@ -1017,45 +1586,63 @@ class Synchronizer(object):
                 local_folder=doc_pair.local_folder,
                 local_path=target_doc_pair.local_parent_path,
             ).first()
+            if (parent_doc_pair is not None
+                and parent_doc_pair.remote_ref is None):
+                parent_doc_pair = None
+
+        if parent_doc_pair is not None:
+            # Fetch the source and the target folder with a single request
+            remote_info, parent_remote_info = remote_client.get_infos(
+                [remote_ref, parent_doc_pair.remote_ref])
+        else:
+            remote_info = remote_client.get_info(remote_ref,
+                                                 raise_if_missing=False)
+        # check that the target still exists
+        if remote_info is None:
+            # Nothing to do: the regular deleted / created handling will
+            # work in this case.
+            return False
 
-            if (parent_doc_pair is not None  and
-                parent_doc_pair.remote_ref is not None):
-                # Detect any concurrent deletion of the target remote folder
-                # that would prevent the move
-                parent_doc_pair.refresh_remote(remote_client)
-            if (parent_doc_pair is not None and
-                parent_doc_pair.remote_ref is not None):
-                # Target has not be concurrently deleted, let's perform the
-                # move
-                moved_or_renamed = True
-                log.debug("Detected and resolving local move event "
-                          "on %s to %s",
-                    source_doc_pair, parent_doc_pair)
-                target_ref = parent_doc_pair.remote_ref
-                if not remote_client.can_move(remote_ref, target_ref):
-                    log.debug("Move operation unauthorized: fallback to"
-                              " default create / delete behavior if possible")
-                    return False
-                remote_info = remote_client.move(remote_ref, target_ref)
-                target_doc_pair.update_remote(remote_info)
+        new_parent_ref = None
+        if parent_doc_pair is not None:
+            # Detect any concurrent deletion of the target remote folder
+            # that would prevent the move
+            parent_doc_pair.update_remote(parent_remote_info)
+            # Target has not be concurrently deleted, let's perform the
+            # move
+            moved_or_renamed = True
+            log.debug("Detected and resolving local move event "
+                      "on %s to %s",
+                source_doc_pair, parent_doc_pair)
+            new_parent_ref = parent_doc_pair.remote_ref
 
+        new_name = None
         if target_doc_pair.local_name != source_doc_pair.local_name:
             # This is a (also?) a rename operation
             moved_or_renamed = True
-            new_name = target_doc_pair.local_name
             log.debug("Detected and resolving local rename event on %s to %s",
-                      source_doc_pair, new_name)
+                      source_doc_pair, target_doc_pair.local_name)
             if remote_info.can_rename:
-                remote_info = remote_client.rename(remote_ref, new_name)
+                new_name = target_doc_pair.local_name
             else:
                 log.debug("Marking %s as synchronized since remote document"
                           " can not be renamed: either it is readonly or it is"
                           " a virtual folder that doesn't exist"
                           " in the server hierarchy",
                           target_doc_pair)
-            target_doc_pair.update_remote(remote_info)
+
+        if new_parent_ref is not None or new_name is not None:
+            # Move and rename with a single operation chain
+            moved_info = remote_client.move_and_rename(
+                remote_ref, new_parent_id=new_parent_ref, new_name=new_name)
+            if moved_info is None:
+                log.debug("Move operation unauthorized: fallback to"
+                          " default create / delete behavior if possible")
+                return False
+            remote_info = moved_info
 
         if moved_or_renamed:
+            target_doc_pair.update_remote(remote_info)
             target_doc_pair.update_state('synchronized', 'synchronized')
             if doc_pair.folderish:
                 # Delete the old local tree info that is now deprecated
@@ -1066,10 +1653,8 @@ class Synchronizer(object):
                 # with the local files
                 # TODO: optimize me by updating the local DB and reuse the
                 # previous state info instead?
-                remote_folder_info = remote_client.get_info(
-                    target_doc_pair.remote_ref)
                 self._scan_remote_recursive(session, remote_client,
-                    target_doc_pair, remote_folder_info)
+                    target_doc_pair, remote_info)
             else:
                 session.delete(source_doc_pair)
             session.commit()
@@ -1082,22 +1667,40 @@ class Synchronizer(object):
                         if server_binding is not None else None)
         synchronized = 0
         session = self.get_session()
+        bundled_transfers = True
 
         while (limit is None or synchronized < limit):
 
-            pending = self._controller.list_pending(
-                local_folder=local_folder,
-                limit=self.limit_pending,
-                session=session, ignore_in_error=self.error_skip_period)
-
-            or_more = len(pending) == self.limit_pending
+            pending, or_more = self._list_pending(local_folder, session)
             if self._frontend is not None:
                 self._frontend.notify_pending(
                     server_binding, len(pending), or_more=or_more)
-
             if len(pending) == 0:
                 break
 
+            if bundled_transfers:
+                try:
+                    bundled = self._synchronize_bundle(
+                        pending, session,
+                        limit=limit - synchronized if limit else None)
+                except POSSIBLE_NETWORK_ERROR_TYPES as e:
+                    if getattr(e, 'code', None) not in UNEXPECTED_HTTP_STATUS:
+                        raise e
+                    log.error("Failed to transfer a bundle of files,"
+                              " synchronizing them one by one",
+                              exc_info=True)
+                    bundled_transfers = False
+                    bundled = 0
+                except Exception:
+                    log.error("Failed to transfer a bundle of files,"
+                              " synchronizing them one by one",
+                              exc_info=True)
+                    bundled_transfers = False
+                    bundled = 0
+                if bundled:
+                    synchronized += bundled
+                    continue
+
             # Look first for a pending pair state with local_path not None,
             # fall back on first one. This is needed in the case where a
             # document is remotely deleted then created with the same name
@@ -1119,15 +1722,13 @@ class Synchronizer(object):
             try:
                 self.synchronize_one(pair_state, session=session)
                 synchronized += 1
+                self._pair_errors.pop(pair_state.id, None)
+                self._unbundled_pairs.discard(pair_state.id)
             except POSSIBLE_NETWORK_ERROR_TYPES as e:
                 if getattr(e, 'code', None) in UNEXPECTED_HTTP_STATUS:
                     # This is an unexpected: blacklist doc_pair for
                     # a cooldown period
-                    log.error("Failed to sync %r, blacklisting doc pair "
-                              "for %d seconds",
-                        pair_state, self.error_skip_period, exc_info=True)
-                    pair_state.last_sync_error_date = datetime.utcnow()
-                    session.commit()
+                    self._skip_pair_in_error(session, pair_state, error=e)
                 else:
                     # This is expected and should interrupt the sync process
                     # for this local_folder and should be dealt with
@@ -1135,14 +1736,143 @@ class Synchronizer(object):
                     raise e
             except Exception as e:
                 # Unexpected exception: blacklist for a cooldown period
-                log.error("Failed to sync %r, blacklisting doc pair "
-                          "for %d seconds",
-                    pair_state, self.error_skip_period, exc_info=True)
-                pair_state.last_sync_error_date = datetime.utcnow()
-                session.commit()
+                self._skip_pair_in_error(session, pair_state, error=e)
 
         return synchronized
 
+    def _list_pending(self, local_folder, session):
+        """List the pending pairs that are not skipped after errors
+
+        The pairs that failed several times are skipped for longer than the
+        error_skip_period filtered by the query: page through the pending
+        pairs so that they cannot hide the other ones.
+
+        Return the pending pairs and whether there are more of them.
+        """
+        offset = 0
+        while True:
+            page = self._controller.list_pending(
+                local_folder=local_folder,
+                limit=self.limit_pending, offset=offset,
+                session=session, ignore_in_error=self.error_skip_period)
+            or_more = len(page) == self.limit_pending
+            pending = [pair for pair in page
+                       if not self._is_pair_skipped(pair)]
+            if pending or not or_more:
+                return pending, or_more
+            offset += len(page)
+
+    def get_pair_retry_policy(self, pair_state):
+        """Retry policy of a pair in error, by operation class"""
+        if pair_state.pair_state in self.transfer_pair_states:
+            policy = get_retry_policy(TRANSFER_OPERATIONS)
+        else:
+            policy = get_retry_policy(METADATA_OPERATIONS)
+        return RetryPolicy(self.error_skip_period,
+                           max(self.error_skip_period, policy.max_delay),
+                           multiplier=policy.multiplier)
+
+    def _skip_pair_in_error(self, session, pair_state, error=None):
+        """Blacklist a pair after an unexpected error, with a backoff"""
+        errors = self._pair_errors.get(pair_state.id, (0, None))[0] + 1
+        policy = self.get_pair_retry_policy(pair_state)
+        retry_after = get_retry_after(error)
+        # The error date saved in the database skips the pair for at least
+        # the error_skip_period, even after a restart
+        delay = max(self.error_skip_period,
+                    policy.get_delay(errors, retry_after=retry_after))
+        self._pair_errors[pair_state.id] = errors, time() + delay
+        log.error("Failed to sync %r (%d consecutive errors), blacklisting"
+                  " doc pair for %d seconds", pair_state, errors, delay,
+                  exc_info=True)
+        pair_state.last_sync_error_date = datetime.utcnow()
+        session.commit()
+
+    def _is_pair_skipped(self, pair_state):
+        pair_error = self._pair_errors.get(pair_state.id)
+        return pair_error is not None and time() < pair_error[1]
+
+    def get_polling_delay(self, delay):
+        """Return the delay between two polls with some random jitter
+
+        The delay is at least the minimum polling interval advertised by the
+        servers.
+        """
+        if self._min_polling_intervals:
+            delay = max(delay, max(self._min_polling_intervals.values()))
+        return delay * (1 + self.polling_jitter * (2 * random.random() - 1))
+
+    def get_loop_delay(self, delay, max_delay, active=False,
+                       power_saving=True):
+        """Return the delay before the next pass of the synchronization loop
+
+        No delay after an active pass, the next one synchronizes the pending
+        items. Then delay after the last active pass, multiplied by
+        idle_backoff_factor for each idle pass up to max_delay. In power
+        saving mode, see is_power_saving, the passes are spaced by at least
+        delay if active, power_saving_delay if idle: power_saving=False
+        leaves it out.
+        """
+        power_saving = power_saving and self.is_power_saving()
+        if active:
+            self._idle_passes = 0
+            if not power_saving:
+                return 0
+        else:
+            backoff_delay = (delay
+                             * self.idle_backoff_factor ** self._idle_passes)
+            if backoff_delay < max_delay:
+                self._idle_passes += 1
+            delay = min(backoff_delay, max(delay, max_delay))
+            if power_saving:
+                delay = max(delay, self.power_saving_delay)
+        return self.get_polling_delay(delay)
+
+    def is_power_saving(self):
+        """Tell whether the machine runs on battery or is heavily loaded"""
+        try:
+            battery = psutil.sensors_battery()
+        except (AttributeError, NotImplementedError):
+            # Not supported by the platform or by psutil before 5.1
+            battery = None
+        if battery is not None and not battery.power_plugged:
+            return True
+        # Since the previous call
+        return psutil.cpu_percent(interval=None) >= self.high_cpu_load
+
+    def _sleep(self, duration, check_interval):
+        """Sleep until woken up by a remote change notification
+
+        The stop requests are checked every check_interval seconds, at
+        most once a second.
+        """
+        check_interval = max(check_interval, 1)
+        deadline = time() + duration
+        while not self.should_stop_synchronization():
+            remaining = deadline - time()
+            if remaining <= 0:
+                return
+            if self._wakeup.wait(min(remaining, check_interval)):
+                return
+
+    def get_full_scan_delay(self):
+        """Return the delay of the full scans of this device
+
+        The delay is derived from the device id: the devices restarting
+        their full scan at the same time are spread evenly over the
+        full_scan_window.
+        """
+        digest = hashlib.md5(self._controller.device_id).hexdigest()
+        return int(digest[:8], 16) / float(0xffffffff) * self.full_scan_window
+
+    def get_circuit_breaker(self, server_url):
+        """Return the circuit breaker of the requests to a server"""
+        circuit_breaker = self._circuit_breakers.get(server_url)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+            self._circuit_breakers[server_url] = circuit_breaker
+        return circuit_breaker
+
     def _get_sync_pid_filepath(self, process_name="sync"):
         return os.path.join(self._controller.config_folder,
                             'nxdrive_%s.pid' % process_name)
@@ -1196,10 +1926,20 @@ class Synchronizer(object):
             return True
         return False
 
-    def loop(self, max_loops=None, delay=None, max_sync_step=None):
-        """Forever loop to scan / refresh states and perform sync"""
+    def loop(self, max_loops=None, delay=None, max_sync_step=None,
+             max_delay=None, power_saving=None):
+        """Forever loop to scan / refresh states and perform sync
+
+        The passes run back to back while there is something to
+        synchronize, then delay seconds apart, backing off up to max_delay
+        seconds while idle, see get_loop_delay. power_saving defaults to
+        the attribute of the same name.
+        """
 
         delay = delay if delay is not None else self.delay
+        max_delay = max_delay if max_delay is not None else self.max_delay
+        power_saving = (power_saving if power_saving is not None
+                        else self.power_saving)
 
         if self._frontend is not None:
             self._frontend.notify_sync_started()
@@ -1233,24 +1973,34 @@ class Synchronizer(object):
                              loop_count)
                     break
 
+                # Notifications received from now on trigger a new pass
+                self._wakeup.clear()
                 bindings = session.query(ServerBinding).all()
                 if self._frontend is not None:
                     self._frontend.notify_local_folders(bindings)
+                self.stop_change_notifiers(
+                    exclude=[sb.local_folder for sb in bindings])
 
+                # The bindings of the same server and user share the change
+                # summaries fetched during the pass
+                shared_summaries = {}
                 for sb in bindings:
                     if not sb.has_invalid_credentials():
                         n_synchronized += self.update_synchronize_server(
-                            sb, session=session, max_sync_step=max_sync_step)
+                            sb, session=session, max_sync_step=max_sync_step,
+                            shared_summaries=shared_summaries)
 
                 # safety net to ensure that Nuxeo Drive won't eat all the CPU,
                 # disk and network resources of the machine scanning over an
                 # over the bound folders too often.
                 current_time = time()
                 spent = current_time - previous_time
-                sleep_time = delay - spent
-                if sleep_time > 0 and n_synchronized == 0:
+                sleep_time = self.get_loop_delay(
+                    delay, max_delay, active=n_synchronized > 0,
+                    power_saving=power_saving) - spent
+                if sleep_time > 0:
                     log.debug("Sleeping %0.3fs", sleep_time)
-                    sleep(sleep_time)
+                    self._sleep(sleep_time, delay)
                 previous_time = time()
                 loop_count += 1
 
@@ -1265,6 +2015,8 @@ class Synchronizer(object):
         except:
             self.get_session().rollback()
             raise
+        finally:
+            self.stop_change_notifiers()
 
         # Clean pid file
         pid_filepath = self._get_sync_pid_filepath()
@@ -1279,14 +2031,33 @@ class Synchronizer(object):
         if self._frontend is not None:
             self._frontend.notify_sync_stopped()
 
-    def _get_remote_changes(self, server_binding, session=None):
-        """Fetch incremental change summary from the server"""
-        session = self.get_session() if session is None else session
-        remote_client = self.get_remote_fs_client(server_binding)
+    def _get_remote_changes(self, server_binding, session=None,
+                            shared_summaries=None):
+        """Fetch incremental change summary from the server
 
-        summary = remote_client.get_changes(
-            last_sync_date=server_binding.last_sync_date,
-            last_root_definitions=server_binding.last_root_definitions)
+        If shared_summaries is given, the summaries are shared by the
+        bindings of the same server and user with the same checkpoint: a
+        single request is sent for all of them. Each binding gets the
+        changes of its own document pairs.
+        """
+        session = self.get_session() if session is None else session
+        key = self._get_summary_key(server_binding)
+        summary = None
+        if shared_summaries is not None:
+            summary = shared_summaries.get(key)
+        if summary is None:
+            remote_client = self.get_remote_fs_client(server_binding)
+            summary = remote_client.get_changes(
+                last_sync_date=server_binding.last_sync_date,
+                last_root_definitions=server_binding.last_root_definitions)
+            if shared_summaries is not None:
+                shared_summaries[key] = summary
+        else:
+            log.debug("Reusing the change summary of %s for %s",
+                      server_binding.server_url, server_binding.local_folder)
+        if shared_summaries is not None:
+            summary = self._get_binding_changes(server_binding, summary,
+                                                session)
 
         root_definitions = summary['activeSynchronizationRootDefinitions']
         sync_date = summary['syncDate']
@@ -1294,13 +2065,97 @@ class Synchronizer(object):
 
         return summary, checkpoint_data
 
+    def _get_summary_key(self, server_binding):
+        return (server_binding.server_url, server_binding.remote_user,
+                server_binding.last_sync_date,
+                server_binding.last_root_definitions)
+
+    def _get_binding_changes(self, server_binding, summary, session):
+        """Return the summary restricted to the changes of a binding
+
+        The changes of a binding are the ones of the items or of the
+        parents of the items of its document pairs.
+        """
+        changes = []
+        for change in summary['fileSystemChanges']:
+            remote_refs = [change['fileSystemItemId']]
+            fs_item = change.get('fileSystemItem')
+            if fs_item is not None and fs_item.get('parentId') is not None:
+                remote_refs.append(fs_item['parentId'])
+            doc_pair = session.query(LastKnownState).filter(
+                LastKnownState.local_folder == server_binding.local_folder,
+                LastKnownState.remote_ref.in_(remote_refs)).first()
+            if doc_pair is not None:
+                changes.append(change)
+        return dict(summary, fileSystemChanges=changes)
+
     def _checkpoint(self, server_binding, checkpoint_data, session=None):
         """Save the incremental change data for the next iteration"""
+        if checkpoint_data is None:
+            # The change summary was not fetched
+            return
         session = self.get_session() if session is None else session
         sync_date, root_definitions = checkpoint_data
         server_binding.last_sync_date = sync_date
         server_binding.last_root_definitions = root_definitions
         session.commit()
+        self._last_remote_polls[server_binding.local_folder] = time()
+        self._update_change_notifier(server_binding, checkpoint_data)
+
+    def _get_no_changes(self, server_binding):
+        """Return an empty change summary without checkpoint data"""
+        summary = {
+            'fileSystemChanges': [],
+            'hasTooManyChanges': False,
+            'minPollingInterval': self._min_polling_intervals.get(
+                server_binding.server_url),
+        }
+        return summary, None
+
+    def _should_poll_remote(self, server_binding):
+        """Tell whether the change summary of a server should be fetched
+
+        Always unless the server notifies its changes: then only after a
+        notification, or as a fallback every
+        change_notification_polling_delay seconds.
+        """
+        local_folder = server_binding.local_folder
+        notifier = self._change_notifiers.get(local_folder)
+        if (notifier is None or not notifier.is_active()
+            or notifier.has_changes()):
+            return True
+        last_poll = self._last_remote_polls.get(local_folder, 0)
+        return time() - last_poll >= self.change_notification_polling_delay
+
+    def _update_change_notifier(self, server_binding, checkpoint_data):
+        """Wait for the remote changes following checkpoint_data"""
+        local_folder = server_binding.local_folder
+        notifier = self._change_notifiers.get(local_folder)
+        if notifier is None:
+            notifier = ChangeNotifier(
+                lambda: self._get_notifier_client(local_folder),
+                self._wakeup.set, max_wait=self.change_notification_max_wait,
+                name='ChangeNotifier-%s' % server_binding.server_url)
+            self._change_notifiers[local_folder] = notifier
+            notifier.start()
+        sync_date, root_definitions = checkpoint_data
+        notifier.update_cursor(sync_date, root_definitions)
+
+    def _get_notifier_client(self, local_folder):
+        # Called from the notifier thread: use its own session and client
+        session = self.get_session()
+        try:
+            server_binding = session.query(ServerBinding).filter_by(
+                local_folder=local_folder).one()
+            return self.get_remote_fs_client(server_binding)
+        finally:
+            session.close()
+
+    def stop_change_notifiers(self, exclude=()):
+        """Stop the remote change notifiers but the excluded folders' ones"""
+        for local_folder in self._change_notifiers.keys():
+            if local_folder not in exclude:
+                self._change_notifiers.pop(local_folder).stop()
 
     def _update_remote_states(self, server_binding, summary, session=None):
         """Incrementally update the state of documents from a change summary"""
@@ -1367,6 +2222,7 @@ class Synchronizer(object):
                 # Handle new document creations
                 created = False
                 parent_pairs = session.query(LastKnownState).filter_by(
+                    local_folder=server_binding.local_folder,
                     remote_ref=new_info.parent_uid).all()
                 for parent_pair in parent_pairs:
                     if (parent_pair.server_binding.server_url != s_url):
@@ -1399,23 +2255,73 @@ class Synchronizer(object):
                                 "bound local folder: %r", new_info)
 
     def update_synchronize_server(self, server_binding, session=None,
-                                  full_scan=False, max_sync_step=None):
-        """Do one pass of synchronization for given server binding."""
+                                  full_scan=False, max_sync_step=None,
+                                  shared_summaries=None):
+        """Do one pass of synchronization for given server binding.
+
+        shared_summaries is the dict of the change summaries shared by the
+        bindings during a synchronization pass, see _get_remote_changes.
+        """
         session = self.get_session() if session is None else session
         max_sync_step = (max_sync_step if max_sync_step is not None
                           else self.max_sync_step)
         local_scan_is_done = False
+        circuit_breaker = self.get_circuit_breaker(server_binding.server_url)
+        if not circuit_breaker.allow_request():
+            log.trace("Not polling %s until it is available again",
+                      server_binding.server_url)
+            # Keep the local states up to date for the UI
+            self.scan_local(server_binding, session=session)
+            return 0
+        scheduled_full_scan = self._scheduled_full_scans.get(
+            server_binding.local_folder)
+        if scheduled_full_scan is not None:
+            if time() < scheduled_full_scan:
+                # Wait for the slot of this device
+                self.scan_local(server_binding, session=session)
+                return 0
+            full_scan = True
         try:
             tick = time()
             first_pass = server_binding.last_sync_date is None
-            summary, checkpoint = self._get_remote_changes(
-                server_binding, session=session)
+            if (full_scan or first_pass
+                or self._should_poll_remote(server_binding)
+                or (shared_summaries is not None
+                    and self._get_summary_key(server_binding)
+                    in shared_summaries)):
+                summary, checkpoint = self._get_remote_changes(
+                    server_binding, session=session,
+                    shared_summaries=shared_summaries)
+            else:
+                # No change notified since the last poll
+                summary, checkpoint = self._get_no_changes(server_binding)
 
             # Apparently we are online, otherwise an network related exception
             # would have been raised and caught below
             if self._frontend is not None:
                 self._frontend.notify_online(server_binding)
 
+            min_polling_interval = summary.get('minPollingInterval')
+            if min_polling_interval is not None:
+                self._min_polling_intervals[server_binding.server_url] = (
+                    min_polling_interval)
+            else:
+                self._min_polling_intervals.pop(server_binding.server_url,
+                                                None)
+
+            if (summary['hasTooManyChanges'] and not full_scan
+                and not first_pass and self.full_scan_window > 0):
+                # Probably a server restart: all its clients are doing the
+                # same, spread their full scans
+                delay = self.get_full_scan_delay()
+                log.debug("Too many remote changes on %s, remote full scan"
+                          " of %s in %0.1fs", server_binding.server_url,
+                          server_binding.local_folder, delay)
+                self._scheduled_full_scans[server_binding.local_folder] = (
+                    time() + delay)
+                self.scan_local(server_binding, session=session)
+                return 0
+
             if full_scan or summary['hasTooManyChanges'] or first_pass:
                 # Force remote full scan
                 log.debug("Remote full scan of %s. Reasons: "
@@ -1423,6 +2329,8 @@ class Synchronizer(object):
                           server_binding.local_folder, full_scan,
                           summary['hasTooManyChanges'], first_pass)
                 self.scan_remote(server_binding, session=session)
+                self._scheduled_full_scans.pop(server_binding.local_folder,
+                                               None)
             else:
                 # Only update recently changed documents
                 self._update_remote_states(server_binding, summary,
@@ -1473,10 +2381,17 @@ class Synchronizer(object):
                       local_refresh_duration,
                       remote_refresh_duration,
                       synchronization_duration)
+            circuit_breaker.record_success()
             return n_synchronized
 
         except POSSIBLE_NETWORK_ERROR_TYPES as e:
             # Do not fail when expecting possible network related errors
+            if is_server_failure(e):
+                delay = circuit_breaker.record_failure(
+                    retry_after=get_retry_after(e))
+                if delay is not None:
+                    log.warning("Server %s is unavailable, next attempt in"
+                                " %0.1fs", server_binding.server_url, delay)
             self._handle_network_error(server_binding, e)
             if not local_scan_is_done:
                 # Scan the local folders now to update the local DB even
@@ -70,6 +70,9 @@ class IntegrationTestCase(unittest.TestCase):
         self.controller_2 = Controller(self.nxdrive_conf_folder_2,
                                        echo=False)
         self.version = self.controller_1.get_version()
+        # The pace of the tests must not depend on the load of the machine
+        self.controller_1.synchronizer.power_saving = False
+        self.controller_2.synchronizer.power_saving = False
 
         # Long timeout for the root client that is responsible for the test
         # environment set: this client is doing the first query on the Nuxeo
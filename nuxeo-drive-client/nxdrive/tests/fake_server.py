@@ -0,0 +1,629 @@
+"""Local stand-in for the Nuxeo Automation HTTP API
+
+Makes it possible to test the transfer and protocol features of the remote
+clients without a running Nuxeo server.
+"""
+import hashlib
+import json
+import socket
+import sys
+from cStringIO import StringIO
+import tarfile
+import threading
+import time
+import urllib2
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from nxdrive.client.change_notifier import WAIT_FOR_CHANGES_OPERATION
+from nxdrive.client.delta import apply_delta
+from nxdrive.client.operation_chain import CHAIN_OPERATION
+
+
+class FakeServerError(Exception):
+    """Raised by the operation handlers to make the server reply an error"""
+
+    def __init__(self, code, message='', headers=None):
+        super(FakeServerError, self).__init__(message)
+        self.code = code
+        self.headers = headers if headers is not None else {}
+
+
+class FakeBlob(object):
+    """Blob result of an operation handler"""
+
+    def __init__(self, content, mime_type='application/octet-stream'):
+        self.content = content
+        self.mime_type = mime_type
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The clients giving up on a transfer are expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        # Keep the test output clean
+        pass
+
+    def do_GET(self):
+        self.server.fake.dispatch(self, 'GET')
+
+    def do_POST(self):
+        self.server.fake.dispatch(self, 'POST')
+
+
+class FakeAutomationServer(object):
+    """Fake Nuxeo server with a configurable Automation operation registry
+
+    Operation handlers are called with the JSON parameters, the operation
+    input (a batch blob for the batch/execute calls) and the request
+    headers. They return a JSON serializable value or a FakeBlob, or raise
+    FakeServerError.
+
+    Downloadable blobs are registered by relative URL in files. Every
+    request is recorded in requests as a (method, path, headers) tuple.
+
+    JSON responses are compressed with response_encoding ('gzip', 'deflate'
+    or 'raw-deflate' for a deflate encoding without the zlib wrapper) when
+    the client accepts it. gzip encoded requests are supported.
+
+    The operation registry is served with an ETag, unless registry_etag is
+    False, and not sent again to the clients that already have it:
+    registry_downloads counts the full downloads. So are the results of the
+    etag_operations.
+
+    Blobs are sent by chunks of blob_chunk_size bytes, blob_delay seconds
+    apart to simulate a slow link.
+    """
+
+    context = 'nuxeo/'
+
+    response_encoding = None
+
+    etag_operations = ()
+
+    registry_etag = True
+
+    blob_chunk_size = 1024
+
+    blob_delay = 0
+
+    def __init__(self):
+        self.operations = {}
+        self.files = {}
+        self.batches = {}
+        self.requests = []
+        self.registry_downloads = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _RequestHandler)
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/%s' % (self._server.server_address[1],
+                                          self.context)
+
+    def stop(self):
+        with self._changed:
+            # Release the pending long polls
+            self._stopped = True
+            self._changed.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def register_operation(self, op_id, handler, params=()):
+        """Register an operation with (name, required) parameters"""
+        self.operations[op_id] = {
+            'handler': handler,
+            'params': [{'name': name, 'required': required}
+                       for name, required in params],
+        }
+
+    def add_file_system_operations(self):
+        """Serve a flat file system of documents under a single root folder
+
+        The file system items are stored in items by id.
+        """
+        self.items = {}
+        self._last_id = 0
+        self.root_id = self.add_item(None, u'Nuxeo Drive', folder=True)
+        self.register_operation('NuxeoDrive.GetFileSystemItem',
+                                self._get_fs_item, params=[('id', True)])
+        self.register_operation('NuxeoDrive.GetTopLevelFolder',
+                                lambda params, op_input, headers:
+                                self.items[self.root_id])
+        self.register_operation('NuxeoDrive.GetChildren', self._get_children,
+                                params=[('id', True)])
+        self.register_operation('NuxeoDrive.CreateFile', self._create_file,
+                                params=[('parentId', True), ('name', False)])
+        self.register_operation('NuxeoDrive.UpdateFile', self._update_file,
+                                params=[('id', True), ('parentId', False),
+                                        ('name', False)])
+        self.register_operation('NuxeoDrive.Rename', self._rename,
+                                params=[('id', True), ('name', True)])
+        self.register_operation('NuxeoDrive.Delete', self._delete,
+                                params=[('id', True)])
+        self.register_operation('NuxeoDrive.CanMove', self._can_move,
+                                params=[('srcId', True), ('destId', True)])
+        self.register_operation('NuxeoDrive.Move', self._move,
+                                params=[('srcId', True), ('destId', True)])
+
+    def add_delta_operation(self):
+        """Make it possible to update files by uploading a delta"""
+        self.register_operation(
+            'NuxeoDrive.UpdateFileFromDelta', self._update_file_from_delta,
+            params=[('id', True), ('baseDigest', True), ('digest', True),
+                    ('blockSize', True)])
+
+    def add_copy_operation(self):
+        """Make it possible to copy the documents of the file system items
+
+        The document uid of an item is the last part of its id.
+        """
+        self.register_operation('Document.Copy', self._copy_document,
+                                params=[('target', True), ('name', False)])
+
+    def add_archive_operation(self):
+        """Make it possible to download several files as a tar archive"""
+        self.register_operation('NuxeoDrive.GetFilesArchive',
+                                self._get_files_archive,
+                                params=[('ids', True)])
+
+    def add_bundle_operation(self):
+        """Make it possible to create several files with a single request"""
+        self.register_operation('NuxeoDrive.CreateFiles', self._create_files,
+                                params=[('parentId', True)])
+
+    def add_chain_operation(self):
+        """Make it possible to run a chain of operations in a single request
+
+        See nxdrive.client.operation_chain for the protocol.
+        """
+        self.register_operation(CHAIN_OPERATION, self._execute_chain,
+                                params=[('operations', True)])
+
+    def add_change_operations(self):
+        """Serve the change summary and the long poll change notifications
+
+        The changes are not tracked: the summary gives the changes of the
+        file_system_changes list and the date of the last change,
+        incremented by notify_change.
+        """
+        self.sync_date = 1000
+        self.file_system_changes = []
+        self.register_operation(
+            'NuxeoDrive.GetChangeSummary', self._get_change_summary,
+            params=[('lastSyncDate', False),
+                    ('lastSyncActiveRootDefinitions', False)])
+        self.register_operation(
+            WAIT_FOR_CHANGES_OPERATION, self._wait_for_changes,
+            params=[('lastSyncDate', False),
+                    ('lastSyncActiveRootDefinitions', False),
+                    ('maxWait', True)])
+
+    def notify_change(self):
+        with self._changed:
+            self.sync_date += 1
+            self._changed.notify_all()
+
+    def add_item(self, parent_id, name, content=None, folder=False):
+        with self._lock:
+            self._last_id += 1
+            fs_item_id = 'defaultFileSystemItemFactory#default#%d' % (
+                self._last_id)
+        parent_path = (self.items[parent_id]['path'] if parent_id is not None
+                       else '')
+        item = {
+            'id': fs_item_id,
+            'parentId': parent_id,
+            'name': name,
+            'path': parent_path + '/' + fs_item_id,
+            'folder': folder,
+            'canRename': True,
+            'canDelete': True,
+        }
+        if folder:
+            item['canCreateChild'] = True
+        else:
+            item['canUpdate'] = True
+        self.items[fs_item_id] = item
+        if not folder:
+            self.set_content(fs_item_id, content, name=name)
+        else:
+            item['lastModificationDate'] = int(time.time() * 1000)
+        return fs_item_id
+
+    def set_content(self, fs_item_id, content, name=None):
+        item = self.items[fs_item_id]
+        if name is not None:
+            item['name'] = name
+        download_url = 'nxbigfile/default/%s/blobholder:0/%s' % (
+            fs_item_id.rsplit('#', 1)[1], item['name'])
+        item['digest'] = hashlib.md5(content).hexdigest()
+        item['digestAlgorithm'] = 'md5'
+        item['downloadURL'] = download_url
+        item['lastModificationDate'] = int(time.time() * 1000)
+        self.files[download_url] = content
+
+    def get_content(self, fs_item_id):
+        return self.files[self.items[fs_item_id]['downloadURL']]
+
+    def _get_fs_item(self, params, op_input, headers):
+        return self.items.get(params['id'])
+
+    def _get_children(self, params, op_input, headers):
+        if params['id'] not in self.items:
+            raise FakeServerError(404, "No such item: " + params['id'])
+        return sorted((item for item in self.items.values()
+                       if item['parentId'] == params['id']),
+                      key=lambda item: item['id'])
+
+    def _create_file(self, params, op_input, headers):
+        fs_item_id = self.add_item(params['parentId'], op_input['name'],
+                                   content=op_input['content'])
+        return self.items[fs_item_id]
+
+    def _create_files(self, params, op_input, headers):
+        if isinstance(op_input, dict):
+            op_input = [op_input]
+        return [self._create_file(params, blob, headers)
+                for blob in op_input]
+
+    def _get_files_archive(self, params, op_input, headers):
+        out = StringIO()
+        archive = tarfile.open(fileobj=out, mode='w',
+                               format=tarfile.PAX_FORMAT)
+        for fs_item_id in params['ids'].split(','):
+            item = self.items.get(fs_item_id)
+            if item is None or item['folder']:
+                continue
+            content = self.get_content(fs_item_id)
+            member = tarfile.TarInfo(fs_item_id)
+            member.size = len(content)
+            member.pax_headers = {
+                u'digest': item['digest'],
+                u'digestAlgorithm': item['digestAlgorithm'],
+            }
+            archive.addfile(member, StringIO(content))
+        archive.close()
+        return FakeBlob(out.getvalue(), mime_type='application/x-tar')
+
+    def _update_file(self, params, op_input, headers):
+        if params['id'] not in self.items:
+            raise FakeServerError(404, "No such item: " + params['id'])
+        self.set_content(params['id'], op_input['content'],
+                         name=op_input['name'])
+        return self.items[params['id']]
+
+    def _rename(self, params, op_input, headers):
+        item = self.items.get(params['id'])
+        if item is None:
+            raise FakeServerError(404, "No such item: " + params['id'])
+        if item['folder']:
+            item['name'] = params['name']
+            item['lastModificationDate'] = int(time.time() * 1000)
+        else:
+            self.set_content(params['id'], self.get_content(params['id']),
+                             name=params['name'])
+        return item
+
+    def _can_move(self, params, op_input, headers):
+        source = self.items.get(params['srcId'])
+        target = self.items.get(params['destId'])
+        return (source is not None and target is not None
+                and target['folder']
+                and not (target['path'] + '/').startswith(
+                    source['path'] + '/'))
+
+    def _move(self, params, op_input, headers):
+        if not self._can_move(params, op_input, headers):
+            raise FakeServerError(403, "Cannot move %s to %s" % (
+                params['srcId'], params['destId']))
+        item = self.items[params['srcId']]
+        old_path = item['path']
+        new_path = self.items[params['destId']]['path'] + '/' + item['id']
+        for descendant in self.items.values():
+            if (descendant['path'] + '/').startswith(old_path + '/'):
+                descendant['path'] = new_path + descendant['path'][
+                    len(old_path):]
+        item['parentId'] = params['destId']
+        return item
+
+    def _delete(self, params, op_input, headers):
+        if self.items.pop(params['id'], None) is None:
+            raise FakeServerError(404, "No such item: " + params['id'])
+
+    def _execute_chain(self, params, op_input, headers):
+        results = []
+        outcomes = []
+        for call in json.loads(params['operations']):
+            call_params = dict(call['params'])
+            for name, (index, key) in call.get('refs', {}).items():
+                call_params[name] = results[index][key]
+            try:
+                result = self._execute(call['id'], call_params,
+                                       call.get('input', op_input), headers)
+            except FakeServerError as e:
+                outcomes.append({'error': {'status': e.code,
+                                           'message': str(e)}})
+                break
+            if isinstance(result, FakeBlob):
+                result = None
+            results.append(result)
+            outcomes.append({'result': result})
+            if call.get('guard') and not result:
+                break
+        return outcomes
+
+    def _get_change_summary(self, params, op_input, headers):
+        return {
+            'fileSystemChanges': self.file_system_changes,
+            'syncDate': self.sync_date,
+            'activeSynchronizationRootDefinitions': '',
+            'hasTooManyChanges': False,
+        }
+
+    def _wait_for_changes(self, params, op_input, headers):
+        last_sync_date = params.get('lastSyncDate')
+        deadline = time.time() + float(params['maxWait'])
+        with self._changed:
+            while (not self._stopped and last_sync_date is not None
+                   and self.sync_date <= last_sync_date):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return {'hasChanges': (last_sync_date is None
+                                   or self.sync_date > last_sync_date)}
+
+    def _get_item_by_uid(self, uid):
+        for fs_item_id, item in self.items.items():
+            if fs_item_id.rsplit('#', 1)[1] == uid:
+                return item
+        raise FakeServerError(404, "No such document: " + uid)
+
+    def _copy_document(self, params, op_input, headers):
+        source = self._get_item_by_uid(op_input[len('doc:'):])
+        target = self._get_item_by_uid(params['target'])
+        fs_item_id = self.add_item(target['id'], source['name'],
+                                   content=self.get_content(source['id']),
+                                   folder=source['folder'])
+        return {'entity-type': 'document',
+                'uid': fs_item_id.rsplit('#', 1)[1]}
+
+    def _update_file_from_delta(self, params, op_input, headers):
+        item = self.items.get(params['id'])
+        if item is None:
+            raise FakeServerError(404, "No such item: " + params['id'])
+        if item['digest'] != params['baseDigest']:
+            raise FakeServerError(409, "Content has changed")
+        out = StringIO()
+        apply_delta(StringIO(self.get_content(params['id'])),
+                    StringIO(op_input['content']), out,
+                    int(params['blockSize']))
+        content = out.getvalue()
+        if hashlib.md5(content).hexdigest() != params['digest']:
+            raise FakeServerError(409, "Digest mismatch")
+        self.set_content(params['id'], content, name=op_input['name'])
+        return item
+
+    def count_requests(self, path_suffix):
+        return len([r for r in self.requests if r[1].endswith(path_suffix)])
+
+    #
+    # Request handling
+    #
+
+    def dispatch(self, handler, method):
+        path = urllib2.unquote(handler.path.split('?', 1)[0])
+        headers = dict((k.lower(), v) for k, v in handler.headers.items())
+        with self._lock:
+            self.requests.append((method, path, headers))
+        automation_path = '/' + self.context + 'site/automation/'
+        try:
+            if not path.startswith('/' + self.context):
+                raise FakeServerError(404)
+            if method == 'GET' and path == automation_path:
+                self._reply_registry(handler, headers)
+            elif method == 'GET':
+                self._reply_file(handler, path[len(self.context) + 1:])
+            elif path == automation_path + 'batch/upload':
+                self._reply_json(handler, self._upload(handler, headers))
+            elif path == automation_path + 'batch/execute':
+                self._reply_json(handler, self._execute_batch(handler,
+                                                              headers))
+            elif path.startswith(automation_path):
+                op_id = path[len(automation_path):]
+                body = self._read_body(handler)
+                content_type = headers.get('content-type', '')
+                if content_type.startswith('multipart/related'):
+                    request, op_input = self._parse_multipart(content_type,
+                                                              body)
+                else:
+                    request = json.loads(body)
+                    op_input = request.get('input')
+                result = self._execute(op_id, request.get('params', {}),
+                                       op_input, headers)
+                if op_id in self.etag_operations:
+                    self._reply_json_with_etag(handler, headers, result)
+                else:
+                    self._reply_json(handler, result)
+            else:
+                raise FakeServerError(404)
+        except FakeServerError as e:
+            handler.send_response(e.code)
+            for name, value in e.headers.items():
+                handler.send_header(name, value)
+            body = json.dumps({'message': str(e), 'stack': ''})
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+
+    def _get_registry(self):
+        return {'operations': [{'id': op_id, 'params': op['params']}
+                               for op_id, op in self.operations.items()]}
+
+    def _reply_registry(self, handler, headers):
+        def count_download():
+            with self._lock:
+                self.registry_downloads += 1
+        if not self.registry_etag:
+            count_download()
+            self._reply_json(handler, self._get_registry())
+            return
+        self._reply_json_with_etag(handler, headers, self._get_registry(),
+                                   on_download=count_download)
+
+    def _read_body(self, handler):
+        length = int(handler.headers.get('Content-Length', 0))
+        body = handler.rfile.read(length)
+        if handler.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _compress(self, handler, body):
+        """Return the content encoding and the compressed body"""
+        encoding = self.response_encoding
+        accepted = handler.headers.get('Accept-Encoding', '')
+        if encoding is None or encoding.split('-')[-1] not in accepted:
+            return None, body
+        if encoding == 'gzip':
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+        elif encoding == 'raw-deflate':
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            compressor = zlib.compressobj()
+        return (encoding.split('-')[-1],
+                compressor.compress(body) + compressor.flush())
+
+    def _parse_multipart(self, content_type, body):
+        """Return the JSON request and the blob or blob list input"""
+        boundary = content_type.split('boundary="', 1)[1].split('"', 1)[0]
+        request = None
+        blobs = []
+        for part in body.split('--' + boundary)[1:-1]:
+            # Parts are separated by CRLF, their headers by LF
+            part_headers, payload = part[2:-2].split('\n\n', 1)
+            part_headers = dict(line.split(': ', 1)
+                                for line in part_headers.split('\n'))
+            if part_headers.get('Content-ID') == 'request':
+                request = json.loads(payload)
+                continue
+            quoted_name = part_headers['Content-Disposition'].split(
+                "filename*=UTF-8''", 1)[1]
+            blobs.append({
+                'name': urllib2.unquote(quoted_name).decode('utf-8'),
+                'mime_type': part_headers['Content-Type'],
+                'content': payload,
+            })
+        return request, blobs[0] if len(blobs) == 1 else blobs
+
+    def _execute(self, op_id, params, op_input, headers):
+        operation = self.operations.get(op_id)
+        if operation is None:
+            raise FakeServerError(404, "No such operation: " + op_id)
+        return operation['handler'](params, op_input, headers)
+
+    def _upload(self, handler, headers):
+        batch_id = headers['x-batch-id']
+        file_idx = headers['x-file-idx']
+        blob = {
+            'name': urllib2.unquote(headers['x-file-name']).decode('utf-8'),
+            'mime_type': headers.get('x-file-type'),
+            'content': self._read_body(handler),
+        }
+        with self._lock:
+            self.batches.setdefault(batch_id, {})[file_idx] = blob
+        return {'uploaded': 'true', 'batchId': batch_id}
+
+    def _execute_batch(self, handler, headers):
+        params = dict(json.loads(self._read_body(handler))['params'])
+        batch_id = params.pop('batchId')
+        file_idx = params.pop('fileIdx')
+        op_id = params.pop('operationId')
+        batch = self.batches.get(batch_id)
+        if batch is None or file_idx not in batch:
+            raise FakeServerError(404, "No such batch file: %s/%s" % (
+                batch_id, file_idx))
+        with self._lock:
+            blob = self.batches.pop(batch_id)[file_idx]
+        return self._execute(op_id, params, blob, headers)
+
+    def _reply_json(self, handler, result):
+        if isinstance(result, FakeBlob):
+            self._reply_blob(handler, result.content, result.mime_type)
+            return
+        body = json.dumps(result) if result is not None else ''
+        encoding, body = self._compress(handler, body)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json+nxentity')
+        if encoding is not None:
+            handler.send_header('Content-Encoding', encoding)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _reply_json_with_etag(self, handler, headers, result,
+                              on_download=None):
+        """Reply 304 if the client has the result, the result otherwise
+
+        on_download is called before replying the result, so that the
+        client sees its effects as soon as it gets the reply.
+        """
+        etag = '"%s"' % hashlib.md5(
+            json.dumps(result, sort_keys=True)).hexdigest()
+        if headers.get('if-none-match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+            return
+        if on_download is not None:
+            on_download()
+        body = json.dumps(result)
+        encoding, body = self._compress(handler, body)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json+nxentity')
+        handler.send_header('ETag', etag)
+        if encoding is not None:
+            handler.send_header('Content-Encoding', encoding)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _reply_file(self, handler, relative_url):
+        content = self.files.get(relative_url)
+        if content is None:
+            raise FakeServerError(404, "No such file: " + relative_url)
+        self._reply_blob(handler, content)
+
+    def _reply_blob(self, handler, content,
+                    mime_type='application/octet-stream'):
+        handler.send_response(200)
+        handler.send_header('Content-Type', mime_type)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        if not self.blob_delay:
+            handler.wfile.write(content)
+            return
+        for i in range(0, len(content), self.blob_chunk_size):
+            handler.wfile.write(content[i:i + self.blob_chunk_size])
+            handler.wfile.flush()
+            time.sleep(self.blob_delay)
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.add_archive_operation()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client():
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator')
+
+
+def make_remote_files(count):
+    return [SERVER.add_item(SERVER.root_id, u'File %d.txt' % i,
+                            content=os.urandom(1000 + i))
+            for i in range(count)]
+
+
+@with_setup(setup_server, teardown_server)
+def test_stream_contents():
+    remote_client = get_client()
+    assert_true(remote_client.is_archive_supported())
+    fs_item_ids = make_remote_files(20)
+    # Corrupted content
+    SERVER.items[fs_item_ids[0]]['digest'] = hashlib.md5('other').hexdigest()
+    unknown_id = 'defaultFileSystemItemFactory#default#unknown'
+    digesters = dict((fs_item_id, hashlib.md5())
+                     for fs_item_id in fs_item_ids)
+    files = [(fs_item_id, os.path.join(TEST_WORKSPACE, u'%d.txt' % i),
+              digesters[fs_item_id])
+             for i, fs_item_id in enumerate(fs_item_ids)]
+    files.append((unknown_id, os.path.join(TEST_WORKSPACE, u'unknown.txt'),
+                  None))
+
+    results = remote_client.stream_contents(files)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetFilesArchive'), 1)
+    assert_equals(sorted(results), sorted(fs_item_ids[1:]))
+    for fs_item_id in fs_item_ids[1:]:
+        tmp_file, digest = results[fs_item_id]
+        with open(tmp_file, 'rb') as f:
+            content = f.read()
+        assert_equals(content, SERVER.get_content(fs_item_id))
+        assert_equals(digest, hashlib.md5(content).hexdigest())
+        assert_equals(digesters[fs_item_id].hexdigest(), digest)
+    # Only the tmp files of the verified contents are left
+    assert_equals(len(os.listdir(TEST_WORKSPACE)), 19)
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_archive_download():
+    remote_client = get_client()
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    local_client = LocalClient(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    sync = ctl.synchronizer
+    session.add(ServerBinding(local_folder, SERVER.url, 'Administrator',
+                              remote_password='Administrator'))
+    root_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    fs_item_ids = make_remote_files(10)
+    for fs_item_id in fs_item_ids:
+        doc_pair = LastKnownState(local_folder,
+            remote_info=remote_client.get_info(fs_item_id))
+        doc_pair.update_state('unknown', 'created')
+        session.add(doc_pair)
+    session.commit()
+    # Modified since the remote scan
+    SERVER.set_content(fs_item_ids[0], 'new content')
+
+    pending = session.query(LastKnownState).filter_by(
+        pair_state='remotely_created').all()
+    assert_equals(len(pending), 10)
+    assert_equals(sync._synchronize_bundle(pending, session), 9)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetFilesArchive'), 1)
+    synchronized = session.query(LastKnownState).filter_by(
+        pair_state='synchronized', folderish=False).all()
+    assert_equals(len(synchronized), 9)
+    for doc_pair in synchronized:
+        assert_equals(doc_pair.local_digest, doc_pair.remote_digest)
+        assert_equals(local_client.get_content(doc_pair.local_path),
+                      SERVER.get_content(doc_pair.remote_ref))
+    # The modified file is left to the file by file synchronization
+    doc_pair = session.query(LastKnownState).filter_by(
+        remote_ref=fs_item_ids[0]).one()
+    assert_equals(doc_pair.pair_state, 'remotely_created')
+    assert_equals(sorted(os.listdir(local_folder)),
+                  sorted(u'File %d.txt' % i for i in range(1, 10)))
+    ctl.dispose()
+
+
+@with_setup(setup_server, teardown_server)
+def test_stream_contents_failure():
+    remote_client = get_client()
+    fs_item_ids = make_remote_files(5)
+
+    class FailingDigester(object):
+        name = 'md5'
+
+        def update(self, data):
+            raise IOError("Disk error")
+
+    files = [(fs_item_id, os.path.join(TEST_WORKSPACE, u'%d.txt' % i),
+              FailingDigester() if i == 2 else None)
+             for i, fs_item_id in enumerate(fs_item_ids)]
+    with assert_raises(IOError):
+        remote_client.stream_contents(files)
+    # Neither the extracted files nor the partial one are left
+    assert_equals(os.listdir(TEST_WORKSPACE), [])
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_archive_download_mismatch():
+    remote_client = get_client()
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    local_client = LocalClient(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    sync = ctl.synchronizer
+    session.add(ServerBinding(local_folder, SERVER.url, 'Administrator',
+                              remote_password='Administrator'))
+    root_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    fs_item_ids = make_remote_files(5)
+    for fs_item_id in fs_item_ids:
+        doc_pair = LastKnownState(local_folder,
+            remote_info=remote_client.get_info(fs_item_id))
+        doc_pair.update_state('unknown', 'created')
+        session.add(doc_pair)
+    session.commit()
+    # Modified since the remote scan
+    for fs_item_id in fs_item_ids[:2]:
+        SERVER.set_content(fs_item_id, 'new content')
+
+    pending = session.query(LastKnownState).filter_by(
+        pair_state='remotely_created').all()
+    assert_equals(sync._synchronize_bundle(pending, session), 3)
+    # The files that did not match are not downloaded as an archive again
+    pending = session.query(LastKnownState).filter_by(
+        pair_state='remotely_created').all()
+    assert_equals(len(pending), 2)
+    assert_equals(sync._synchronize_bundle(pending, session), 0)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetFilesArchive'), 1)
+    ctl.dispose()
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.remote_file_system_client import BUNDLE_MAX_FILE_SIZE
+from nxdrive.client.remote_file_system_client import BUNDLE_MAX_SIZE
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+from nxdrive.tests.fake_server import FakeServerError
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.add_bundle_operation()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client():
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator')
+
+
+def make_files(folder, count, size, prefix=u'File'):
+    files = []
+    for i in range(count):
+        file_path = os.path.join(folder, u'%s %d.txt' % (prefix, i))
+        with open(file_path, 'wb') as f:
+            # Also check that the binary content is not altered
+            f.write('\r\nFrom ' + os.urandom(size - 7))
+        files.append(file_path)
+    return files
+
+
+@with_setup(setup_server, teardown_server)
+def test_stream_files():
+    remote_client = get_client()
+    assert_true(remote_client.is_bundle_supported())
+    file_paths = make_files(TEST_WORKSPACE, 50, 1000)
+    digesters = [hashlib.md5() for _ in file_paths]
+
+    infos = remote_client.stream_files(
+        SERVER.root_id, [(file_path, None, digester)
+                         for file_path, digester in zip(file_paths,
+                                                        digesters)])
+    # A single request instead of an upload and an operation per file
+    assert_equals(len(SERVER.requests), 2)
+    assert_equals(SERVER.count_requests('NuxeoDrive.CreateFiles'), 1)
+    assert_equals(len(infos), 50)
+    for file_path, digester, info in zip(file_paths, digesters, infos):
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        assert_equals(info.name, os.path.basename(file_path))
+        assert_equals(info.parent_uid, SERVER.root_id)
+        assert_equals(info.digest, digester.hexdigest())
+        assert_equals(SERVER.get_content(info.uid), content)
+
+    # Files are sent by bundles of limited size
+    file_paths = make_files(TEST_WORKSPACE, 20, BUNDLE_MAX_FILE_SIZE,
+                            prefix=u'Big')
+    infos = remote_client.stream_files(
+        SERVER.root_id, [(file_path, None, None) for file_path in file_paths])
+    assert_equals(len(infos), 20)
+    per_bundle = BUNDLE_MAX_SIZE // BUNDLE_MAX_FILE_SIZE
+    assert_equals(SERVER.count_requests('NuxeoDrive.CreateFiles'),
+                  1 + (20 + per_bundle - 1) // per_bundle)
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_bundle():
+    remote_client = get_client()
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    local_client = LocalClient(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    sync = ctl.synchronizer
+    session.add(ServerBinding(local_folder, SERVER.url, 'Administrator',
+                              remote_password='Administrator'))
+
+    root_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    make_files(local_folder, 10, 1000)
+    # Too big to be bundled
+    make_files(local_folder, 1, BUNDLE_MAX_FILE_SIZE + 1000, prefix=u'Big')
+    for child in local_client.get_children_info(u'/'):
+        doc_pair = LastKnownState(local_folder, local_info=child)
+        doc_pair.update_state('created', 'unknown')
+        session.add(doc_pair)
+    session.commit()
+    pending = session.query(LastKnownState).filter_by(
+        pair_state='locally_created').all()
+    assert_equals(len(pending), 11)
+
+    assert_equals(sync._synchronize_locally_created_bundle(pending, session),
+                  10)
+    assert_equals(SERVER.count_requests('NuxeoDrive.CreateFiles'), 1)
+    assert_equals(SERVER.count_requests('batch/upload'), 0)
+    synchronized = session.query(LastKnownState).filter_by(
+        pair_state='synchronized', folderish=False).all()
+    assert_equals(len(synchronized), 10)
+    for doc_pair in synchronized:
+        assert_equals(doc_pair.remote_digest, doc_pair.local_digest)
+        assert_equals(SERVER.get_content(doc_pair.remote_ref),
+                      local_client.get_content(doc_pair.local_path))
+
+    # A single file left: nothing to bundle
+    pending = session.query(LastKnownState).filter_by(
+        pair_state='locally_created').all()
+    assert_equals(sync._synchronize_locally_created_bundle(pending, session),
+                  0)
+    ctl.dispose()
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_bundle_failure():
+    remote_client = get_client()
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    local_client = LocalClient(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    sync = ctl.synchronizer
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    session.add(server_binding)
+
+    # The requests fail after the first one
+    create_files = SERVER.operations['NuxeoDrive.CreateFiles']['handler']
+    calls = []
+
+    def fail_after_first_bundle(params, op_input, headers):
+        calls.append(params)
+        if len(calls) > 1:
+            raise FakeServerError(500, "Server error")
+        return create_files(params, op_input, headers)
+
+    SERVER.operations['NuxeoDrive.CreateFiles']['handler'] = (
+        fail_after_first_bundle)
+
+    root_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    per_bundle = BUNDLE_MAX_SIZE // BUNDLE_MAX_FILE_SIZE
+    n_files = 2 * per_bundle + 1
+    make_files(local_folder, n_files, BUNDLE_MAX_FILE_SIZE)
+    for child in local_client.get_children_info(u'/'):
+        doc_pair = LastKnownState(local_folder, local_info=child)
+        doc_pair.update_state('created', 'unknown')
+        session.add(doc_pair)
+    session.commit()
+
+    assert_equals(sync.synchronize(server_binding), n_files)
+    # The second bundle failed and the remaining files were bundled again
+    # before falling back on one by one creations
+    assert_equals(len(calls), 3)
+    # The files of the first bundle were not created again
+    assert_equals(SERVER.count_requests('batch/upload'),
+                  n_files - per_bundle)
+    assert_equals(len(SERVER.items), n_files + 1)
+    for doc_pair in session.query(LastKnownState).filter_by(
+        folderish=False):
+        assert_equals(doc_pair.pair_state, 'synchronized')
+        assert_equals(SERVER.get_content(doc_pair.remote_ref),
+                      local_client.get_content(doc_pair.local_path))
+    ctl.dispose()
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import time
+from threading import Event
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.change_notifier import ChangeNotifier
+from nxdrive.client.change_notifier import WAIT_FOR_CHANGES_OPERATION
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.add_change_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client():
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@with_setup(setup_server, teardown_server)
+def test_change_notifier():
+    changed = Event()
+    notifier = ChangeNotifier(get_client, changed.set, max_wait=0.2)
+    notifier.start()
+    notifier.update_cursor(SERVER.sync_date, '')
+    assert_true(wait_for(notifier.is_active))
+    assert_false(changed.is_set())
+
+    SERVER.notify_change()
+    assert_true(changed.wait(5))
+    assert_true(notifier.has_changes())
+    # No more requests until the changes are fetched
+    n_requests = SERVER.count_requests(WAIT_FOR_CHANGES_OPERATION)
+    time.sleep(0.5)
+    assert_equals(SERVER.count_requests(WAIT_FOR_CHANGES_OPERATION),
+                  n_requests)
+
+    changed.clear()
+    notifier.update_cursor(SERVER.sync_date, '')
+    assert_false(notifier.has_changes())
+    SERVER.notify_change()
+    assert_true(changed.wait(5))
+    notifier.stop()
+    assert_false(notifier.is_active())
+
+
+@with_setup(setup_server, teardown_server)
+def test_unsupported_change_notification():
+    SERVER.operations.pop(WAIT_FOR_CHANGES_OPERATION)
+    notifier = ChangeNotifier(get_client, lambda: None)
+    notifier.start()
+    notifier.update_cursor(SERVER.sync_date, '')
+    assert_true(wait_for(lambda: not notifier.supported))
+    assert_false(notifier.is_active())
+
+
+@with_setup(setup_server, teardown_server)
+def test_notified_synchronization():
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    server_binding.last_sync_date = SERVER.sync_date
+    session.add(server_binding)
+    root_pair = LastKnownState(local_folder,
+        local_info=LocalClient(local_folder).get_info(u'/'),
+        remote_info=get_client().get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    session.commit()
+
+    sync = ctl.synchronizer
+    sync.change_notification_max_wait = 0.2
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+    notifier = sync._change_notifiers[local_folder]
+    assert_true(wait_for(notifier.is_active))
+
+    # The change summary is not polled without notification
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+
+    # A notification wakes the synchronization loop up
+    SERVER.notify_change()
+    assert_true(sync._wakeup.wait(5))
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 2)
+    assert_equals(server_binding.last_sync_date, SERVER.sync_date)
+    assert_false(notifier.has_changes())
+
+    # Polling stays as a fallback
+    sync._last_remote_polls[local_folder] -= (
+        sync.change_notification_polling_delay)
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 3)
+    ctl.dispose()
+    assert_false(notifier.is_active())
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.add_change_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def bind(session, name, remote_ids):
+    """Bind a local folder with pairs for the given remote items"""
+    local_folder = os.path.join(TEST_WORKSPACE, name)
+    os.mkdir(local_folder)
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    server_binding.last_sync_date = SERVER.sync_date
+    session.add(server_binding)
+    local_client = LocalClient(local_folder)
+    remote_client = RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                           'nxdrive-test-device', '1.0',
+                                           password='Administrator')
+    for remote_id in remote_ids:
+        remote_info = remote_client.get_info(remote_id)
+        if remote_id == SERVER.root_id:
+            local_path = u'/'
+        else:
+            local_path = local_client.make_folder(u'/', remote_info.name)
+        pair = LastKnownState(local_folder,
+                              local_info=local_client.get_info(local_path),
+                              remote_info=remote_info)
+        pair.update_state('synchronized', 'synchronized')
+        session.add(pair)
+    session.commit()
+    return server_binding
+
+
+@with_setup(setup_server, teardown_server)
+def test_shared_change_summary():
+    folder_id = SERVER.add_item(SERVER.root_id, u'Folder', folder=True)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    # Same server and user: the bindings share the change summaries
+    binding_1 = bind(session, u'Nuxeo Drive 1', [SERVER.root_id, folder_id])
+    binding_2 = bind(session, u'Nuxeo Drive 2', [SERVER.root_id])
+
+    file_id = SERVER.add_item(folder_id, u'File.txt', content='content')
+    SERVER.notify_change()
+    SERVER.file_system_changes.append({
+        'fileSystemItemId': file_id,
+        'fileSystemItem': SERVER.items[file_id],
+        'eventId': 'documentCreated',
+        'eventDate': 1001,
+    })
+
+    sync = ctl.synchronizer
+    shared_summaries = {}
+    for server_binding in (binding_1, binding_2):
+        sync.update_synchronize_server(server_binding, session=session,
+                                       shared_summaries=shared_summaries)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+
+    # The change is only applied to the binding of the parent folder
+    pairs = session.query(LastKnownState).filter_by(remote_ref=file_id)
+    assert_equals([pair.local_folder for pair in pairs],
+                  [binding_1.local_folder])
+    assert_equals(LocalClient(binding_1.local_folder).get_content(
+        u'/Folder/File.txt'), 'content')
+    # Each binding keeps its own checkpoint
+    assert_equals(binding_1.last_sync_date, SERVER.sync_date)
+    assert_equals(binding_2.last_sync_date, SERVER.sync_date)
+
+    # The summaries are not shared outside of a synchronization pass
+    SERVER.file_system_changes = []
+    SERVER.notify_change()
+    for server_binding in (binding_1, binding_2):
+        sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 3)
+    ctl.dispose()
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.base_automation_client import COMPRESSIBLE_MIME_TYPES
+from nxdrive.client.base_automation_client import REQUEST_COMPRESSION_MIN_SIZE
+from nxdrive.client.base_automation_client import get_decompressor
+from nxdrive.client.base_automation_client import gzip_compress
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+SERVER = None
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def get_client(**kwargs):
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator', **kwargs)
+
+
+def test_decompressors():
+    data = '{"entries": []}' * 1000
+    assert_equals(get_decompressor(None), None)
+    assert_equals(get_decompressor('identity'), None)
+
+    decompressor = get_decompressor('gzip')
+    assert_equals(decompressor.decompress(gzip_compress(data))
+                  + decompressor.flush(), data)
+
+    # The deflate encoding with or without the zlib wrapper
+    for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        compressed = compressor.compress(data) + compressor.flush()
+        decompressor = get_decompressor('deflate')
+        # Fed by chunks
+        decompressed = ''.join(decompressor.decompress(compressed[i:i + 10])
+                               for i in range(0, len(compressed), 10))
+        assert_equals(decompressed + decompressor.flush(), data)
+
+
+@with_setup(setup_server, teardown_server)
+def test_compressed_responses():
+    for encoding in ('gzip', 'deflate', 'raw-deflate'):
+        SERVER.response_encoding = encoding
+        # The operation registry is compressed too
+        remote_client = get_client()
+        info = remote_client.get_info(SERVER.root_id)
+        assert_equals(info.name, u'Nuxeo Drive')
+        method, path, headers = SERVER.requests[-1]
+        assert_equals(headers['accept-encoding'], 'gzip, deflate')
+
+
+@with_setup(setup_server, teardown_server)
+def test_compressed_requests():
+    remote_client = get_client(compress_requests=True)
+    # Small requests are sent as is
+    remote_client.get_info(SERVER.root_id)
+    assert_true('content-encoding' not in SERVER.requests[-1][2])
+
+    name = u'a' * REQUEST_COMPRESSION_MIN_SIZE
+    remote_client.execute('NuxeoDrive.GetFileSystemItem', id=name)
+    method, path, headers = SERVER.requests[-1]
+    assert_equals(headers['content-encoding'], 'gzip')
+    assert_true(int(headers['content-length']) < REQUEST_COMPRESSION_MIN_SIZE)
+
+
+@with_setup(setup_server, teardown_server)
+def test_compressed_uploads():
+    workspace = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    try:
+        remote_client = get_client(
+            upload_compression_types=COMPRESSIBLE_MIME_TYPES)
+        csv_content = ''.join('%d,%d,some text\n' % (i, i * i)
+                              for i in range(100000))
+        random_content = os.urandom(200000)
+        files = [
+            (u'export.csv', csv_content, True),
+            # Does not compress well
+            (u'random.txt', random_content, False),
+            # Not an allowed type
+            (u'export.bin', csv_content, False),
+        ]
+        for name, content, compressed in files:
+            file_path = os.path.join(workspace, name)
+            with open(file_path, 'wb') as f:
+                f.write(content)
+            digester = hashlib.md5()
+            fs_item_id = remote_client.stream_file(
+                SERVER.root_id, file_path, digester=digester)
+            assert_equals(SERVER.get_content(fs_item_id), content)
+            assert_equals(digester.hexdigest(),
+                          hashlib.md5(content).hexdigest())
+            upload = [r for r in SERVER.requests
+                      if r[1].endswith('batch/upload')][-1]
+            assert_equals(upload[2].get('content-encoding'),
+                          'gzip' if compressed else None)
+            assert_equals(int(upload[2]['x-file-size']), len(content))
+            if compressed:
+                saved = len(content) - int(upload[2]['content-length'])
+                assert_true(saved > len(content) / 2)
+                assert_equals(remote_client.upload_bytes_saved, saved)
+        assert_equals(remote_client.upload_bytes_saved, saved)
+        # No compressed tmp file is left behind
+        assert_equals([name for name in os.listdir(tempfile.gettempdir())
+                       if name.endswith('-nxdrive-compressed-upload')], [])
+    finally:
+        shutil.rmtree(workspace)
@@ -0,0 +1,70 @@
+from nose.tools import assert_equals
+from nose.tools import with_setup
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.response_cache import ResponseCache
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+SERVER = None
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.etag_operations = ('NuxeoDrive.GetChildren',
+                              'NuxeoDrive.GetTopLevelFolder')
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def get_client(response_cache):
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator',
+                                  response_cache=response_cache)
+
+
+def test_response_cache():
+    cache = ResponseCache(max_size=2)
+    cache.put('a', '"1"', [1])
+    cache.put('b', '"2"', [2])
+    assert_equals(cache.get('a'), ('"1"', [1]))
+    # The least recently used result is evicted
+    cache.put('c', '"3"', [3])
+    assert_equals(cache.get('b'), None)
+    assert_equals(len(cache), 2)
+    cache.discard('a')
+    assert_equals(cache.get('a'), None)
+
+
+@with_setup(setup_server, teardown_server)
+def test_conditional_listings():
+    SERVER.response_encoding = 'gzip'
+    cache = ResponseCache()
+    client = get_client(cache)
+    SERVER.add_item(SERVER.root_id, u'file.txt', content='content')
+    children = client.get_children_info(SERVER.root_id)
+    assert_equals([info.name for info in children], [u'file.txt'])
+    assert_equals(cache.hits, 0)
+
+    # Not modified: the cached listing is reused, also by another client
+    for client in (client, get_client(cache)):
+        children = client.get_children_info(SERVER.root_id)
+        assert_equals([info.name for info in children], [u'file.txt'])
+    assert_equals(cache.hits, 2)
+    assert_equals(client.get_filesystem_root_info().uid, SERVER.root_id)
+    assert_equals(client.get_filesystem_root_info().uid, SERVER.root_id)
+    assert_equals(cache.hits, 3)
+
+    # Modified listing
+    SERVER.add_item(SERVER.root_id, u'other.txt', content='other')
+    children = client.get_children_info(SERVER.root_id)
+    assert_equals(sorted(info.name for info in children),
+                  [u'file.txt', u'other.txt'])
+    assert_equals(cache.hits, 3)
+    children = client.get_children_info(SERVER.root_id)
+    assert_equals(len(children), 2)
+    assert_equals(cache.hits, 4)
@@ -0,0 +1,259 @@
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+from nxdrive.tests.fake_server import FakeServerError
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+CONTENT = os.urandom(100000)
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client():
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator')
+
+
+def get_synchronizer():
+    """Return a controller with a server binding and its synchronizer"""
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    session.add(server_binding)
+    session.commit()
+    return ctl, server_binding
+
+
+def fail(code):
+    def handler(params, op_input, headers):
+        raise FakeServerError(code, "Failure")
+    return handler
+
+
+@with_setup(setup_server, teardown_server)
+def test_copy_file():
+    SERVER.add_copy_operation()
+    remote_client = get_client()
+    ctl, server_binding = get_synchronizer()
+    folder_id = SERVER.add_item(SERVER.root_id, u'Folder', folder=True)
+    source_id = SERVER.add_item(SERVER.root_id, u'template.odt',
+                                content=CONTENT)
+
+    copy_id = ctl.synchronizer._copy_remote_file(
+        server_binding, remote_client, source_id, folder_id, u'project.odt')
+    assert_true(copy_id is not None)
+    assert_true(copy_id != source_id)
+    info = remote_client.get_info(copy_id)
+    assert_equals(info.name, u'project.odt')
+    assert_equals(info.parent_uid, folder_id)
+    assert_equals(info.digest, remote_client.get_info(source_id).digest)
+    assert_equals(remote_client.get_content(copy_id), CONTENT)
+    # No content was uploaded
+    assert_equals(SERVER.count_requests('batch/upload'), 0)
+    assert_equals(SERVER.count_requests('Document.Copy'), 1)
+    ctl.dispose()
+
+
+@with_setup(setup_server, teardown_server)
+def test_copy_file_not_possible():
+    remote_client = get_client()
+    ctl, server_binding = get_synchronizer()
+    sync = ctl.synchronizer
+    source_id = SERVER.add_item(SERVER.root_id, u'template.odt',
+                                content=CONTENT)
+    # Document.Copy is not available
+    assert_equals(sync._copy_remote_file(server_binding, remote_client,
+                                         source_id, SERVER.root_id,
+                                         u'project.odt'), None)
+
+    SERVER.add_copy_operation()
+    # Unknown source document
+    unknown_id = 'defaultFileSystemItemFactory#default#unknown'
+    assert_equals(sync._copy_remote_file(server_binding, remote_client,
+                                         unknown_id, SERVER.root_id,
+                                         u'project.odt'), None)
+    # Not an adapted document
+    assert_equals(sync._copy_remote_file(
+        server_binding, remote_client, source_id,
+        'org.nuxeo.drive.service.impl.DefaultTopLevelFolderItemFactory#',
+        u'project.odt'), None)
+    # The ids of the other factories do not hold a document uid
+    assert_equals(sync._copy_remote_file(
+        server_binding, remote_client, source_id,
+        'collectionSyncRootFolderItemFactory#default#uid',
+        u'project.odt'), None)
+    assert_equals(SERVER.count_requests('Document.Copy'), 1)
+    assert_equals(len(SERVER.items), 2)
+
+    # The copy cannot be renamed: it is deleted
+    SERVER.register_operation('NuxeoDrive.Rename', fail(500),
+                              params=[('id', True), ('name', True)])
+    assert_equals(sync._copy_remote_file(server_binding, remote_client,
+                                         source_id, SERVER.root_id,
+                                         u'project.odt'), None)
+    assert_equals(len(SERVER.items), 2)
+
+    # A failure to delete it does not hide the renaming failure
+    SERVER.register_operation('NuxeoDrive.Delete', fail(500),
+                              params=[('id', True)])
+    assert_equals(sync._copy_remote_file(server_binding, remote_client,
+                                         source_id, SERVER.root_id,
+                                         u'project.odt'), None)
+    assert_equals(len(SERVER.items), 3)
+    ctl.dispose()
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_copy_remote_duplicate():
+    SERVER.add_copy_operation()
+    remote_client = get_client()
+    ctl, server_binding = get_synchronizer()
+    local_folder = server_binding.local_folder
+    local_client = LocalClient(local_folder)
+    session = ctl.get_session()
+    sync = ctl.synchronizer
+
+    # A synchronized file
+    source_id = SERVER.add_item(SERVER.root_id, u'template.odt',
+                                content=CONTENT)
+    local_client.make_file(u'/', u'template.odt', content=CONTENT)
+    source_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/template.odt'),
+        remote_info=remote_client.get_info(source_id))
+    source_pair.update_state('synchronized', 'synchronized')
+    session.add(source_pair)
+
+    # Locally created copy: the remote file is copied
+    local_client.make_file(u'/', u'project.odt', content=CONTENT)
+    doc_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/project.odt'))
+    session.add(doc_pair)
+    session.commit()
+    remote_ref, digester = sync._copy_remote_duplicate(
+        session, doc_pair, local_client, remote_client, SERVER.root_id,
+        u'project.odt')
+    assert_true(remote_ref is not None)
+    assert_equals(digester.hexdigest(), doc_pair.local_digest)
+    assert_equals(remote_client.get_info(remote_ref).name, u'project.odt')
+    assert_equals(remote_client.get_content(remote_ref), CONTENT)
+
+    # Locally created file with another content: it has to be uploaded
+    local_client.make_file(u'/', u'other.odt', content='other content')
+    doc_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/other.odt'))
+    session.add(doc_pair)
+    session.commit()
+    remote_ref, digester = sync._copy_remote_duplicate(
+        session, doc_pair, local_client, remote_client, SERVER.root_id,
+        u'other.odt')
+    assert_equals(remote_ref, None)
+    assert_equals(SERVER.count_requests('batch/upload'), 0)
+
+    # Without copy support the local content is not read for nothing
+    SERVER.operations.pop('Document.Copy')
+    ctl.invalidate_client_cache()
+    local_client.make_file(u'/', u'project-2.odt', content=CONTENT)
+    doc_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/project-2.odt'))
+    session.add(doc_pair)
+    session.commit()
+    read_paths = []
+    local_client.update_digester = lambda path, digester: read_paths.append(
+        path)
+    assert_equals(sync._copy_remote_duplicate(
+        session, doc_pair, local_client, remote_client, SERVER.root_id,
+        u'project-2.odt'), (None, None))
+    assert_equals(read_paths, [])
+    ctl.dispose()
+
+
+def count_downloads():
+    return len([r for r in SERVER.requests if '/nxbigfile/' in r[1]])
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_copy_local_duplicate():
+    remote_client = get_client()
+    ctl, server_binding = get_synchronizer()
+    local_folder = server_binding.local_folder
+    local_client = LocalClient(local_folder)
+    session = ctl.get_session()
+    sync = ctl.synchronizer
+
+    root_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    # A synchronized file
+    source_id = SERVER.add_item(SERVER.root_id, u'template.odt',
+                                content=CONTENT)
+    local_client.make_file(u'/', u'template.odt', content=CONTENT)
+    source_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/template.odt'),
+        remote_info=remote_client.get_info(source_id))
+    source_pair.update_state('synchronized', 'synchronized')
+    session.add(source_pair)
+    session.commit()
+
+    def add_remote_copy(name):
+        copy_id = SERVER.add_item(SERVER.root_id, name, content=CONTENT)
+        doc_pair = LastKnownState(local_folder,
+            remote_info=remote_client.get_info(copy_id))
+        doc_pair.update_state(remote_state='created')
+        session.add(doc_pair)
+        session.commit()
+        assert_equals(doc_pair.pair_state, 'remotely_created')
+        return doc_pair
+
+    # Remotely created copy: the local file is copied
+    doc_pair = add_remote_copy(u'project.odt')
+    sync.synchronize_one(doc_pair, session=session)
+    assert_equals(doc_pair.pair_state, 'synchronized')
+    assert_equals(local_client.get_content(u'/project.odt'), CONTENT)
+    assert_equals(doc_pair.local_digest, source_pair.remote_digest)
+    assert_equals(count_downloads(), 0)
+    assert_equals(sync.saved_download_bytes, len(CONTENT))
+
+    # The local files have been modified since their synchronization: the
+    # content is downloaded
+    for pair in (source_pair, doc_pair):
+        with open(pair.get_local_abspath(), 'wb') as f:
+            f.write('modified content')
+    doc_pair = add_remote_copy(u'project-2.odt')
+    sync.synchronize_one(doc_pair, session=session)
+    assert_equals(doc_pair.pair_state, 'synchronized')
+    assert_equals(local_client.get_content(u'/project-2.odt'), CONTENT)
+    assert_equals(count_downloads(), 1)
+    assert_equals(sync.saved_download_bytes, len(CONTENT))
+    # No tmp file is left behind
+    assert_equals(sorted(os.listdir(local_folder)),
+                  [u'project-2.odt', u'project.odt', u'template.odt'])
+    ctl.dispose()
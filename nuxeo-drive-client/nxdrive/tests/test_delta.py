@@ -0,0 +1,227 @@
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+from cStringIO import StringIO
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_raises
+from nose.tools import with_setup
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.delta import DeltaTooBig
+from nxdrive.client.delta import Signature
+from nxdrive.client.delta import SignatureBuilder
+from nxdrive.client.delta import SignatureStore
+from nxdrive.client.delta import apply_delta
+from nxdrive.client.delta import compute_delta
+from nxdrive.client.delta import roll
+from nxdrive.client.delta import strong_checksum
+from nxdrive.client.delta import weak_checksum
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+BLOCK_SIZE = 4096
+BASE = ''.join(chr(random.randint(0, 255))
+               for _ in range(50 * BLOCK_SIZE + 123))
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_workspace():
+    global TEST_WORKSPACE
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+
+
+def teardown_workspace():
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def setup_server():
+    global SERVER
+    setup_workspace()
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    teardown_workspace()
+
+
+def get_signature(content, block_size=BLOCK_SIZE):
+    builder = SignatureBuilder(block_size)
+    # Chunks not aligned on blocks
+    for i in range(0, len(content), 10000):
+        builder.update(memoryview(content)[i:i + 10000])
+    return builder.signature()
+
+
+def write_file(content):
+    file_path = os.path.join(TEST_WORKSPACE, 'file.bin')
+    with open(file_path, 'wb') as f:
+        f.write(content)
+    return file_path
+
+
+def check_delta(base, new, **kwargs):
+    signature = get_signature(base)
+    file_path = write_file(new)
+    delta = StringIO()
+    builder = SignatureBuilder(BLOCK_SIZE)
+    with io.open(file_path, 'rb', buffering=0) as f:
+        literal_size = compute_delta(f, signature, delta, builder=builder,
+                                     buffer_size=3 * BLOCK_SIZE + 17,
+                                     **kwargs)
+    out = StringIO()
+    apply_delta(StringIO(base), StringIO(delta.getvalue()), out, BLOCK_SIZE)
+    assert_equals(out.getvalue(), new)
+    # The content was fed to the builder while computing the delta
+    assert_equals(builder.hexdigest(), hashlib.md5(new).hexdigest())
+    assert_equals(builder.signature().blocks, get_signature(new).blocks)
+    return literal_size
+
+
+def test_roll():
+    data = BASE[:3 * BLOCK_SIZE]
+    checksum = weak_checksum(data[:BLOCK_SIZE])
+    for i in range(2 * BLOCK_SIZE):
+        checksum = roll(checksum, ord(data[i]), ord(data[i + BLOCK_SIZE]),
+                        BLOCK_SIZE)
+        assert_equals(checksum, weak_checksum(data[i + 1:i + 1 + BLOCK_SIZE]))
+
+
+def test_signature_builder():
+    expected = [(weak_checksum(BASE[i:i + BLOCK_SIZE]),
+                 strong_checksum(BASE[i:i + BLOCK_SIZE]))
+                for i in range(0, len(BASE), BLOCK_SIZE)]
+    # Chunks smaller than, aligned on and bigger than the blocks
+    for chunk_size in (1000, BLOCK_SIZE, 3 * BLOCK_SIZE + 17):
+        builder = SignatureBuilder(BLOCK_SIZE)
+        buffer_ = bytearray(BASE)
+        for i in range(0, len(BASE), chunk_size):
+            builder.update(memoryview(buffer_)[i:i + chunk_size])
+        assert_equals(builder.signature().blocks, expected)
+        assert_equals(builder.size, len(BASE))
+    # Strings are processed in place too
+    builder = SignatureBuilder(BLOCK_SIZE)
+    builder.update(BASE)
+    assert_equals(builder.signature().blocks, expected)
+
+    # Only the digest of a small content is computed
+    builder = SignatureBuilder(BLOCK_SIZE, min_size=len(BASE) + 1)
+    builder.set_expected_size(len(BASE))
+    builder.update(memoryview(BASE))
+    assert_equals(builder.hexdigest(), hashlib.md5(BASE).hexdigest())
+    assert_equals(builder.signature(), None)
+
+
+@with_setup(setup_workspace, teardown_workspace)
+def test_delta():
+    # Same content: no literal bytes
+    assert_equals(check_delta(BASE, BASE), 0)
+
+    # In place modification
+    new = BASE[:10000] + 'modified' + BASE[10008:]
+    assert_true(check_delta(BASE, new) <= 2 * BLOCK_SIZE)
+
+    # Insertion shifting the rest of the content, deletion, append
+    new = BASE[:10000] + 'inserted' + BASE[10000:]
+    assert_true(check_delta(BASE, new) <= 2 * BLOCK_SIZE)
+    new = BASE[:10000] + BASE[30000:]
+    assert_true(check_delta(BASE, new) <= 2 * BLOCK_SIZE)
+    new = BASE + 'appended'
+    assert_true(check_delta(BASE, new) <= 2 * BLOCK_SIZE)
+
+    # Small and empty files
+    assert_equals(check_delta(BASE, 'small'), 5)
+    assert_equals(check_delta(BASE, ''), 0)
+    assert_equals(check_delta('', BASE), len(BASE))
+
+
+@with_setup(setup_workspace, teardown_workspace)
+def test_delta_too_big():
+    new = os.urandom(len(BASE))
+    assert_raises(DeltaTooBig, check_delta, BASE, new,
+                  min_literal_check=BLOCK_SIZE)
+
+
+@with_setup(setup_workspace, teardown_workspace)
+def test_signature_store():
+    store = SignatureStore(os.path.join(TEST_WORKSPACE, 'signatures'))
+    assert_equals(store.get(u'/sync/root', u'ref#1'), None)
+
+    signature = get_signature(BASE)
+    store.save(u'/sync/root', u'ref#1', signature)
+    loaded = store.get(u'/sync/root', u'ref#1')
+    assert_equals(loaded.digest, hashlib.md5(BASE).hexdigest())
+    assert_equals(loaded.size, len(BASE))
+    assert_equals(loaded.block_size, BLOCK_SIZE)
+    assert_equals(loaded.blocks, signature.blocks)
+
+    store.delete(u'/sync/root', u'ref#1')
+    assert_equals(store.get(u'/sync/root', u'ref#1'), None)
+    store.save(u'/sync/root', u'ref#1', signature)
+    store.delete_all(u'/sync/root')
+    assert_equals(store.get(u'/sync/root', u'ref#1'), None)
+
+
+def get_uploaded_sizes():
+    return [int(headers['x-file-size'])
+            for method, path, headers in SERVER.requests
+            if path.endswith('batch/upload')]
+
+
+@with_setup(setup_server, teardown_server)
+def test_delta_upload():
+    SERVER.add_delta_operation()
+    remote_client = RemoteFileSystemClient(
+        SERVER.url, 'Administrator', 'nxdrive-test-device', '1.0',
+        password='Administrator')
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'file.bin', content=BASE)
+    signature = get_signature(BASE)
+
+    new = BASE[:10000] + 'inserted' + BASE[10000:]
+    file_path = write_file(new)
+    builder = remote_client.stream_update_delta(
+        fs_item_id, file_path, signature, filename=u'file.bin',
+        digester=hashlib.md5())
+    assert_equals(SERVER.get_content(fs_item_id), new)
+    assert_equals(builder.hexdigest(), hashlib.md5(new).hexdigest())
+    assert_true(get_uploaded_sizes()[-1] < 3 * BLOCK_SIZE)
+
+    # Outdated signature: full upload
+    new_2 = new + 'appended'
+    file_path = write_file(new_2)
+    builder = remote_client.stream_update_delta(
+        fs_item_id, file_path, signature, filename=u'file.bin',
+        digester=hashlib.md5())
+    assert_equals(SERVER.get_content(fs_item_id), new_2)
+    assert_equals(builder.hexdigest(), hashlib.md5(new_2).hexdigest())
+    assert_equals(get_uploaded_sizes()[-1], len(new_2))
+
+    # The signature of the uploaded content can be used for the next delta
+    signature = builder.signature()
+    new_3 = 'prepended' + new_2
+    file_path = write_file(new_3)
+    remote_client.stream_update_delta(fs_item_id, file_path, signature,
+                                      filename=u'file.bin')
+    assert_equals(SERVER.get_content(fs_item_id), new_3)
+    assert_true(get_uploaded_sizes()[-1] < 3 * BLOCK_SIZE)
+
+
+@with_setup(setup_server, teardown_server)
+def test_delta_upload_not_supported():
+    remote_client = RemoteFileSystemClient(
+        SERVER.url, 'Administrator', 'nxdrive-test-device', '1.0',
+        password='Administrator')
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'file.bin', content=BASE)
+    new = 'prepended' + BASE
+    file_path = write_file(new)
+    builder = remote_client.stream_update_delta(
+        fs_item_id, file_path, get_signature(BASE), filename=u'file.bin')
+    assert_equals(SERVER.get_content(fs_item_id), new)
+    assert_equals(get_uploaded_sizes(), [len(new)])
+    assert_true(isinstance(builder.signature(), Signature))
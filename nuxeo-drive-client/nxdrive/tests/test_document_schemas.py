@@ -0,0 +1,79 @@
+from nose.tools import assert_equals
+from nose.tools import with_setup
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.remote_document_client import INFO_SCHEMAS
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+SERVER = None
+
+DOC = {
+    'uid': 'doc-uid',
+    'path': '/default-domain/workspaces/folder/doc',
+    'type': 'File',
+    'facets': [],
+    'lastModified': '2013-06-24T15:42:03.00Z',
+    'properties': {
+        'dc:title': u'doc',
+        'file:content': {'digest': 'd41d8cd98f00b204e9800998ecf8427e'},
+    },
+}
+
+FOLDER = {
+    'uid': 'folder-uid',
+    'path': '/default-domain/workspaces/folder',
+    'type': 'Folder',
+    'facets': ['Folderish'],
+    'lastModified': '2013-06-24T15:42:03.00Z',
+    'properties': {'dc:title': u'folder'},
+}
+
+def _query(params, op_input, headers):
+    return {'entries': [DOC]}
+
+
+def _fetch(params, op_input, headers):
+    return FOLDER if params['value'] == FOLDER['path'] else DOC
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.register_operation(
+        'Document.Query', _query,
+        params=[('query', True), ('language', False)])
+    SERVER.register_operation(
+        'Document.Fetch', _fetch, params=[('value', True)])
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def get_schemas(op_id):
+    path = '/' + SERVER.context + 'site/automation/' + op_id
+    return [headers['x-nxdocumentproperties']
+            for method, path_, headers in SERVER.requests if path_ == path]
+
+
+def get_client():
+    return RemoteDocumentClient(SERVER.url, 'Administrator',
+                                'nxdrive-test-device', '1.0',
+                                password='Administrator')
+
+
+@with_setup(setup_server, teardown_server)
+def test_document_schemas():
+    client = get_client()
+    info = client.get_info('doc-uid')
+    assert_equals(info.name, u'doc')
+    assert_equals(info.digest, 'd41d8cd98f00b204e9800998ecf8427e')
+    # Only the schemas read by the client are requested
+    assert_equals(get_schemas('Document.Query'), [INFO_SCHEMAS])
+    assert_equals(get_schemas('Document.Fetch'), [INFO_SCHEMAS])
+
+    # Fetching a document returns all its schemas by default
+    client.fetch('doc-uid')
+    assert_equals(get_schemas('Document.Fetch')[-1], '*')
+    client.fetch('doc-uid', schemas='dublincore')
+    assert_equals(get_schemas('Document.Fetch')[-1], 'dublincore')
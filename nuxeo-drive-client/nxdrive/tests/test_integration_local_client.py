@@ -196,6 +196,24 @@ def test_get_new_file():
     assert_false(os.path.exists(os_path))
 
 
+@with_temp_folder
+def test_copy_content():
+    doc = lcclient.make_file(TEST_WORKSPACE, u'Document.txt',
+                             content=SOME_TEXT_CONTENT)
+    path, os_path, name = lcclient.get_new_file(TEST_WORKSPACE,
+                                                u'Copy.txt')
+    digester = hashlib.md5()
+    lcclient.copy_content(doc, os_path, digester=digester,
+                          durability='fsync')
+    assert_equal(lcclient.get_content(path), SOME_TEXT_CONTENT)
+    assert_equal(digester.hexdigest(), SOME_TEXT_DIGEST)
+
+    # Overwrite an existing file
+    lcclient.update_content(doc, b"Other content")
+    lcclient.copy_content(doc, os_path)
+    assert_equal(lcclient.get_content(path), b"Other content")
+
+
 @with_temp_folder
 def test_get_path():
     abs_path = os.path.join(
@@ -0,0 +1,141 @@
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.operation_chain import CHAIN_OPERATION
+from nxdrive.client.operation_chain import ChainError
+from nxdrive.tests.fake_server import FakeAutomationServer
+from nxdrive.tests.fake_server import FakeBlob
+
+
+SERVER = None
+
+DOCUMENTS = {}
+
+
+def _create_document(params, op_input, headers):
+    uid = 'doc-%d' % len(DOCUMENTS)
+    DOCUMENTS[uid] = {
+        'parent': op_input[len('doc:'):],
+        'name': params['name'],
+        'properties': params['properties'],
+        'content': None,
+    }
+    return {'entity-type': 'document', 'uid': uid}
+
+
+def _attach_blob(params, op_input, headers):
+    DOCUMENTS[params['document']]['content'] = op_input['content']
+    return FakeBlob(op_input['content'])
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.register_operation(
+        'Document.Create', _create_document,
+        params=[('type', True), ('name', False), ('properties', False)])
+    SERVER.register_operation(
+        'Blob.Attach', _attach_blob, params=[('document', False)])
+    DOCUMENTS.clear()
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def get_client(client_class=RemoteFileSystemClient):
+    return client_class(SERVER.url, 'Administrator', 'nxdrive-test-device',
+                        '1.0', password='Administrator')
+
+
+def check_move_and_rename(chained):
+    if chained:
+        SERVER.add_chain_operation()
+    client = get_client()
+    assert_equals(client.is_chaining_supported(), chained)
+    folder_id = SERVER.add_item(SERVER.root_id, u'Folder', folder=True)
+    sub_folder_id = SERVER.add_item(folder_id, u'Sub Folder', folder=True)
+    file_id = SERVER.add_item(SERVER.root_id, u'file.txt', content='content')
+
+    info = client.move_and_rename(file_id, new_parent_id=folder_id,
+                                  new_name=u'renamed.txt')
+    assert_equals(info.uid, file_id)
+    assert_equals(info.parent_uid, folder_id)
+    assert_equals(info.name, u'renamed.txt')
+    assert_equals(SERVER.get_content(file_id), 'content')
+    if chained:
+        assert_equals(SERVER.count_requests(CHAIN_OPERATION), 1)
+        assert_equals(SERVER.count_requests('NuxeoDrive.Move'), 0)
+    else:
+        assert_equals(SERVER.count_requests('NuxeoDrive.CanMove'), 1)
+        assert_equals(SERVER.count_requests('NuxeoDrive.Move'), 1)
+        assert_equals(SERVER.count_requests('NuxeoDrive.Rename'), 1)
+
+    # The guard stops the chain: a folder cannot be moved to its child
+    assert_equals(client.move_and_rename(folder_id,
+                                         new_parent_id=sub_folder_id,
+                                         new_name=u'Other'), None)
+    assert_equals(SERVER.items[folder_id]['parentId'], SERVER.root_id)
+    assert_equals(SERVER.items[folder_id]['name'], u'Folder')
+    assert_equals(client.move_and_rename('missing',
+                                         new_parent_id=folder_id), None)
+
+    # Batched reads
+    infos = client.get_infos([folder_id, 'missing', sub_folder_id])
+    assert_equals(infos[0].uid, folder_id)
+    assert_equals(infos[1], None)
+    assert_equals(infos[2].parent_uid, folder_id)
+
+    # Failures are reported with the index of the failed call
+    with assert_raises(ChainError) as cm:
+        client.move_and_rename('missing', new_name=u'Other')
+    assert_equals(cm.exception.index, 0)
+    assert_equals(cm.exception.results, [])
+    assert_equals(cm.exception.code, 404)
+
+
+@with_setup(setup_server, teardown_server)
+def test_move_and_rename():
+    check_move_and_rename(False)
+
+
+@with_setup(setup_server, teardown_server)
+def test_chained_move_and_rename():
+    check_move_and_rename(True)
+
+
+@with_setup(setup_server, teardown_server)
+def test_create_and_attach():
+    client = get_client(RemoteDocumentClient)
+    assert_false(client.is_chaining_supported())
+    uid = client.make_file('parent-uid', u'File 1.txt', content='aaa')
+    assert_equals(DOCUMENTS[uid]['content'], 'aaa')
+    assert_equals(SERVER.count_requests('Document.Create'), 1)
+    assert_equals(SERVER.count_requests('batch/execute'), 1)
+    # The document is created before streaming its blob
+    paths = [path for _, path, _ in SERVER.requests]
+    assert_true(paths.index('/nuxeo/site/automation/Document.Create')
+                < paths.index('/nuxeo/site/automation/batch/upload'))
+
+    SERVER.add_chain_operation()
+    client = get_client(RemoteDocumentClient)
+    assert_true(client.is_chaining_supported())
+    uid = client.make_file('parent-uid', u'File 2.txt', content='bbb')
+    assert_equals(DOCUMENTS[uid], {
+        'parent': 'parent-uid',
+        'name': u'File 2.txt',
+        'properties': u'dc:title=File 2.txt',
+        'content': 'bbb',
+    })
+    # A single request to create the document and attach the blob
+    assert_equals(SERVER.count_requests('batch/execute'), 2)
+    assert_equals(SERVER.count_requests('Document.Create'), 1)
+
+    # Without content
+    uid = client.make_file('parent-uid', u'Empty')
+    assert_equals(DOCUMENTS[uid]['content'], None)
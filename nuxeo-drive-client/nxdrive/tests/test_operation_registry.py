@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.operation_registry import OperationRegistry
+from nxdrive.client.operation_registry import RegistryCache
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client(registry_cache):
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator',
+                                  registry_cache=registry_cache)
+
+
+def get_registry_requests():
+    registry_path = '/' + SERVER.context + 'site/automation/'
+    return [headers for method, path, headers in SERVER.requests
+            if method == 'GET' and path == registry_path]
+
+
+@with_setup(setup_server, teardown_server)
+def test_registry_revalidation():
+    cache_folder = os.path.join(TEST_WORKSPACE, 'registry')
+    client = get_client(RegistryCache(cache_folder))
+    assert_equals(SERVER.registry_downloads, 1)
+    assert_true('NuxeoDrive.CreateFile' in client.operations)
+    assert_equals(len(os.listdir(cache_folder)), 1)
+
+    # A new process reads the registry from the disk and only revalidates
+    # it
+    client = get_client(RegistryCache(cache_folder))
+    assert_equals(SERVER.registry_downloads, 1)
+    assert_true('if-none-match' in get_registry_requests()[-1])
+    assert_true('NuxeoDrive.CreateFile' in client.operations)
+    assert_equals(client.get_fs_item(SERVER.root_id)['id'], SERVER.root_id)
+
+    # The server registry changed: it is downloaded again
+    SERVER.add_copy_operation()
+    cache = RegistryCache(cache_folder)
+    client = get_client(cache)
+    assert_equals(SERVER.registry_downloads, 2)
+    assert_true('Document.Copy' in client.operations)
+    assert_true('Document.Copy' in cache.get(client.automation_url).operations)
+
+    # An invalid cache file is ignored
+    for filename in os.listdir(cache_folder):
+        with open(os.path.join(cache_folder, filename), 'wb') as f:
+            f.write('{"truncated')
+    client = get_client(RegistryCache(cache_folder))
+    assert_equals(SERVER.registry_downloads, 3)
+    assert_true('Document.Copy' in client.operations)
+
+
+@with_setup(setup_server, teardown_server)
+def test_registry_without_validator():
+    SERVER.registry_etag = False
+    cache_folder = os.path.join(TEST_WORKSPACE, 'registry')
+    cache = RegistryCache(cache_folder)
+    client = get_client(cache)
+    assert_equals(SERVER.registry_downloads, 1)
+
+    # Reused without any request by the new clients, and processes
+    for cache in (cache, RegistryCache(cache_folder)):
+        client = get_client(cache)
+        assert_equals(len(get_registry_requests()), 1)
+        assert_true('NuxeoDrive.CreateFile' in client.operations)
+    assert_equals(client.get_fs_item(SERVER.root_id)['id'], SERVER.root_id)
+
+    # Downloaded again once expired
+    SERVER.add_copy_operation()
+    cache.ttl = 0
+    client = get_client(cache)
+    assert_equals(SERVER.registry_downloads, 2)
+    assert_true('Document.Copy' in client.operations)
+
+
+def test_check_params():
+    registry = OperationRegistry([
+        {'id': 'Op', 'params': [{'name': 'id', 'required': True},
+                                {'name': 'name', 'required': False}]},
+    ])
+    registry.check_params('Op', {'id': 'ref'})
+    registry.check_params('Op', {'id': 'ref', 'name': 'file.txt'})
+    assert_raises(ValueError, registry.check_params, 'Op', {})
+    assert_raises(ValueError, registry.check_params, 'Op',
+                  {'id': 'ref', 'other': 'value'})
+    assert_raises(ValueError, registry.check_params, 'Unknown', {})
+
+    # Cannot be revalidated without an ETag or a modification date
+    assert_true(not registry.has_validators())
+    assert_true(registry.is_fresh(60))
+    assert_true(not registry.is_fresh(60, now=registry.fetch_time + 61))
+    registry = OperationRegistry.from_json(OperationRegistry(
+        registry.operations.values(), etag='"1"').to_json())
+    assert_equals(registry.etag, '"1"')
+    assert_raises(ValueError, registry.check_params, 'Op', {})
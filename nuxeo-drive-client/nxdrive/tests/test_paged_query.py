@@ -0,0 +1,95 @@
+import time
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+SERVER = None
+
+DOC = {
+    'uid': 'doc-uid',
+    'path': '/default-domain/workspaces/folder/doc',
+    'type': 'File',
+    'facets': [],
+    'lastModified': '2013-06-24T15:42:03.00Z',
+    'properties': {
+        'dc:title': u'doc',
+        'file:content': {'digest': 'd41d8cd98f00b204e9800998ecf8427e'},
+    },
+}
+
+FOLDER = {
+    'uid': 'folder-uid',
+    'path': '/default-domain/workspaces/folder',
+    'type': 'Folder',
+    'facets': ['Folderish'],
+    'lastModified': '2013-06-24T15:42:03.00Z',
+    'properties': {'dc:title': u'folder'},
+}
+
+
+def _fetch(params, op_input, headers):
+    return FOLDER if params['value'] == FOLDER['path'] else DOC
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.register_operation(
+        'Document.Fetch', _fetch, params=[('value', True)])
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def get_client():
+    return RemoteDocumentClient(SERVER.url, 'Administrator',
+                                'nxdrive-test-device', '1.0',
+                                password='Administrator')
+
+
+@with_setup(setup_server, teardown_server)
+def test_paged_query():
+    docs = [dict(DOC, uid='doc-uid-%d' % i,
+                 path='/default-domain/workspaces/folder/doc-%d' % i)
+            for i in range(25)]
+    pages = []
+
+    def paged_query(params, op_input, headers):
+        page_size = params['pageSize']
+        index = params['currentPageIndex']
+        pages.append(index)
+        return {
+            'entries': docs[index * page_size:(index + 1) * page_size],
+            'isNextPageAvailable': (index + 1) * page_size < len(docs),
+        }
+
+    SERVER.register_operation(
+        'Document.Query', paged_query,
+        params=[('query', True), ('language', False), ('pageSize', False),
+                ('currentPageIndex', False)])
+    client = get_client()
+    assert_true(client.is_paging_supported())
+
+    for prefetch in (False, True):
+        del pages[:]
+        results = client.iter_query("SELECT * FROM Document", page_size=10,
+                                    prefetch=prefetch)
+        # The pages are requested lazily, the next one in the background
+        # with prefetch
+        assert_equals(next(results)['uid'], 'doc-uid-0')
+        expected = [0, 1] if prefetch else [0]
+        deadline = time.time() + 5
+        while pages != expected and time.time() < deadline:
+            time.sleep(0.01)
+        assert_equals(pages, expected)
+        uids = ['doc-uid-0'] + [doc['uid'] for doc in results]
+        assert_equals(uids, [doc['uid'] for doc in docs])
+        assert_equals(pages, [0, 1, 2])
+
+    # All the children are listed, whatever their number
+    children = client.get_children_info('folder-uid', limit=10)
+    assert_equals(len(children), len(docs))
@@ -0,0 +1,97 @@
+from nose.tools import assert_equals
+from nose.tools import with_setup
+from nxdrive.client import RemoteDocumentClient
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+SERVER = None
+
+DOC = {
+    'uid': 'doc-uid',
+    'path': '/default-domain/workspaces/folder/doc',
+    'type': 'File',
+    'facets': [],
+    'lastModified': '2013-06-24T15:42:03.00Z',
+    'properties': {
+        'dc:title': u'doc',
+        'file:content': {'digest': 'd41d8cd98f00b204e9800998ecf8427e'},
+    },
+}
+
+FOLDER = {
+    'uid': 'folder-uid',
+    'path': '/default-domain/workspaces/folder',
+    'type': 'Folder',
+    'facets': ['Folderish'],
+    'lastModified': '2013-06-24T15:42:03.00Z',
+    'properties': {'dc:title': u'folder'},
+}
+
+CHILDREN = [dict(DOC, uid='doc-uid-%d' % i,
+                 path='/default-domain/workspaces/folder/doc-%d' % i)
+            for i in range(10)]
+
+
+def _query(params, op_input, headers):
+    if 'ecm:parentId' in params['query']:
+        return {'entries': CHILDREN}
+    return {'entries': [DOC]}
+
+
+def _fetch(params, op_input, headers):
+    return FOLDER if params['value'] == FOLDER['path'] else DOC
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.register_operation(
+        'Document.Query', _query,
+        params=[('query', True), ('language', False)])
+    SERVER.register_operation(
+        'Document.Fetch', _fetch, params=[('value', True)])
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def get_schemas(op_id):
+    path = '/' + SERVER.context + 'site/automation/' + op_id
+    return [headers['x-nxdocumentproperties']
+            for method, path_, headers in SERVER.requests if path_ == path]
+
+
+def get_client():
+    return RemoteDocumentClient(SERVER.url, 'Administrator',
+                                'nxdrive-test-device', '1.0',
+                                password='Administrator')
+
+
+@with_setup(setup_server, teardown_server)
+def test_parent_uid_cache():
+    client = get_client()
+    # A single query checks the existence and gets the document, the parent
+    # uid is fetched once
+    for _ in range(3):
+        info = client.get_info('doc-uid')
+        assert_equals(info.parent_uid, 'folder-uid')
+    assert_equals(len(get_schemas('Document.Query')), 3)
+    assert_equals(len(get_schemas('Document.Fetch')), 1)
+
+    # The children of a folder are listed by a single request
+    children = client.get_children_info('folder-uid')
+    assert_equals(len(children), len(CHILDREN))
+    assert_equals(set(info.parent_uid for info in children),
+                  set(['folder-uid']))
+    assert_equals(len(get_schemas('Document.Query')), 4)
+    assert_equals(len(get_schemas('Document.Fetch')), 1)
+
+    # No fetch at all when the server sends the parent ref
+    DOC['parentRef'] = 'folder-uid'
+    try:
+        client = get_client()
+        assert_equals(client.get_info('doc-uid').parent_uid, 'folder-uid')
+        assert_equals(len(get_schemas('Document.Fetch')), 1)
+    finally:
+        del DOC['parentRef']
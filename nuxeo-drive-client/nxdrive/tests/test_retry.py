@@ -0,0 +1,219 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import urllib2
+from mimetools import Message
+from StringIO import StringIO
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.retry import CircuitBreaker
+from nxdrive.client.retry import METADATA_OPERATIONS
+from nxdrive.client.retry import RetryPolicy
+from nxdrive.client.retry import TRANSFER_OPERATIONS
+from nxdrive.client.retry import get_retry_policy
+from nxdrive.client.retry import get_retry_after
+from nxdrive.client.retry import is_server_failure
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+from nxdrive.tests.fake_server import FakeServerError
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def http_error(code, headers=''):
+    return urllib2.HTTPError('http://localhost/', code, 'error',
+                             Message(StringIO(headers)), None)
+
+
+def test_retry_policy():
+    policy = RetryPolicy(5, 60, rng=lambda: 1.0)
+    assert_equals([policy.get_delay(n) for n in range(1, 7)],
+                  [5, 10, 20, 40, 60, 60])
+    # Jitter: between half and the whole delay
+    policy = RetryPolicy(5, 60, rng=lambda: 0.0)
+    assert_equals(policy.get_delay(3), 10)
+    assert_equals(policy.get_delay(1000), 30)
+    # The Retry-After delay is honored, within the limit
+    assert_equals(policy.get_delay(1, retry_after=42), 42)
+    assert_equals(policy.get_delay(1, retry_after=3600), 60)
+
+
+def test_retry_after():
+    assert_equals(get_retry_after(http_error(503, 'Retry-After: 120\n')),
+                  120)
+    error = http_error(503, 'Retry-After: Wed, 21 Oct 2015 07:28:00 GMT\n')
+    assert_equals(get_retry_after(error, now=1445412480 - 30), 30)
+    assert_equals(get_retry_after(http_error(503)), None)
+    assert_equals(get_retry_after(socket.error()), None)
+
+    assert_true(is_server_failure(http_error(503)))
+    assert_true(is_server_failure(http_error(500)))
+    assert_true(is_server_failure(urllib2.URLError('refused')))
+    assert_true(is_server_failure(socket.error()))
+    assert_false(is_server_failure(http_error(401)))
+    assert_false(is_server_failure(http_error(404)))
+
+
+def test_circuit_breaker():
+    now = [0]
+    breaker = CircuitBreaker(RetryPolicy(10, 100, rng=lambda: 1.0),
+                             failure_threshold=2, clock=lambda: now[0])
+    assert_true(breaker.allow_request())
+    assert_equals(breaker.record_failure(), None)
+    assert_true(breaker.allow_request())
+    assert_equals(breaker.record_failure(), 10)
+    assert_false(breaker.allow_request())
+    assert_equals(breaker.rejected, 1)
+
+    # Trial after the delay: its failure opens the breaker for longer
+    now[0] = 10
+    assert_true(breaker.allow_request())
+    assert_equals(breaker.record_failure(), 20)
+    now[0] = 29
+    assert_false(breaker.allow_request())
+    now[0] = 30
+    assert_true(breaker.allow_request())
+    breaker.record_success()
+    assert_equals(breaker.failures, 0)
+    assert_true(breaker.allow_request())
+
+    # Opened right away by a Retry-After delay
+    assert_equals(breaker.record_failure(retry_after=50), 50)
+    assert_false(breaker.allow_request())
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_circuit_breaker():
+    def unavailable(params, op_input, headers):
+        raise FakeServerError(503, "Maintenance",
+                              headers={'Retry-After': '120'})
+    SERVER.register_operation(
+        'NuxeoDrive.GetChangeSummary', unavailable,
+        params=[('lastSyncDate', False),
+                ('lastSyncActiveRootDefinitions', False)])
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    session.add(server_binding)
+    root_pair = LastKnownState(local_folder,
+        local_info=LocalClient(local_folder).get_info(u'/'))
+    session.add(root_pair)
+    session.commit()
+
+    sync = ctl.synchronizer
+    assert_equals(sync.update_synchronize_server(server_binding,
+                                                 session=session), 0)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+    # The server is not polled before the Retry-After delay
+    assert_equals(sync.update_synchronize_server(server_binding,
+                                                 session=session), 0)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+    circuit_breaker = sync.get_circuit_breaker(server_binding.server_url)
+    assert_true(circuit_breaker.retry_time is not None)
+    assert_equals(circuit_breaker.rejected, 1)
+
+    # The pairs in error are skipped for longer after each error
+    sync.error_skip_period = 10
+    for errors in (1, 2, 3):
+        before = time.time()
+        sync._skip_pair_in_error(session, root_pair)
+        assert_true(sync._is_pair_skipped(root_pair))
+        count, retry_time = sync._pair_errors[root_pair.id]
+        assert_equals(count, errors)
+        assert_true(retry_time - before >= 10 * 2 ** (errors - 1) / 2.0)
+    assert_true(root_pair.last_sync_error_date is not None)
+    ctl.dispose()
+
+
+@with_setup(setup_server, teardown_server)
+def test_synchronizer_skipped_pairs():
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    local_client = LocalClient(local_folder)
+    remote_client = RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                           'nxdrive-test-device', '1.0',
+                                           password='Administrator')
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    session.add(server_binding)
+    root_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    for name in (u'a.txt', u'b.txt', u'c.txt', u'd.txt'):
+        local_client.make_file(u'/', name, content='Content of ' + name)
+        doc_pair = LastKnownState(local_folder,
+            local_info=local_client.get_info(u'/' + name))
+        doc_pair.update_state('created', 'unknown')
+        session.add(doc_pair)
+    session.commit()
+
+    sync = ctl.synchronizer
+    sync.limit_pending = 2
+    # The first page of pending pairs failed several times: they are
+    # skipped for longer than the error_skip_period
+    skipped = session.query(LastKnownState).filter(
+        LastKnownState.local_name.in_([u'a.txt', u'b.txt'])).all()
+    for doc_pair in skipped:
+        sync._pair_errors[doc_pair.id] = 2, time.time() + 3600
+    # They do not hide the other pending pairs
+    assert_equals(sync.synchronize(server_binding), 2)
+    for doc_pair in session.query(LastKnownState).filter_by(
+        folderish=False):
+        if doc_pair in skipped:
+            assert_equals(doc_pair.pair_state, 'locally_created')
+        else:
+            assert_equals(doc_pair.pair_state, 'synchronized')
+    assert_equals(sync.synchronize(server_binding), 0)
+
+    # The content transfers back off for longer than the metadata
+    # operations, starting from the error_skip_period
+    sync.error_skip_period = 10
+    transfer_policy = sync.get_pair_retry_policy(skipped[0])
+    assert_equals(transfer_policy.base_delay, 10)
+    assert_equals(transfer_policy.max_delay,
+                  get_retry_policy(TRANSFER_OPERATIONS).max_delay)
+    deleted_pair = LastKnownState(local_folder,
+        local_info=local_client.get_info(u'/c.txt'))
+    deleted_pair.update_state('deleted', 'synchronized')
+    metadata_policy = sync.get_pair_retry_policy(deleted_pair)
+    assert_equals(metadata_policy.max_delay,
+                  get_retry_policy(METADATA_OPERATIONS).max_delay)
+    assert_true(transfer_policy.max_delay > metadata_policy.max_delay)
+
+    # A Retry-After delay sent by the server is honored
+    before = time.time()
+    sync._skip_pair_in_error(session, skipped[0],
+                             error=http_error(503, 'Retry-After: 120\n'))
+    assert_true(sync._pair_errors[skipped[0].id][1] - before >= 120)
+    ctl.dispose()
@@ -0,0 +1,174 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+import psutil
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.register_operation(
+        'NuxeoDrive.GetChangeSummary',
+        lambda params, op_input, headers: {
+            'fileSystemChanges': [],
+            'syncDate': 2000,
+            'activeSynchronizationRootDefinitions': '',
+            'hasTooManyChanges': True,
+            'minPollingInterval': 30,
+        },
+        params=[('lastSyncDate', False),
+                ('lastSyncActiveRootDefinitions', False)])
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def test_polling_delay():
+    workspace = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    try:
+        ctl = Controller(os.path.join(workspace, u'config'),
+                         full_scan_window=600)
+        sync = ctl.synchronizer
+        delays = [sync.get_polling_delay(5) for _ in range(100)]
+        assert_true(all(4 <= delay <= 6 for delay in delays))
+        assert_true(len(set(delays)) > 1)
+
+        # The server advertised interval is a minimum
+        sync._min_polling_intervals['http://server/'] = 30
+        assert_true(sync.get_polling_delay(5) >= 24)
+
+        # Same device, same slot
+        delay = sync.get_full_scan_delay()
+        assert_true(0 <= delay <= 600)
+        assert_equals(sync.get_full_scan_delay(), delay)
+        ctl.device_id = 'other-device'
+        assert_true(sync.get_full_scan_delay() != delay)
+        ctl.dispose()
+    finally:
+        shutil.rmtree(workspace)
+
+
+def test_loop_delay():
+    workspace = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    sensors_battery = getattr(psutil, 'sensors_battery', None)
+    try:
+        ctl = Controller(os.path.join(workspace, u'config'))
+        sync = ctl.synchronizer
+        sync.polling_jitter = 0
+        sync.is_power_saving = lambda: False
+
+        # Back off while idle, back to back passes after some activity
+        delays = [sync.get_loop_delay(5, 30) for _ in range(8)]
+        assert_equals(delays[:3], [5, 7.5, 11.25])
+        assert_equals(delays[-1], 30)
+        assert_equals(sync.get_loop_delay(5, 30, active=True), 0)
+        assert_equals(sync.get_loop_delay(5, 30), 5)
+
+        # Power saving
+        sync.is_power_saving = lambda: True
+        assert_equals(sync.get_loop_delay(5, 30, active=True), 5)
+        assert_equals(sync.get_loop_delay(5, 30), sync.power_saving_delay)
+        assert_equals(sync.get_loop_delay(5, 30, active=True,
+                                          power_saving=False), 0)
+        assert_equals(sync.get_loop_delay(0, 30, power_saving=False), 0)
+        del sync.is_power_saving
+        Battery = namedtuple('Battery', 'percent secsleft power_plugged')
+        psutil.sensors_battery = lambda: Battery(50, 3600, False)
+        assert_true(sync.is_power_saving())
+        psutil.sensors_battery = lambda: Battery(50, 3600, True)
+        sync.high_cpu_load = 101
+        assert_false(sync.is_power_saving())
+
+        # Remote change notifications end the sleep
+        sync._wakeup.set()
+        start = time.time()
+        sync._sleep(10, 5)
+        assert_true(time.time() - start < 1)
+
+        # No busy loop checking the stop requests with a null base delay
+        timeouts = []
+        wakeup = sync._wakeup
+
+        class Wakeup(object):
+            def wait(self, timeout):
+                timeouts.append(timeout)
+                return wakeup.wait(timeout)
+
+        wakeup.clear()
+        sync._wakeup = Wakeup()
+        sync._sleep(1.5, 0)
+        assert_equals(len(timeouts), 2)
+        assert_equals(timeouts[0], 1)
+        ctl.dispose()
+    finally:
+        if sensors_battery is not None:
+            psutil.sensors_battery = sensors_battery
+        elif hasattr(psutil, 'sensors_battery'):
+            del psutil.sensors_battery
+        shutil.rmtree(workspace)
+
+
+@with_setup(setup_server, teardown_server)
+def test_staggered_full_scan():
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    server_binding.last_sync_date = 1000
+    session.add(server_binding)
+    remote_client = RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                           'nxdrive-test-device', '1.0',
+                                           password='Administrator')
+    root_pair = LastKnownState(local_folder,
+        local_info=LocalClient(local_folder).get_info(u'/'),
+        remote_info=remote_client.get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    session.commit()
+
+    sync = ctl.synchronizer
+    full_scans = []
+    sync.scan_remote = lambda server_binding, session=None: (
+        full_scans.append(server_binding.local_folder))
+
+    # Too many changes: the full scan waits for the slot of the device
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(full_scans, [])
+    assert_equals(sync._min_polling_intervals, {SERVER.url: 30})
+    scheduled = sync._scheduled_full_scans[local_folder]
+    assert_true(scheduled <= time.time() + sync.full_scan_window)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+
+    # The server is not polled before the slot
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChangeSummary'), 1)
+
+    sync._scheduled_full_scans[local_folder] = time.time() - 1
+    sync.update_synchronize_server(server_binding, session=session)
+    assert_equals(full_scans, [local_folder])
+    assert_equals(sync._scheduled_full_scans, {})
+    assert_equals(server_binding.last_sync_date, 2000)
+    ctl.dispose()
@@ -0,0 +1,104 @@
+import threading
+import time
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.single_flight import SingleFlight
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+SERVER = None
+
+
+def setup_server():
+    global SERVER
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_call(value):
+        calls.append(value)
+        started.set()
+        release.wait()
+        return [value]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        single_flight.do('key', slow_call, 'value'))) for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    # Wait for the other threads to join the call in flight
+    deadline = time.time() + 5
+    while single_flight.coalesced < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert_equals(calls, ['value'])
+    assert_equals(len(results), 5)
+    # The decoded result is shared
+    assert_true(all(result is results[0] for result in results))
+    assert_equals(single_flight.get_metrics(),
+                  {'calls': 1, 'coalesced': 4})
+
+    # Calls made after the end of the previous one are run again, errors
+    # are raised to the caller
+    def failing_call():
+        raise ValueError('error')
+    assert_raises(ValueError, single_flight.do, 'key', failing_call)
+    assert_equals(single_flight.do('key', lambda: 'other'), 'other')
+    assert_equals(single_flight.get_metrics(),
+                  {'calls': 3, 'coalesced': 4})
+
+
+@with_setup(setup_server, teardown_server)
+def test_coalesced_remote_reads():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    get_fs_item = SERVER.operations['NuxeoDrive.GetFileSystemItem']['handler']
+
+    def slow_get_fs_item(params, op_input, headers):
+        release.wait()
+        return get_fs_item(params, op_input, headers)
+
+    SERVER.register_operation('NuxeoDrive.GetFileSystemItem',
+                              slow_get_fs_item, params=[('id', True)])
+    infos = []
+
+    def get_info():
+        # One client by thread, as with the controller
+        client = RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                        'nxdrive-test-device', '1.0',
+                                        password='Administrator',
+                                        single_flight=single_flight)
+        infos.append(client.get_info(SERVER.root_id))
+
+    threads = [threading.Thread(target=get_info) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while single_flight.coalesced < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert_equals([info.uid for info in infos], [SERVER.root_id] * 3)
+    requests = [path for method, path, headers in SERVER.requests
+                if path.endswith('NuxeoDrive.GetFileSystemItem')]
+    assert_equals(len(requests), 1)
+    assert_equals(single_flight.get_metrics(),
+                  {'calls': 1, 'coalesced': 2})
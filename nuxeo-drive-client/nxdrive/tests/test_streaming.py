@@ -0,0 +1,183 @@
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_raises
+from nose.tools import with_setup
+from nxdrive.client import CorruptedFile
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.streaming import DURABILITY_POLICIES
+from nxdrive.client.streaming import StreamWriter
+from nxdrive.client.streaming import get_buffer_size
+from nxdrive.client.streaming import iter_file
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+
+# Not a multiple of the buffer sizes to check the last partial chunk
+CONTENT = os.urandom(3 * 1024 ** 2 + 12345)
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client():
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator')
+
+
+def test_buffer_size():
+    with tempfile.TemporaryFile() as f:
+        buffer_size = get_buffer_size(f, buffer_size=1000000)
+        if sys.platform != 'win32':
+            block_size = os.fstatvfs(f.fileno()).f_bsize
+            assert_equals(buffer_size % block_size, 0)
+        assert_true(0 < buffer_size <= 1000000)
+    # No file descriptor: use the default size
+    assert_equals(get_buffer_size(None, buffer_size=4096), 4096)
+
+
+def test_iter_file():
+    with tempfile.TemporaryFile() as f:
+        f.write(CONTENT)
+        f.seek(0)
+        with io.open(f.fileno(), 'rb', buffering=0, closefd=False) as raw:
+            chunks = [chunk.tobytes() for chunk in iter_file(raw, 4096)]
+    assert_equals(len(chunks), len(CONTENT) // 4096 + 1)
+    assert_equals(''.join(chunks), CONTENT)
+
+
+@with_setup(setup_server, teardown_server)
+def test_streaming_upload_download():
+    remote_client = get_client()
+    file_path = os.path.join(TEST_WORKSPACE, 'upload.bin')
+    with open(file_path, 'wb') as f:
+        f.write(CONTENT)
+
+    fs_item_id = remote_client.stream_file(SERVER.root_id, file_path,
+                                           filename=u'upload.bin')
+    assert_equals(SERVER.get_content(fs_item_id), CONTENT)
+
+    # The downloaded content is received in the preallocated buffer
+    target = os.path.join(TEST_WORKSPACE, 'download.bin')
+    tmp_file = remote_client.stream_content(fs_item_id, target)
+    with open(tmp_file, 'rb') as f:
+        assert_equals(f.read(), CONTENT)
+
+    # In memory download
+    assert_equals(remote_client.get_content(fs_item_id), CONTENT)
+
+
+@with_setup(setup_server, teardown_server)
+def test_digest_while_streaming():
+    remote_client = get_client()
+    file_path = os.path.join(TEST_WORKSPACE, 'upload.bin')
+    with open(file_path, 'wb') as f:
+        f.write(CONTENT)
+    expected_digest = hashlib.md5(CONTENT).hexdigest()
+
+    digester = hashlib.md5()
+    fs_item_id = remote_client.stream_file(SERVER.root_id, file_path,
+                                           filename=u'upload.bin',
+                                           digester=digester)
+    assert_equals(digester.hexdigest(), expected_digest)
+
+    digester = hashlib.md5()
+    target = os.path.join(TEST_WORKSPACE, 'download.bin')
+    remote_client.stream_content(fs_item_id, target, digester=digester)
+    assert_equals(digester.hexdigest(), expected_digest)
+
+    # The digest of the downloaded content is checked even with another
+    # digest algorithm
+    digester = hashlib.sha1()
+    remote_client.stream_content(fs_item_id, target, digester=digester)
+    assert_equals(digester.hexdigest(), hashlib.sha1(CONTENT).hexdigest())
+
+    # A known digest is not computed again by the local client
+    local_client = LocalClient(TEST_WORKSPACE)
+    info = local_client.get_info(u'/upload.bin', digest='known digest')
+    assert_equals(info.get_digest(), 'known digest')
+    info = local_client.get_info(u'/upload.bin')
+    assert_equals(info.get_digest(), expected_digest)
+
+
+@with_setup(setup_server, teardown_server)
+def test_corrupted_download():
+    remote_client = get_client()
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'file.bin',
+                                 content=CONTENT)
+    SERVER.items[fs_item_id]['digest'] = hashlib.md5('other').hexdigest()
+
+    target = os.path.join(TEST_WORKSPACE, 'download.bin')
+    assert_raises(CorruptedFile, remote_client.stream_content, fs_item_id,
+                  target)
+    # No partial file is left behind
+    assert_equals(os.listdir(TEST_WORKSPACE), [])
+
+
+def test_stream_writer():
+    workspace = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    try:
+        for durability in DURABILITY_POLICIES:
+            file_path = os.path.join(workspace, durability + '.part')
+            with StreamWriter(file_path, size=len(CONTENT),
+                              durability=durability, window=4096) as f:
+                for i in range(0, len(CONTENT), 10000):
+                    f.write(memoryview(CONTENT)[i:i + 10000])
+            with open(file_path, 'rb') as f:
+                assert_equals(f.read(), CONTENT)
+
+        # Preallocated space is released for an incomplete download
+        file_path = os.path.join(workspace, 'incomplete.part')
+        with StreamWriter(file_path, size=len(CONTENT)) as f:
+            f.write(CONTENT[:1000])
+        assert_equals(os.path.getsize(file_path), 1000)
+
+        assert_raises(ValueError, StreamWriter, file_path,
+                      durability='unknown')
+    finally:
+        shutil.rmtree(workspace)
+
+
+@with_setup(setup_server, teardown_server)
+def test_digest_checked_once():
+    remote_client = get_client()
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'file.bin',
+                                 content=CONTENT)
+    digests = []
+
+    class CountingDigester(object):
+        name = hashlib.md5().name
+
+        def __init__(self):
+            self.md5 = hashlib.md5()
+
+        def update(self, data):
+            self.md5.update(data)
+
+        def hexdigest(self):
+            digests.append(self.md5.hexdigest())
+            return digests[-1]
+
+    target = os.path.join(TEST_WORKSPACE, 'download.bin')
+    remote_client.stream_content(fs_item_id, target,
+                                 digester=CountingDigester())
+    # The provided digester is used to check the downloaded content
+    assert_equals(digests, [hashlib.md5(CONTENT).hexdigest()])
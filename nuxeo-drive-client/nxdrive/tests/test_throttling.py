@@ -0,0 +1,105 @@
+from datetime import datetime
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from nose.tools import assert_raises
+from nxdrive.client.throttling import TokenBucket
+from nxdrive.client.throttling import Throttle
+from nxdrive.client.throttling import parse_schedule
+from nxdrive.client.throttling import in_schedule
+
+
+class FakeClock(object):
+    """Clock that only advances when sleeping"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+def test_unlimited_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(clock=clock, sleep=clock.sleep)
+    assert_false(bucket.is_limited())
+    for _ in range(1000):
+        assert_equals(bucket.consume(1024 ** 2), 0.0)
+    assert_equals(clock.now, 0.0)
+
+
+def test_bucket_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1000, clock=clock, sleep=clock.sleep)
+    assert_true(bucket.is_limited())
+
+    # The bucket starts full
+    assert_equals(bucket.consume(1000), 0.0)
+
+    # Chunks bigger than the burst size are allowed by going in debt
+    assert_equals(bucket.consume(5000), 5.0)
+    assert_equals(clock.now, 5.0)
+
+    # 10000 bytes at 1000 B/s takes 10s whatever the chunk size
+    for _ in range(100):
+        bucket.consume(100)
+    assert_equals(clock.now, 15.0)
+
+    # Idle time refills the bucket up to the burst size only
+    clock.now += 60
+    assert_equals(bucket.consume(1000), 0.0)
+    assert_equals(bucket.consume(1000), 1.0)
+
+
+def test_bucket_rate_change():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1000, clock=clock, sleep=clock.sleep)
+    bucket.consume(1000)
+    bucket.set_rate(100)
+    assert_equals(bucket.consume(100), 1.0)
+    bucket.set_rate(None)
+    assert_equals(bucket.consume(10000), 0.0)
+
+
+def test_schedule():
+    assert_equals(parse_schedule(None), None)
+    assert_equals(parse_schedule(''), None)
+    assert_equals(parse_schedule('08:00-18:30'), (480, 1110))
+    assert_raises(ValueError, parse_schedule, '8h-18h')
+    assert_raises(ValueError, parse_schedule, '08:00-24:00')
+
+    office_hours = parse_schedule('08:00-18:00')
+    assert_true(in_schedule(office_hours, datetime(2014, 1, 1, 8, 0)))
+    assert_true(in_schedule(office_hours, datetime(2014, 1, 1, 17, 59)))
+    assert_false(in_schedule(office_hours, datetime(2014, 1, 1, 18, 0)))
+    assert_false(in_schedule(office_hours, datetime(2014, 1, 1, 3, 0)))
+
+    night = parse_schedule('22:00-06:00')
+    assert_true(in_schedule(night, datetime(2014, 1, 1, 23, 0)))
+    assert_true(in_schedule(night, datetime(2014, 1, 1, 5, 0)))
+    assert_false(in_schedule(night, datetime(2014, 1, 1, 12, 0)))
+
+    assert_true(in_schedule(None))
+
+
+def test_throttle():
+    clock = FakeClock()
+    throttle = Throttle(upload_rate=1000, request_rate=2, clock=clock,
+                        sleep=clock.sleep)
+    assert_equals(throttle.upload(1000), 0.0)
+    assert_equals(throttle.upload(2000), 2.0)
+    assert_equals(throttle.download(10 ** 9), 0.0)
+
+    # A single request can be issued at once
+    assert_equals(throttle.request(), 0.0)
+    assert_equals(throttle.request(), 0.5)
+
+    # Runtime reconfiguration
+    throttle.configure(download_rate=1000)
+    assert_equals(throttle.upload(10 ** 9), 0.0)
+    assert_equals(throttle.request(), 0.0)
+    assert_equals(throttle.download(1000), 0.0)
+    assert_equals(throttle.download(1000), 1.0)
@@ -0,0 +1,145 @@
+import os
+import shutil
+import socket
+import tempfile
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.timeouts import DEFAULT_THROUGHPUT
+from nxdrive.client.timeouts import LinkStats
+from nxdrive.client.timeouts import ReadWatchdog
+from nxdrive.client.throttling import Throttle
+from nxdrive.client.timeouts import TransferTimeout
+from nxdrive.tests.fake_server import FakeAutomationServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+URL = 'http://server/'
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+
+
+def teardown_server():
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def test_link_stats():
+    stats = LinkStats()
+    # Nothing known yet: the minimum timeout and the default throughput
+    assert_equals(stats.get_timeout(URL, min_timeout=20), 20)
+    assert_equals(stats.get_timeout(URL, size=DEFAULT_THROUGHPUT), 4)
+
+    # A slow server gets longer timeouts
+    for _ in range(10):
+        stats.record_latency(URL, 30)
+    assert_true(stats.get_timeout(URL, min_timeout=20) > 30)
+    # A fast one the minimum timeout
+    for _ in range(50):
+        stats.record_latency(URL, 0.1)
+    assert_equals(stats.get_timeout(URL, min_timeout=20), 20)
+
+    # Big responses get more time on a slow link
+    stats.record_transfer(URL, 1024 ** 2, 100)
+    assert_true(stats.get_timeout(URL, size=1024 ** 2, min_timeout=20)
+                >= 20 + 100)
+    assert_equals(stats.get_throughput(URL, upload=True), DEFAULT_THROUGHPUT)
+    # Small transfers are dominated by the latency
+    stats.record_transfer(URL, 1024, 100)
+    assert_equals(stats.get_throughput(URL), 1024 ** 2 / 100.0)
+
+    stats.record_response_size(URL, 'NuxeoDrive.GetChildren', 1000)
+    assert_equals(stats.get_response_size(URL, 'NuxeoDrive.GetChildren'),
+                  1000)
+    assert_equals(stats.get_response_size(URL, 'NuxeoDrive.Delete'), 0)
+
+
+def test_read_watchdog():
+    clock = FakeClock()
+    watchdog = ReadWatchdog(10, deadline=100, clock=clock)
+    for _ in range(9):
+        clock.now += 9
+        watchdog.update(1024)
+    assert_equals(watchdog.n_bytes, 9 * 1024)
+
+    # Stalled
+    clock.now += 11
+    assert_raises(TransferTimeout, watchdog.update, 1024)
+
+    # Too slow
+    watchdog = ReadWatchdog(10, deadline=100, clock=clock)
+    clock.now = 101
+    assert_raises(TransferTimeout, watchdog.update, 1024)
+
+    # The time spent sleeping for the bandwidth limits is not counted
+    watchdog = ReadWatchdog(10, deadline=clock.now + 20, clock=clock)
+    clock.now += 5
+    watchdog.update(1024)
+    watchdog.pause(80)
+    clock.now += 85
+    watchdog.update(1024)
+    watchdog.pause(40)
+    clock.now += 45
+    watchdog.update(1024)
+    assert_equals(watchdog.get_duration(), 15)
+    clock.now += 11
+    assert_raises(TransferTimeout, watchdog.update, 1024)
+
+
+@with_setup(setup_server, teardown_server)
+def test_stalled_download():
+    content = os.urandom(1024 ** 2)
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'File.bin', content)
+    stats = LinkStats()
+    client = RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                    'nxdrive-test-device', '1.0',
+                                    password='Administrator', timeout=0.5,
+                                    link_stats=stats)
+    client.min_blob_timeout = 0.5
+    file_path = os.path.join(TEST_WORKSPACE, u'File.bin')
+    client.stream_content(fs_item_id, file_path)
+    assert_true(stats.get_throughput(SERVER.url) != DEFAULT_THROUGHPUT)
+
+    # The link gets much slower than usual: the download is aborted
+    # instead of blocking the synchronization
+    SERVER.blob_delay = 0.01
+    assert_raises(socket.timeout, client.stream_content, fs_item_id,
+                  file_path)
+
+
+@with_setup(setup_server, teardown_server)
+def test_throttled_download():
+    content = os.urandom(3 * 1024 ** 2)
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'File.bin', content)
+    stats = LinkStats()
+    client = RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                    'nxdrive-test-device', '1.0',
+                                    password='Administrator', timeout=0.5,
+                                    link_stats=stats)
+    client.min_blob_timeout = 0.5
+    file_path = os.path.join(TEST_WORKSPACE, u'File.bin')
+    client.stream_content(fs_item_id, file_path)
+
+    # The bandwidth limit makes the download much slower than the estimated
+    # throughput of the link: it is not aborted
+    client.set_throttle(Throttle(download_rate=1024 ** 2))
+    tmp_file = client.stream_content(fs_item_id, file_path)
+    with open(tmp_file, 'rb') as f:
+        assert_equals(f.read(), content)
@@ -0,0 +1,332 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+from nxdrive.client import CorruptedFile
+from nxdrive.client import LocalClient
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.remote_file_system_client import SINK_MAX_PENDING_CHUNKS
+from nxdrive.client.response_cache import ResponseCache
+from nxdrive.client.throttling import Throttle
+from nxdrive.client.transport import EventLoopTransport
+from nxdrive.client.transport import Request
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.fake_server import FakeAutomationServer
+from nxdrive.tests.fake_server import _ThreadingHTTPServer
+
+
+TEST_WORKSPACE = None
+SERVER = None
+TRANSPORT = None
+
+
+def setup_server():
+    global TEST_WORKSPACE, SERVER, TRANSPORT
+    TEST_WORKSPACE = tempfile.mkdtemp(prefix=u'-nxdrive-tests-')
+    SERVER = FakeAutomationServer()
+    SERVER.add_file_system_operations()
+    SERVER.etag_operations = ('NuxeoDrive.GetChildren',)
+    SERVER.response_encoding = 'gzip'
+    TRANSPORT = EventLoopTransport(max_connections=8)
+
+
+def teardown_server():
+    TRANSPORT.stop()
+    SERVER.stop()
+    shutil.rmtree(TEST_WORKSPACE)
+
+
+def get_client(**kwargs):
+    return RemoteFileSystemClient(SERVER.url, 'Administrator',
+                                  'nxdrive-test-device', '1.0',
+                                  password='Administrator',
+                                  transport=TRANSPORT, **kwargs)
+
+
+@with_setup(setup_server, teardown_server)
+def test_concurrent_requests():
+    client = get_client(response_cache=ResponseCache())
+    fs_item_ids = [SERVER.add_item(SERVER.root_id, u'File %d.txt' % i,
+                                   content='Content %d' % i)
+                   for i in range(100)]
+
+    # Many requests in flight, sent by a single thread
+    futures = [client.get_info_async(fs_item_id)
+               for fs_item_id in fs_item_ids]
+    infos = [future.result(timeout=10) for future in futures]
+    assert_equals([info.name for info in infos],
+                  [u'File %d.txt' % i for i in range(100)])
+    # The request handler threads of the fake server come and go
+    assert_equals([thread.name for thread in threading.enumerate()
+                   if thread.name == 'EventLoopTransport'],
+                  ['EventLoopTransport'])
+    assert_equals(TRANSPORT.requests, 100)
+
+    children = client.get_children_info_async(SERVER.root_id).result()
+    assert_equals(children, client.get_children_info(SERVER.root_id))
+    # Revalidated listing
+    client.get_children_info_async(SERVER.root_id).result()
+    assert_equals(client.response_cache.hits, 2)
+
+    assert_equals(client.get_info_async('unknown', raise_if_missing=False)
+                  .result(), None)
+    SERVER.operations.pop('NuxeoDrive.GetFileSystemItem')
+    error = client.get_info_async(fs_item_ids[0]).exception()
+    assert_true(isinstance(error, urllib2.HTTPError))
+    assert_equals(error.code, 404)
+
+    # Simulated network errors fail the futures
+    client.make_raise(IOError('Network error'))
+    assert_raises(IOError, client.get_children_info_async(
+        SERVER.root_id).result)
+
+
+class _ThreadDigester(object):
+    """MD5 digester recording the threads it is updated by
+
+    The updates wait for the unblocked event if given.
+    """
+
+    name = 'md5'
+
+    def __init__(self, unblocked=None):
+        self._digester = hashlib.md5()
+        self.threads = set()
+        self.unblocked = unblocked
+
+    def update(self, data):
+        self.threads.add(threading.current_thread().name)
+        if self.unblocked is not None:
+            self.unblocked.wait()
+        self._digester.update(data)
+
+    def hexdigest(self):
+        return self._digester.hexdigest()
+
+
+@with_setup(setup_server, teardown_server)
+def test_stream_content_async():
+    content = os.urandom(1024 ** 2 + 1234)
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'File.bin', content)
+    client = get_client()
+    file_path = os.path.join(TEST_WORKSPACE, u'File.bin')
+    digesters = [_ThreadDigester() for _ in range(10)]
+    futures = [client.stream_content_async(fs_item_id, file_path + str(i),
+                                           digester=digester)
+               for i, digester in enumerate(digesters)]
+    for future in futures:
+        with open(future.result(timeout=10), 'rb') as f:
+            assert_equals(f.read(), content)
+    # The event loop does not digest nor write the contents: the workers
+    # of the transport do
+    workers = set(['TransportWorker-%d' % i
+                   for i in range(TRANSPORT.workers.max_workers)])
+    for digester in digesters:
+        assert_equals(digester.hexdigest(), hashlib.md5(content).hexdigest())
+        assert_true(digester.threads)
+        assert_true(digester.threads <= workers)
+
+    SERVER.items[fs_item_id]['digest'] = 'invalid'
+    future = client.stream_content_async(fs_item_id, file_path)
+    assert_raises(CorruptedFile, future.result)
+    assert_true(u'.File.bin.part' not in os.listdir(TEST_WORKSPACE))
+
+
+@with_setup(setup_server, teardown_server)
+def test_stream_content_async_backpressure():
+    content = os.urandom(8 * 1024 ** 2 + 1234)
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'File.bin', content)
+    client = get_client()
+    file_path = os.path.join(TEST_WORKSPACE, u'File.bin')
+    unblocked = threading.Event()
+    digester = _ThreadDigester(unblocked=unblocked)
+    future = client.stream_content_async(fs_item_id, file_path,
+                                         digester=digester)
+
+    # The connection is not read while the sink is full
+    deadline = time.time() + 10
+    paused = []
+    while not paused and time.time() < deadline:
+        time.sleep(0.05)
+        paused = [connection
+                  for connections in TRANSPORT._connections.values()
+                  for connection in connections if connection.is_paused()]
+    assert_equals(len(paused), 1)
+    assert_equals(len(paused[0].sink._pending), SINK_MAX_PENDING_CHUNKS)
+    assert_true(not future.done())
+
+    unblocked.set()
+    with open(future.result(timeout=10), 'rb') as f:
+        assert_equals(f.read(), content)
+    assert_equals(digester.hexdigest(), hashlib.md5(content).hexdigest())
+
+
+@with_setup(setup_server, teardown_server)
+def test_stream_content_async_request_rate():
+    sleeping_threads = set()
+
+    def sleep(delay):
+        sleeping_threads.add(threading.current_thread().name)
+
+    # The clock is frozen: every request but the first one waits
+    client = get_client()
+    client.set_throttle(Throttle(request_rate=1, clock=lambda: 0.0,
+                                 sleep=sleep))
+    content = 'Some content'
+    fs_item_id = SERVER.add_item(SERVER.root_id, u'File.txt', content)
+    file_path = os.path.join(TEST_WORKSPACE, u'File.txt')
+    futures = [client.stream_content_async(fs_item_id, file_path + str(i))
+               for i in range(3)]
+    for future in futures:
+        with open(future.result(timeout=10), 'rb') as f:
+            assert_equals(f.read(), content)
+    # The request tokens are not waited for by the event loop
+    assert_equals(sleeping_threads, set(['MainThread']))
+
+
+class _ChunkedHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        body = ''.join('%x\r\n%s\r\n' % (len(chunk), chunk)
+                       for chunk in ('Hello', ' ' * 5000, self.path))
+        self.wfile.write(body + '0\r\n\r\n')
+
+
+class _DroppingHandler(BaseHTTPRequestHandler):
+    """Close the connection without response to the /drop requests"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply()
+
+    def reply(self):
+        self.server.received.append((self.command, self.path))
+        if self.path == '/drop':
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('OK')
+
+
+def test_retry_idempotent_requests():
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _DroppingHandler)
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    transport = EventLoopTransport(max_connections=1)
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        for method, attempts in (('GET', 2), ('POST', 1)):
+            del server.received[:]
+            assert_equals(transport.submit(Request(url + 'ok', method=method))
+                          .result(timeout=10).body, 'OK')
+            # Failing on the kept alive connection: only the idempotent
+            # requests are sent again, the others may have been processed
+            future = transport.submit(Request(url + 'drop', method=method))
+            assert_true(future.exception(timeout=10) is not None)
+            assert_equals(server.received,
+                          [(method, '/ok')] + [(method, '/drop')] * attempts)
+        # An Automation operation without side effect can be sent again
+        del server.received[:]
+        transport.submit(Request(url + 'ok', method='POST')).result(
+            timeout=10)
+        future = transport.submit(Request(url + 'drop', method='POST',
+                                          idempotent=True))
+        assert_true(future.exception(timeout=10) is not None)
+        assert_equals(server.received,
+                      [('POST', '/ok'), ('POST', '/drop'), ('POST', '/drop')])
+    finally:
+        transport.stop()
+        server.shutdown()
+        server.server_close()
+
+
+def test_keep_alive():
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _ChunkedHandler)
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    transport = EventLoopTransport(max_connections=2)
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        for i in range(5):
+            futures = [transport.submit(Request(url + '%d/%d' % (i, j)))
+                       for j in range(10)]
+            for j, future in enumerate(futures):
+                response = future.result(timeout=10)
+                assert_equals(response.status, 200)
+                assert_equals(response.body, 'Hello' + ' ' * 5000
+                              + '/%d/%d' % (i, j))
+        # The connections are reused
+        assert_true(len(server.connections) <= 2)
+    finally:
+        transport.stop()
+        server.shutdown()
+        server.server_close()
+
+
+@with_setup(setup_server, teardown_server)
+def test_scan_remote():
+    folder_ids = []
+    for i in range(3):
+        folder_id = SERVER.add_item(SERVER.root_id, u'Folder %d' % i,
+                                    folder=True)
+        folder_ids.append(folder_id)
+        for j in range(3):
+            sub_folder_id = SERVER.add_item(folder_id, u'Sub %d' % j,
+                                            folder=True)
+            SERVER.add_item(sub_folder_id, u'File.txt', content='Content')
+    local_folder = os.path.join(TEST_WORKSPACE, u'Nuxeo Drive')
+    os.mkdir(local_folder)
+    ctl = Controller(os.path.join(TEST_WORKSPACE, u'config'))
+    session = ctl.get_session()
+    server_binding = ServerBinding(local_folder, SERVER.url,
+                                   'Administrator',
+                                   remote_password='Administrator')
+    session.add(server_binding)
+    root_pair = LastKnownState(local_folder,
+        local_info=LocalClient(local_folder).get_info(u'/'),
+        remote_info=get_client().get_info(SERVER.root_id))
+    root_pair.update_state('synchronized', 'synchronized')
+    session.add(root_pair)
+    session.commit()
+
+    ctl.synchronizer.scan_remote(server_binding, session=session)
+    # The children of the subfolders are listed by the event loop transport
+    assert_equals(ctl.transport.requests, 3 + 9)
+    assert_equals(SERVER.count_requests('NuxeoDrive.GetChildren'), 1 + 3 + 9)
+    # All the remote documents are bound to new pairs
+    assert_equals(session.query(LastKnownState).filter_by(
+        local_path=None).count(), 3 + 9 + 9)
+    ctl.dispose()